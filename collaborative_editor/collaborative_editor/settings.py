@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'editor.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'collaborative_editor.urls'
@@ -71,15 +72,97 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'collaborative_editor.asgi.application'
 
+# Group members in the same process are served from memory by
+# editor.layers.HybridChannelLayer; Redis only carries messages between
+# processes.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'editor.layers.HybridChannelLayer',
         'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+            'backend': {
+                'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {
+                    "hosts": [('127.0.0.1', 6379)],
+                    },
+                },
             },
         },
     }
 
+# Realtime editor
+# Edits are kept in memory and written back by editor.persistence: a dirty
+# document is saved at most every EDITOR_FLUSH_INTERVAL seconds, or once it has
+# been quiet for EDITOR_IDLE_FLUSH seconds, and always when the last user leaves.
+EDITOR_FLUSH_INTERVAL = 5.0
+EDITOR_IDLE_FLUSH = 1.0
+# Frames fanned out to a room are encoded once with this callable. Use
+# 'editor.broadcast.orjson_dumps' when orjson is installed.
+EDITOR_JSON_ENCODER = 'json.dumps'
+# Cursor moves are coalesced per user and sent to the room at most this many
+# times per second, batched into a single frame.
+EDITOR_CURSOR_RATE = 20
+# Recent operations kept per room. Clients reconnecting within this window get
+# the missed operations replayed instead of the whole document.
+EDITOR_HISTORY_SIZE = 1000
+# Have browsers negotiate the compact binary frame encoding (editor.protocol)
+# instead of JSON text frames.
+EDITOR_BINARY_PROTOCOL = False
+# Every flush appends the new operations to the op log (DocumentOperation).
+# A full checkpoint is stored as a DocumentVersion every EDITOR_CHECKPOINT_OPS
+# operations or EDITOR_CHECKPOINT_INTERVAL seconds, whichever comes first.
+# `manage.py compact_oplog` folds operations older than EDITOR_OPLOG_RETENTION
+# seconds into checkpoints.
+EDITOR_CHECKPOINT_OPS = 500
+EDITOR_CHECKPOINT_INTERVAL = 600
+EDITOR_OPLOG_RETENTION = 7 * 24 * 3600
+# Versions are stored as reverse deltas against the next newer version, with a
+# full copy every EDITOR_VERSION_KEYFRAME versions, zlib-compressed when
+# EDITOR_VERSION_COMPRESSION is on. `manage.py compress_versions` converts
+# existing rows.
+EDITOR_VERSION_KEYFRAME = 20
+EDITOR_VERSION_COMPRESSION = True
+# Version comparisons served by the compare API are memoized per process for
+# this many version pairs.
+EDITOR_DIFF_CACHE_SIZE = 128
+# Each document's room is held by one worker, chosen by consistent hashing
+# over the live workers (editor.sharding). Workers heartbeat every
+# EDITOR_WORKER_HEARTBEAT seconds and are dropped after missing three.
+EDITOR_WORKER_HEARTBEAT = 5.0
+# Frames for a connection are written at most every EDITOR_SEND_INTERVAL
+# seconds, batched into one frame (editor.outbox). A client with more than
+# EDITOR_SEND_QUEUE frames waiting gets a fresh snapshot instead.
+EDITOR_SEND_INTERVAL = 0.02
+EDITOR_SEND_QUEUE = 256
+# Each connection renews its presence in the room every
+# EDITOR_PRESENCE_HEARTBEAT seconds and is dropped after missing three.
+EDITOR_PRESENCE_HEARTBEAT = 15.0
+# Set to a directory to record every room session there as a trace that
+# `manage.py replay_trace` can play back (editor.trace). Off by default.
+EDITOR_TRACE_DIR = None
+# Counters and histograms for the realtime layer and the editor views
+# (editor.metrics), served in the Prometheus text format at /metrics/ to staff
+# or to requests bearing EDITOR_METRICS_TOKEN. With
+# EDITOR_METRICS_LOG_INTERVAL set they are also logged every that many seconds.
+EDITOR_METRICS = True
+EDITOR_METRICS_TOKEN = None
+EDITOR_METRICS_LOG_INTERVAL = None
+# Admission control (editor.limits), per second with bursts of twice that.
+# Edits over a connection's or the room's budget are held back and merged;
+# cursor frames over budget are dropped. Larger frames close the connection
+# and a room with EDITOR_MAX_ROOM_MEMBERS connections turns new ones away.
+EDITOR_EDIT_RATE = 20
+EDITOR_ROOM_EDIT_RATE = 200
+EDITOR_CURSOR_INPUT_RATE = 30
+EDITOR_ROOM_CURSOR_INPUT_RATE = 300
+EDITOR_MAX_FRAME_BYTES = 512 * 1024
+EDITOR_MAX_ROOM_MEMBERS = 100
+# Rooms with no activity for EDITOR_ROOM_IDLE_TIMEOUT seconds, and the least
+# recently active ones while all rooms of a worker hold more than
+# EDITOR_ROOM_MEMORY_BUDGET bytes, are saved and evicted from memory
+# (editor.rooms.RoomManager). They are loaded again on their next edit.
+EDITOR_ROOM_IDLE_TIMEOUT = 600
+EDITOR_ROOM_MEMORY_BUDGET = 256 * 1024 * 1024
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
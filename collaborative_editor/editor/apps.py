@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class EditorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'editor'
+
+    def ready(self):
+        from django.conf import settings
+
+        from . import signals  # noqa: F401
+        from .metrics import registry
+        registry.enabled = getattr(settings, 'EDITOR_METRICS', True)
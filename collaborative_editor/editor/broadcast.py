@@ -0,0 +1,53 @@
+from functools import lru_cache
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .protocol import encode_binary
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj).decode()
+
+
+@lru_cache(maxsize=None)
+def _load_encoder(path):
+    return import_string(path)
+
+
+def encode(frame):
+    # EDITOR_JSON_ENCODER is a dotted path to a callable returning a str,
+    # e.g. 'editor.broadcast.orjson_dumps' when orjson is installed
+    return _load_encoder(getattr(settings, 'EDITOR_JSON_ENCODER', 'json.dumps'))(frame)
+
+
+async def fan_out(channel_layer, group, frame, exclude=None, binary=False):
+    # Encode the outgoing frame once for the whole group; members forward the
+    # pre-encoded text as is (see EditorConsumer.send_frame). The binary form
+    # is added when some member negotiated the binary protocol.
+    message = {'type': 'send.frame', 'kind': frame['type'], 'text': encode(frame)}
+    if binary:
+        message['bytes'] = encode_binary(frame)
+
+    send_except = getattr(channel_layer, 'group_send_except', None)
+    if send_except is not None:
+        await send_except(group, message, exclude)
+    elif isinstance(channel_layer, InMemoryChannelLayer):
+        # Group membership is visible in-process, so skip the sender up front
+        for channel in list(channel_layer.groups.get(group, ())):
+            if channel != exclude:
+                try:
+                    await channel_layer.send(channel, message)
+                except ChannelFull:
+                    pass
+    else:
+        # Membership lives in the backend; members drop their own frames
+        message['exclude'] = exclude
+        await channel_layer.group_send(group, message)
@@ -0,0 +1,244 @@
+import random
+import sys
+
+# Chunks are kept at most this long; small inserts are spliced into an
+# existing chunk, larger ones become new nodes.
+MAX_CHUNK = 512
+
+_priorities = random.Random()
+
+
+class _Node:
+    __slots__ = ('text', 'left', 'right', 'priority', 'size', 'lines')
+
+    def __init__(self, text, priority=None):
+        self.text = text
+        self.left = None
+        self.right = None
+        self.priority = _priorities.random() if priority is None else priority
+        self.size = len(text)
+        self.lines = text.count('\n')
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _lines(node):
+    return node.lines if node is not None else 0
+
+
+def _update(node):
+    node.size = len(node.text) + _size(node.left) + _size(node.right)
+    node.lines = node.text.count('\n') + _lines(node.left) + _lines(node.right)
+
+
+def _split(node, offset):
+    # Returns (left, right) where left holds the first `offset` characters
+    if node is None:
+        return None, None
+    left_size = _size(node.left)
+    if offset <= left_size:
+        left, node.left = _split(node.left, offset)
+        _update(node)
+        return left, node
+    end = left_size + len(node.text)
+    if offset >= end:
+        node.right, right = _split(node.right, offset - end)
+        _update(node)
+        return node, right
+    # The cut falls inside this chunk. The tail inherits our priority so the
+    # heap order with node.right is preserved.
+    cut = offset - left_size
+    tail = _Node(node.text[cut:], node.priority)
+    node.text = node.text[:cut]
+    tail.right, node.right = node.right, None
+    _update(node)
+    _update(tail)
+    return node, tail
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _collect(node, start, end, parts):
+    # Append the chunks overlapping [start, end) of this subtree in order
+    while node is not None and start < end:
+        left_size = _size(node.left)
+        if start < left_size:
+            _collect(node.left, start, min(end, left_size), parts)
+        text_end = left_size + len(node.text)
+        if start < text_end and end > left_size:
+            parts.append(node.text[max(start - left_size, 0):end - left_size])
+        start, end = max(start - text_end, 0), end - text_end
+        node = node.right
+
+
+class Rope:
+    # Balanced tree of text chunks (a treap keyed by offset). Each node caches
+    # the length and newline count of its subtree, which doubles as the
+    # line-start index: offset <-> line lookups are a single O(log n) descent.
+    # Inserts and deletes touch O(log n) nodes and never copy the whole text.
+    __slots__ = ('root',)
+
+    def __init__(self, text=''):
+        self.root = None
+        if text:
+            self.root = self._build(text)
+
+    @staticmethod
+    def _build(text):
+        stack = []
+        for start in range(0, len(text), MAX_CHUNK):
+            node = _Node(text[start:start + MAX_CHUNK])
+            last = None
+            while stack and stack[-1].priority < node.priority:
+                last = stack.pop()
+                _update(last)
+            node.left = last
+            if stack:
+                stack[-1].right = node
+            stack.append(node)
+        for node in reversed(stack):
+            _update(node)
+        return stack[0]
+
+    def __len__(self):
+        return _size(self.root)
+
+    def memory_usage(self):
+        # Bytes held by the nodes and their text
+        stack, total = [self.root] if self.root is not None else [], 0
+        while stack:
+            node = stack.pop()
+            total += sys.getsizeof(node) + sys.getsizeof(node.text)
+            stack.extend(child for child in (node.left, node.right) if child is not None)
+        return total
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    def __eq__(self, other):
+        if isinstance(other, Rope):
+            other = str(other)
+        return isinstance(other, str) and len(self) == len(other) and str(self) == other
+
+    def chunks(self):
+        stack, node = [], self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.text
+            node = node.right
+
+    def insert(self, offset, text):
+        if not 0 <= offset <= len(self):
+            raise IndexError('insert out of range')
+        if not text:
+            return
+        if len(text) <= MAX_CHUNK and self._insert_in_place(offset, text):
+            return
+        left, right = _split(self.root, offset)
+        self.root = _merge(_merge(left, self._build(text)), right)
+
+    def _insert_in_place(self, offset, text):
+        # Splice into the chunk containing offset when it has room, updating
+        # the cached sizes on the way back up
+        path, node = [], self.root
+        while node is not None:
+            left_size = _size(node.left)
+            end = left_size + len(node.text)
+            if offset < left_size:
+                path.append(node)
+                node = node.left
+            elif offset <= end:
+                if len(node.text) + len(text) > MAX_CHUNK:
+                    return False
+                cut = offset - left_size
+                node.text = node.text[:cut] + text + node.text[cut:]
+                path.append(node)
+                break
+            else:
+                path.append(node)
+                offset -= end
+                node = node.right
+        else:
+            return False
+        for node in reversed(path):
+            _update(node)
+        return True
+
+    def delete(self, offset, length):
+        if offset < 0 or length < 0 or offset + length > len(self):
+            raise IndexError('delete out of range')
+        if not length:
+            return
+        left, rest = _split(self.root, offset)
+        _, right = _split(rest, length)
+        self.root = _merge(left, right)
+
+    def substring(self, start, end):
+        parts = []
+        _collect(self.root, max(start, 0), min(end, len(self)), parts)
+        return ''.join(parts)
+
+    @property
+    def line_count(self):
+        return _lines(self.root) + 1
+
+    def line_of(self, offset):
+        # 0-based line containing offset
+        if not 0 <= offset <= len(self):
+            raise IndexError('offset out of range')
+        line, node = 0, self.root
+        while node is not None:
+            left_size = _size(node.left)
+            if offset < left_size:
+                node = node.left
+                continue
+            line += _lines(node.left)
+            offset -= left_size
+            if offset <= len(node.text):
+                return line + node.text.count('\n', 0, offset)
+            line += node.text.count('\n')
+            offset -= len(node.text)
+            node = node.right
+        return line
+
+    def line_start(self, line):
+        # Offset of the first character on a 0-based line
+        if not 0 <= line < self.line_count:
+            raise IndexError('line out of range')
+        if line == 0:
+            return 0
+        offset, node = 0, self.root
+        while node is not None:
+            left_lines = _lines(node.left)
+            if line <= left_lines:
+                node = node.left
+                continue
+            line -= left_lines
+            offset += _size(node.left)
+            here = node.text.count('\n')
+            if line <= here:
+                index = -1
+                for _ in range(line):
+                    index = node.text.index('\n', index + 1)
+                return offset + index + 1
+            line -= here
+            offset += len(node.text)
+            node = node.right
+        raise IndexError('line out of range')
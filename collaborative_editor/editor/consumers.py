@@ -1,14 +1,49 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Document
-import asyncio
+from . import metrics
+from .limits import FRAME_TOO_LARGE, ROOM_FULL, TokenBucket, cursor_input_rate, max_frame_bytes
+from .outbox import Outbox
+from .permissions import can_edit, permission_level
+from .presence import heartbeat_interval
+from .protocol import BINARY_SUBPROTOCOL, ProtocolError, decode_binary
+from .sharding import get_worker
+
+CLIENT_FRAMES = ('text_change', 'cursor_position', 'viewport', 'resync')
 
 class EditorConsumer(AsyncWebsocketConsumer):
+    # The document's Room lives in whichever worker owns it (editor.sharding);
+    # this consumer validates client frames and hands them over as commands.
+    # Everything the client is sent arrives through send_frame and is written
+    # out by an Outbox.
+
     async def connect(self):
+        started = time.perf_counter()
         self.document_id = self.scope['url_route']['kwargs']['document_id']
         self.room_group_name = f'editor_{self.document_id}'
         self.user_id = self.scope['user'].id if self.scope['user'].is_authenticated else 'anonymous'
+        # Reconnecting clients tell us where they left off
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.client_id = query.get('client_id', [None])[0]
+        resume_epoch = query.get('epoch', [None])[0]
+        resume_revision = query.get('revision', [''])[0]
+
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', ())
+
+        # Resolved once here and refreshed when the document's permissions change
+        self.permission_level = await self.get_permission_level()
+        if self.permission_level is None:
+            await self.close()
+            return
+
+        self.outbox = Outbox(self.send, self.binary, lambda: self.command('resync'))
+        # Excess cursor frames are dropped here; edits are limited by the room
+        self.cursor_budget = TokenBucket(cursor_input_rate())
+        self.worker = get_worker(self.channel_layer_alias)
+        await self.worker.start()
 
         # Join room group
 
@@ -17,132 +52,113 @@ class EditorConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
-
-        # Send current document content
-        content = await self.get_document_content()
-        await self.send(text_data=json.dumps({
-            'type': 'document_content',
-            'content': content,
-            'user_id': self.user_id
-        }))
+        await self.accept(subprotocol=BINARY_SUBPROTOCOL if self.binary else None)
+        metrics.connections.inc()
 
-        # Notify others of new user
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_joined',
-                'user_id': self.user_id
-            }
-        )
+        # The owner replies with a replay or the document content and tells
+        # the others we joined
+        await self.command('attach', {
+            'binary': self.binary,
+            'epoch': resume_epoch,
+            'revision': int(resume_revision) if resume_revision.isdigit() else None
+        })
+        self.heartbeat = asyncio.get_running_loop().create_task(self.send_heartbeats())
+        metrics.connect_seconds.observe(time.perf_counter() - started)
 
     async def disconnect(self, close_code):
-        # Notify others that the user left
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_left',
-                'user_id': self.user_id
-            }
-        )
+        if getattr(self, 'worker', None) is None:
+            # Rejected before joining
+            return
+        self.heartbeat.cancel()
+        self.outbox.close()
+        metrics.connections.dec()
+
+        await self.command('detach')
 
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
-    
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+
+    async def command(self, op, fields=None):
+        await self.worker.command(self.document_id, {
+            'op': op,
+            'channel': self.channel_name,
+            'user_id': self.user_id,
+            **(fields or {})
+        })
+
+    async def send_heartbeats(self):
+        # Keeps our entry in the room's presence alive, see editor.presence
+        while True:
+            await asyncio.sleep(heartbeat_interval())
+            # Also renews the room group membership before group_expiry
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+            await self.command('heartbeat', {'binary': self.binary})
+
+    async def receive(self, text_data=None, bytes_data=None):
+        size = len(bytes_data) if bytes_data is not None else len(text_data.encode())
+        metrics.frame_bytes.observe(size, ('in',))
+        if size > max_frame_bytes():
+            metrics.limited.inc(('frame_too_large',))
+            await self.close(code=FRAME_TOO_LARGE)
+            return
+        try:
+            data = decode_binary(bytes_data) if bytes_data is not None else json.loads(text_data)
+            if isinstance(data, dict) and isinstance(data.get('text'), str):
+                # JSON escapes can smuggle in lone surrogates, which are not
+                # UTF-8 and could not be stored or sent to binary clients
+                data['text'].encode()
+        except (ProtocolError, ValueError):
+            return
+        if not isinstance(data, dict):
+            # Valid JSON but not a frame, dropped like malformed input
+            return
         msg_type = data.get('type')
+        metrics.frames_received.inc((msg_type if msg_type in CLIENT_FRAMES else 'other',))
 
         if msg_type == 'text_change':
-            await self.handle_text_change(data)
+            if not can_edit(self.permission_level):
+                # Read-only member: undo whatever the client applied locally
+                await self.command('resync')
+            else:
+                await self.command('submit', {'client_id': self.client_id, 'data': data})
         elif msg_type == 'cursor_position':
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'cursor_update',
-                    'user_id': self.user_id,
-                    'position': data['position'],
-                    'selection': data.get('selection')
-                }
-            )
-    
-    async def handle_text_change(self, data):
-        operation = data['operation'] # Insert, delete or replace
-        position = data['position']
-        text = data.get('text', '')
-        length = data.get('length', 0)
-
-        # Save to database
-        await self.save_document_content(data['content'])
-
-        # Broadcast to all users except the sender
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'broadcast_text_change',
-                'user_id': self.user_id,
-                'operation': operation,
-                'position': position,
-                'text': text,
-                'length': length,
-                'content': data['content']
-            }
-        )
-
-    # Message handlers called by channel layer when group_send is used
-    async def broadcast_text_change(self, event):
-        if event['user_id'] != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'text_change',
-                'user_id': event['user_id'],
-                'operation': event['operation'],
-                'position': event['position'],
-                'text': event['text'],
-                'length': event['length'],
-                'content': event['content']
-            }))
-    
-    async def cursor_update(self, event):
-        if event['user_id'] != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_position',
-                'user_id': event['user_id'],
-                'position': event['position'],
-                'selection': event.get('selection')
-            }))
-
-    async def user_joined(self, event):
-        if event['user_id'] != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'user_joined',
-                'user_id': event['user_id']
-            }))
-    
-    async def user_left(self, event):
-        if event['user_left'] != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'user_left',
-                'user_id': event['user_id']
-            }))
+            if not self.cursor_budget.take():
+                metrics.limited.inc(('cursor_dropped',))
+                return
+            position, selection = data.get('position'), data.get('selection')
+            if type(position) is not int or position < 0:
+                return
+            if not (isinstance(selection, dict) and all(
+                type(selection.get(key)) is int and selection[key] >= 0 for key in ('from', 'to')
+            )):
+                selection = None
+            await self.command('cursor', {'position': position, 'selection': selection})
+        elif msg_type == 'viewport':
+            first_line, last_line = data.get('from_line'), data.get('to_line')
+            if type(first_line) is int and type(last_line) is int and first_line <= last_line:
+                await self.command('viewport', {'from_line': first_line, 'to_line': last_line})
+        elif msg_type == 'resync':
+            await self.command('resync')
+
+    # Called by the channel layer for frames fanned out by editor.broadcast
+    async def send_frame(self, event):
+        if event.get('exclude') != self.channel_name:
+            await self.outbox.put(event)
+
+    # Sent by the room's worker when it already has EDITOR_MAX_ROOM_MEMBERS
+    async def room_full(self, event):
+        await self.close(code=ROOM_FULL)
+
+    # Sent by editor.signals when the owner or a collaborator changes
+    async def permissions_changed(self, event):
+        self.permission_level = await self.get_permission_level()
+        if self.permission_level is None:
+            await self.close()
 
     @database_sync_to_async
-    def get_document_content(self):
-        try:
-            doc = Document.objects.get(id=self.document_id)
-            return doc.content
-        except Document.DoesNotExist:
-            return ""
-
-
-    @database_sync_to_async
-    def save_document_content(self, content):
-        try:
-            doc = Document.objects.get(id=self.document_id)
-            doc.content = content
-            doc.save()
-        except Document.DoesNotExist:
-            pass
\ No newline at end of file
+    def get_permission_level(self):
+        with metrics.db_seconds.time(('permission',)):
+            return permission_level(self.document_id, self.scope['user'])
@@ -0,0 +1,147 @@
+import asyncio
+from bisect import bisect_left, bisect_right, insort
+
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .broadcast import encode
+from .protocol import encode_binary
+
+
+class ViewportIndex:
+    # Visible line range per connection, kept sorted by first line so the
+    # viewports overlapping a span of lines can be found without scanning
+    # every member of a large room. No viewport is taller than the tallest
+    # one, so only those starting within that many lines above the span can
+    # reach into it.
+
+    def __init__(self):
+        self.ranges = {}  # channel_name -> (first_line, last_line)
+        self._starts = []  # sorted (first_line, last_line, channel_name)
+        self._heights = []  # sorted last_line - first_line of every viewport
+
+    def __contains__(self, channel):
+        return channel in self.ranges
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def update(self, channel, first_line, last_line):
+        self.remove(channel)
+        self.ranges[channel] = (first_line, last_line)
+        insort(self._starts, (first_line, last_line, channel))
+        insort(self._heights, last_line - first_line)
+
+    def remove(self, channel):
+        old = self.ranges.pop(channel, None)
+        if old is not None:
+            self._starts.remove((old[0], old[1], channel))
+            del self._heights[bisect_left(self._heights, old[1] - old[0])]
+
+    def overlapping(self, first_line, last_line):
+        if not self._starts:
+            return []
+        begin = bisect_left(self._starts, (first_line - self._heights[-1],))
+        end = bisect_right(self._starts, (last_line, float('inf'), ''))
+        return [channel for start, stop, channel in self._starts[begin:end] if stop >= first_line]
+
+
+class CursorCoalescer:
+    # Keeps only the latest cursor per user and publishes them to the room at
+    # most EDITOR_CURSOR_RATE times per second, however fast clients report
+    # cursor activity. A member only receives full cursors for users whose
+    # cursor or selection intersects its reported viewport; for the others it
+    # gets just the line the user moved to, and only when that line changes.
+
+    def __init__(self, room):
+        self.room = room
+        self.pending = {}  # user_id -> cursor
+        self.lines = {}  # user_id -> last line announced to off-screen members
+        self._task = None
+
+    @property
+    def interval(self):
+        return 1 / getattr(settings, 'EDITOR_CURSOR_RATE', 20)
+
+    def update(self, user_id, position, selection=None):
+        self.pending[user_id] = {
+            'user_id': user_id,
+            'position': position,
+            'selection': selection
+        }
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def discard(self, user_id):
+        self.pending.pop(user_id, None)
+        self.lines.pop(user_id, None)
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.pending.clear()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    def line_span(self, cursor):
+        buffer = self.room.buffer
+        offsets = [cursor['position']]
+        selection = cursor.get('selection')
+        if isinstance(selection, dict):
+            offsets += [selection.get('from'), selection.get('to')]
+        lines = [
+            buffer.line_of(min(max(offset, 0), len(buffer)))
+            for offset in offsets if type(offset) is int
+        ]
+        return (min(lines), max(lines)) if lines else (0, 0)
+
+    def frames(self, cursors):
+        # Returns {channel_name: frame} for every member with something to see.
+        # Members that never reported a viewport see every cursor. Only the
+        # members that see a cursor are visited, unless its line changed and
+        # everyone else has to be told.
+        viewports = self.room.viewports
+        members = self.room.members
+        everywhere = []
+        if len(viewports) < len(members):
+            everywhere = [channel for channel in members if channel not in viewports]
+        shown, offscreen = {}, {}
+        for cursor in cursors:
+            user_id = cursor['user_id']
+            first, last = self.line_span(cursor)
+            seen_by = set(everywhere)
+            seen_by.update(channel for channel in viewports.overlapping(first, last) if channel in members)
+            for channel in seen_by:
+                shown.setdefault(channel, []).append(cursor)
+            if self.lines.get(user_id) != first:
+                self.lines[user_id] = first
+                for channel in members:
+                    if channel not in seen_by:
+                        offscreen.setdefault(channel, []).append({'user_id': user_id, 'line': first})
+        return {
+            channel: {'type': 'cursors', 'cursors': shown.get(channel, []), 'offscreen': offscreen.get(channel, [])}
+            for channel in shown.keys() | offscreen.keys()
+        }
+
+    async def flush(self):
+        if not self.pending:
+            return
+        cursors, self.pending = list(self.pending.values()), {}
+        layer = self.room.channel_layer or get_channel_layer()
+        # Members seeing the same cursors share one encoded frame
+        encoded = {}
+        for channel, frame in self.frames(cursors).items():
+            binary = channel in self.room.binary_channels
+            key = (binary, repr(frame))
+            if key not in encoded:
+                if binary:
+                    encoded[key] = {'type': 'send.frame', 'kind': 'cursors', 'bytes': encode_binary(frame)}
+                else:
+                    encoded[key] = {'type': 'send.frame', 'kind': 'cursors', 'text': encode(frame)}
+            try:
+                await layer.send(channel, encoded[key])
+            except ChannelFull:
+                pass
@@ -0,0 +1,177 @@
+# Line-level diff between document versions. Lines are interned to integers
+# first so the Myers search compares ints instead of strings, and the search
+# itself is the linear-space divide and conquer variant, O((N + M) * D) time
+# for D changed lines.
+from functools import lru_cache
+
+from django.conf import settings
+
+from .models import DocumentVersion
+from .versions import version_content
+
+
+def _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi):
+    # Returns (x, y, u, v): a diagonal run a[x:u] == b[y:v] lying on an
+    # optimal edit path, plus the length of that path
+    n, m = a_hi - a_lo, b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    forward, backward = {1: 0}, {1: 0}
+    for d in range((n + m + 1) // 2 + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k] >= n:
+                return a_lo + start_x, b_lo + start_y, a_lo + x, b_lo + y, 2 * d - 1
+        for k in range(-d, d + 1, 2):
+            # Same search from the ends of both sequences
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return a_hi - x, b_hi - y, a_hi - start_x, b_hi - start_y, 2 * d
+    raise AssertionError('no middle snake')
+
+
+def _matching_blocks(a, a_lo, a_hi, b, b_lo, b_hi, blocks):
+    # Appends (i, j, size) runs of equal lines in order
+    start = a_lo
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        a_lo += 1
+        b_lo += 1
+    if a_lo > start:
+        blocks.append((start, b_lo - (a_lo - start), a_lo - start))
+    end = a_hi
+    while a_hi > a_lo and b_hi > b_lo and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+    suffix = (a_hi, b_hi, end - a_hi) if end > a_hi else None
+
+    if a_lo < a_hi and b_lo < b_hi:
+        x, y, u, v, length = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        if length > 1:
+            _matching_blocks(a, a_lo, x, b, b_lo, y, blocks)
+            if u > x:
+                blocks.append((x, y, u - x))
+            _matching_blocks(a, u, a_hi, b, v, b_hi, blocks)
+    if suffix is not None:
+        blocks.append(suffix)
+
+
+def diff_lines(old_lines, new_lines):
+    # difflib-style opcodes: (tag, i1, i2, j1, j2)
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old_lines]
+    b = [ids.setdefault(line, len(ids)) for line in new_lines]
+    blocks = []
+    _matching_blocks(a, 0, len(a), b, 0, len(b), blocks)
+    blocks.append((len(a), len(b), 0))
+
+    opcodes = []
+    i = j = 0
+    for block_i, block_j, size in blocks:
+        if i < block_i and j < block_j:
+            opcodes.append(('replace', i, block_i, j, block_j))
+        elif i < block_i:
+            opcodes.append(('delete', i, block_i, j, j))
+        elif j < block_j:
+            opcodes.append(('insert', i, i, j, block_j))
+        if size:
+            opcodes.append(('equal', block_i, block_i + size, block_j, block_j + size))
+        i, j = block_i + size, block_j + size
+    return opcodes
+
+
+def hunks(old_lines, new_lines, opcodes, context=3):
+    # Unified-diff style hunks with `context` unchanged lines around each
+    # change (grouped as difflib.SequenceMatcher.get_grouped_opcodes does);
+    # line numbers are 1-based
+    codes = list(opcodes)
+    if codes and codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if codes and codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+    groups, group = [], []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * context:
+            group.append((tag, i1, i1 + context, j1, j1 + context))
+            groups.append(group)
+            group = []
+            i1, j1 = i2 - context, j2 - context
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+
+    result = []
+    for group in groups:
+        lines = []
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines += [' ' + line for line in old_lines[i1:i2]]
+                continue
+            lines += ['-' + line for line in old_lines[i1:i2]]
+            lines += ['+' + line for line in new_lines[j1:j2]]
+        result.append({
+            'old_start': group[0][1] + 1,
+            'old_lines': group[-1][2] - group[0][1],
+            'new_start': group[0][3] + 1,
+            'new_lines': group[-1][4] - group[0][3],
+            'lines': lines
+        })
+    return result
+
+
+_cache = None  # lru_cache around _compare, see compare_versions
+
+
+def compare_versions(document_id, from_id, to_id):
+    # Version contents never change once written, so results are memoized per
+    # version pair, up to EDITOR_DIFF_CACHE_SIZE of them. The cache is built on
+    # first use and again whenever that setting changes. The document id is
+    # part of the key because row ids can be reused after a delete. The
+    # returned dict is shared; do not mutate it.
+    global _cache
+    size = getattr(settings, 'EDITOR_DIFF_CACHE_SIZE', 128)
+    if _cache is None or _cache.cache_info().maxsize != size:
+        _cache = lru_cache(maxsize=size)(_compare)
+    return _cache(document_id, from_id, to_id)
+
+
+def cache_clear():
+    if _cache is not None:
+        _cache.cache_clear()
+
+
+compare_versions.cache_clear = cache_clear
+
+
+def _compare(document_id, from_id, to_id):
+    versions = {
+        version.id: version
+        for version in DocumentVersion.objects.filter(document_id=document_id, id__in=[from_id, to_id])
+    }
+    old_lines = version_content(versions[from_id]).splitlines()
+    new_lines = version_content(versions[to_id]).splitlines()
+    opcodes = diff_lines(old_lines, new_lines)
+    return {
+        'hunks': hunks(old_lines, new_lines, opcodes),
+        'added': sum(j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag != 'equal'),
+        'removed': sum(i2 - i1 for tag, i1, i2, j1, j2 in opcodes if tag != 'equal')
+    }
@@ -0,0 +1,116 @@
+# Full-text search over document contents. On SQLite a trigram FTS5 table
+# holds each document's title and content, so any substring of three or more
+# characters (identifiers, operators, paths) can be looked up. FTS5 rows need
+# integer ids, which editor_documentsearch_docs assigns per document. The index
+# is updated from the save path: Document post_save/post_delete (editor.signals)
+# and the write-behind flush. Other databases fall back to icontains.
+import uuid
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Document
+
+SEARCH_TABLE = 'editor_documentsearch'
+IDS_TABLE = 'editor_documentsearch_docs'
+MIN_QUERY_LENGTH = 3
+SNIPPET_LINES = 3
+SNIPPET_WIDTH = 200
+
+
+def enabled():
+    return connection.vendor == 'sqlite'
+
+
+def _key(document_id):
+    # Document ids are stored as 32 hex digits on SQLite
+    return uuid.UUID(str(document_id)).hex
+
+
+def index_document(document_id):
+    # Re-indexes one document from its current row
+    if not enabled():
+        return
+    key = _key(document_id)
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT OR IGNORE INTO {IDS_TABLE} (document_id) VALUES (%s)', [key])
+        cursor.execute(f'SELECT id FROM {IDS_TABLE} WHERE document_id = %s', [key])
+        rowid = cursor.fetchone()[0]
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [rowid])
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, content) '
+            f'SELECT %s, title, content FROM editor_document WHERE id = %s',
+            [rowid, key]
+        )
+
+
+def unindex_document(document_id):
+    if not enabled():
+        return
+    key = _key(document_id)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid = (SELECT id FROM {IDS_TABLE} WHERE document_id = %s)', [key]
+        )
+        cursor.execute(f'DELETE FROM {IDS_TABLE} WHERE document_id = %s', [key])
+
+
+def rebuild():
+    # Only needed for documents written around the ORM, e.g. bulk_create
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+        cursor.execute(f'INSERT OR IGNORE INTO {IDS_TABLE} (document_id) SELECT id FROM editor_document')
+        cursor.execute(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, title, content) SELECT ids.id, d.title, d.content '
+            f'FROM editor_document d JOIN {IDS_TABLE} ids ON ids.document_id = d.id'
+        )
+
+
+def _matching_ids(user, query, limit):
+    # Matches across the whole index, then keeps the documents the user can
+    # open. Rare terms have short posting lists, and common ones reach the
+    # limit after a few visible hits.
+    phrase = '"' + query.replace('"', '""') + '"'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT ids.document_id FROM {SEARCH_TABLE} '
+            f'JOIN {IDS_TABLE} AS ids ON ids.id = {SEARCH_TABLE}.rowid '
+            f'WHERE {SEARCH_TABLE} MATCH %s AND ids.document_id IN ('
+            f'  SELECT id FROM editor_document WHERE created_by_id = %s'
+            f'  UNION SELECT document_id FROM editor_documentcollaborator WHERE user_id = %s'
+            f') LIMIT %s',
+            [phrase, user.id, user.id, limit]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def snippets(content, query):
+    # (line number, text) of the first few lines containing query
+    needle, found = query.lower(), []
+    for number, line in enumerate(content.splitlines(), 1):
+        if needle in line.lower():
+            found.append((number, line.strip()[:SNIPPET_WIDTH]))
+            if len(found) == SNIPPET_LINES:
+                break
+    return found
+
+
+def search_documents(user, query, limit=20):
+    # [(document, [(line, text), ...])] for documents the user owns or
+    # collaborates on; title-only matches come back without snippets
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+    documents = Document.objects.only('id', 'title', 'language', 'content')
+    if enabled():
+        ids = _matching_ids(user, query, limit)
+        by_id = {document.id.hex: document for document in documents.filter(id__in=ids)}
+        matches = [by_id[key] for key in ids if key in by_id]
+    else:
+        matches = list(
+            documents.filter(Q(created_by=user) | Q(collaborators__user=user))
+            .filter(Q(content__icontains=query) | Q(title__icontains=query))
+            .distinct()[:limit]
+        )
+    return [(document, snippets(document.content, query)) for document in matches]
@@ -0,0 +1,96 @@
+# Document history is an append-only log of committed operations
+# (DocumentOperation) plus checkpoints (DocumentVersion rows with a revision,
+# stored as described in editor.versions). Any revision is rebuilt from the nearest checkpoint at or before
+# it and the operations that follow, and since the write-behind flusher writes
+# a checkpoint every EDITOR_CHECKPOINT_OPS operations that replay is bounded.
+from django.db import transaction
+
+from .buffer import Rope
+from .models import DocumentOperation, DocumentVersion
+from .ot import INSERT
+from .versions import store_version, version_content
+
+CHECKPOINT_DESCRIPTION = 'Checkpoint'
+
+
+def operation_row(document_id, revision, commit):
+    operation = commit.operation
+    return DocumentOperation(
+        document_id=document_id,
+        revision=revision,
+        operation=operation.kind,
+        position=operation.position,
+        text=operation.text,
+        length=operation.length,
+        user_id=commit.user_id if type(commit.user_id) is int else None
+    )
+
+
+def replay(content, rows):
+    buffer = Rope(content)
+    for row in rows:
+        if row.operation == INSERT:
+            buffer.insert(row.position, row.text)
+        else:
+            buffer.delete(row.position, row.length)
+    return str(buffer)
+
+
+def revision_at(document_id, moment):
+    # Latest revision committed at or before moment, or None
+    return (
+        DocumentOperation.objects
+        .filter(document_id=document_id, created_at__lte=moment)
+        .order_by('-revision')
+        .values_list('revision', flat=True)
+        .first()
+    )
+
+
+def document_at(document_id, revision):
+    # Returns the document text at revision: one checkpoint read and at most
+    # EDITOR_CHECKPOINT_OPS operations replayed on top of it
+    checkpoint = (
+        DocumentVersion.objects
+        .filter(document_id=document_id, revision__lte=revision)
+        .order_by('-revision')
+        .first()
+    )
+    if checkpoint is None:
+        raise LookupError(f'no checkpoint at or before revision {revision}')
+    rows = list(
+        DocumentOperation.objects
+        .filter(document_id=document_id, revision__gt=checkpoint.revision, revision__lte=revision)
+        .order_by('revision')
+    )
+    if len(rows) != revision - checkpoint.revision:
+        # Compacted away, or lost when a room outran its ring buffer
+        raise LookupError(f'revision {revision} is not in the operation log')
+    return replay(version_content(checkpoint), rows)
+
+
+def compact(document_id, before):
+    # Folds operations older than `before` into a checkpoint at the newest of
+    # them and deletes them. Revisions before that point stay reachable at
+    # checkpoint granularity. Returns the number of operations removed.
+    boundary = revision_at(document_id, before)
+    if boundary is None:
+        return 0
+    with transaction.atomic():
+        if not DocumentVersion.objects.filter(document_id=document_id, revision=boundary).exists():
+            last = DocumentOperation.objects.filter(document_id=document_id, revision=boundary).first()
+            try:
+                content = document_at(document_id, boundary)
+            except LookupError:
+                return 0
+            store_version(
+                document_id,
+                content,
+                revision=boundary,
+                created_by_id=last.user_id or last.document.created_by_id,
+                change_description=CHECKPOINT_DESCRIPTION
+            )
+        deleted, _ = DocumentOperation.objects.filter(
+            document_id=document_id, revision__lte=boundary
+        ).delete()
+    return deleted
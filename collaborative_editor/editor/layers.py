@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import random
+import string
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+def build_layer(config):
+    if isinstance(config, BaseChannelLayer):
+        return config
+    return import_string(config['BACKEND'])(**config.get('CONFIG', {}))
+
+
+def relay_of(channel):
+    # 'hybrid.x!abc.def' -> 'hybrid.x!abc', the relay of the process owning it
+    head, bang, tail = channel.partition('!')
+    if not bang:
+        return None
+    return head + bang + tail.split('.', 1)[0]
+
+
+class HybridChannelLayer(InMemoryChannelLayer):
+    # Channel layer for workers where most groups live entirely inside one
+    # process. Channels created here, and their group memberships, are kept
+    # in memory by the base class and served without leaving the process.
+    # The backend layer (Redis in production) only carries messages for
+    # members in other processes. Each process receives on one backend
+    # channel, its relay. Processes announce which groups they have members
+    # in, so a group_send only forwards to the relays that need it. Until the
+    # other processes have answered (`settle` seconds after joining a group),
+    # sends to that group go through the backend group as well.
+
+    settle = 1.0
+    # The base class sweeps every channel and group on each receive and
+    # group_send, a cost that grows with every connection in the process.
+    # Here that sweep runs at most this often, and sends only expire the
+    # memberships of the group they go to.
+    cleanup_interval = 1.0
+
+    def __init__(self, backend=None, **kwargs):
+        super().__init__(**kwargs)
+        self._cleaned = time.monotonic()
+        self.backend = build_layer(backend or {'BACKEND': 'channels.layers.InMemoryChannelLayer'})
+        self.relay = None
+        self.peers = {}  # group -> relays of other processes with members in it
+        self.joined = {}  # group -> when our first member joined
+        self._relay_task = None
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self._cleaned >= self.cleanup_interval:
+            self._cleaned = now
+            super()._clean_expired()
+
+    def _expire_group(self, group):
+        members = self.groups.get(group)
+        if members:
+            timeout = int(time.time()) - self.group_expiry
+            for channel, joined in list(members.items()):
+                if joined and joined < timeout:
+                    del members[channel]
+
+    async def _ensure_relay(self):
+        if self.relay is None:
+            self.relay = await self.backend.new_channel('hybrid')
+        if self._relay_task is None or self._relay_task.done():
+            self._relay_task = asyncio.get_running_loop().create_task(self._read_relay())
+
+    def is_local(self, channel):
+        return self.relay is not None and channel.startswith(self.relay + '.')
+
+    async def new_channel(self, prefix='specific.'):
+        await self._ensure_relay()
+        return f'{self.relay}.' + ''.join(random.choice(string.ascii_letters) for _ in range(12))
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            await super().send(channel, message)
+            return
+        relay = relay_of(channel)
+        if relay is None or relay == channel:
+            await self.backend.send(channel, message)
+        else:
+            await self.backend.send(relay, {'type': 'hybrid.send', 'channel': channel, 'message': message})
+
+    async def receive(self, channel):
+        if self.is_local(channel):
+            return await super().receive(channel)
+        return await self.backend.receive(channel)
+
+    async def group_add(self, group, channel):
+        if not self.is_local(channel):
+            await self.backend.group_add(group, channel)
+            return
+        self._expire_group(group)
+        first = not self.groups.get(group)
+        await super().group_add(group, channel)
+        # Adding again renews the relay's backend membership like any other
+        await self.backend.group_add(group, self.relay)
+        if first:
+            self.joined[group] = time.monotonic()
+            # Ask the processes already in the group to introduce themselves
+            await self.backend.group_send(group, {'type': 'hybrid.join', 'group': group, 'relay': self.relay})
+
+    async def group_discard(self, group, channel):
+        if not self.is_local(channel):
+            await self.backend.group_discard(group, channel)
+            return
+        await super().group_discard(group, channel)
+        if group not in self.groups and self.relay is not None:
+            await self.backend.group_discard(group, self.relay)
+            self.joined.pop(group, None)
+            for peer in self.peers.pop(group, ()):
+                await self._forward(peer, {'type': 'hybrid.leave', 'group': group, 'relay': self.relay})
+
+    async def group_send(self, group, message):
+        await self.group_send_except(group, message, None)
+
+    async def group_send_except(self, group, message, exclude):
+        self._clean_expired()
+        self._expire_group(group)
+        await self._deliver(group, message, exclude)
+        envelope = {
+            'type': 'hybrid.group', 'group': group, 'message': message,
+            'exclude': exclude, 'origin': self.relay
+        }
+        if self.groups.get(group) and time.monotonic() - self.joined.get(group, 0) >= self.settle:
+            peers = self.peers.get(group, ())
+            if peers:
+                await asyncio.gather(*(self._forward(peer, envelope) for peer in peers))
+        else:
+            # We do not know (yet) who else is a member; let the backend fan out
+            await self.backend.group_send(group, envelope)
+
+    async def _deliver(self, group, message, exclude=None):
+        for channel in list(self.groups.get(group, ())):
+            if channel != exclude:
+                try:
+                    await super().send(channel, message)
+                except ChannelFull:
+                    pass
+
+    async def _forward(self, relay, message):
+        try:
+            await self.backend.send(relay, message)
+        except ChannelFull:
+            pass
+
+    async def _read_relay(self):
+        while True:
+            message = await self.backend.receive(self.relay)
+            try:
+                await self._handle_relayed(message)
+            except Exception:
+                logger.exception('Failed to handle relayed message')
+
+    async def _handle_relayed(self, message):
+        kind = message.get('type')
+        if kind == 'hybrid.send':
+            try:
+                await super().send(message['channel'], message['message'])
+            except ChannelFull:
+                pass
+        elif kind == 'hybrid.group':
+            if message.get('origin') == self.relay:
+                return
+            await self._deliver(message['group'], message['message'], message.get('exclude'))
+            return
+        group, relay = message.get('group'), message.get('relay')
+        if relay == self.relay:
+            return
+        if kind == 'hybrid.join' and group in self.groups:
+            self.peers.setdefault(group, set()).add(relay)
+            await self._forward(relay, {'type': 'hybrid.here', 'group': group, 'relay': self.relay})
+        elif kind == 'hybrid.here' and group in self.groups:
+            self.peers.setdefault(group, set()).add(relay)
+        elif kind == 'hybrid.leave':
+            self.peers.get(group, set()).discard(relay)
+
+    async def flush(self):
+        await super().flush()
+        self.peers = {}
+        self.joined = {}
+        if hasattr(self.backend, 'flush'):
+            await self.backend.flush()
+
+    async def close(self):
+        if self._relay_task is not None:
+            self._relay_task.cancel()
+        await self.backend.close()
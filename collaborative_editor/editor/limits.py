@@ -0,0 +1,92 @@
+import time
+
+from django.conf import settings
+
+from .ot import INSERT, InvalidOperation, Operation, transform
+
+# Close codes for connections turned away
+ROOM_FULL = 4008
+FRAME_TOO_LARGE = 1009
+
+
+def edit_rate():
+    return getattr(settings, 'EDITOR_EDIT_RATE', 20)
+
+
+def room_edit_rate():
+    return getattr(settings, 'EDITOR_ROOM_EDIT_RATE', 200)
+
+
+def cursor_input_rate():
+    return getattr(settings, 'EDITOR_CURSOR_INPUT_RATE', 30)
+
+
+def room_cursor_input_rate():
+    return getattr(settings, 'EDITOR_ROOM_CURSOR_INPUT_RATE', 300)
+
+
+def max_frame_bytes():
+    return getattr(settings, 'EDITOR_MAX_FRAME_BYTES', 512 * 1024)
+
+
+def max_room_members():
+    return getattr(settings, 'EDITOR_MAX_ROOM_MEMBERS', 100)
+
+
+class TokenBucket:
+    # Allows `rate` events per second on average and bursts of up to two
+    # seconds' worth. Refilled lazily, so an idle bucket costs nothing.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else 2 * rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def peek(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= 1
+
+    def take(self, now=None):
+        if not self.peek(now):
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        # Seconds until the next token
+        return max(1 - self.tokens, 0) / self.rate if self.rate else float('inf')
+
+
+def merge_edits(first, second):
+    # Folds `second` into `first` (both text_change data from one client,
+    # made against the same revision) when together they are a single insert
+    # or delete. The room rebases `second` over `first` like any commit since
+    # that revision (see Room.submit), so the merge must do the same. Returns
+    # the merged data or None.
+    if first.get('revision') != second.get('revision'):
+        return None
+    try:
+        a, b = Operation.from_message(first), Operation.from_message(second)
+    except InvalidOperation:
+        return None
+    if a.kind != b.kind:
+        return None
+    _, b = transform(a, b)
+    if a.kind == INSERT:
+        if b.position != a.position + a.length:
+            return None
+        merged = Operation.insert(a.position, a.text + b.text)
+    elif b.position == a.position:
+        # Forward delete
+        merged = Operation.delete(a.position, a.length + b.length)
+    elif b.position + b.length == a.position:
+        # Backspace
+        merged = Operation.delete(b.position, a.length + b.length)
+    else:
+        return None
+    return {**second, **merged.to_message()}
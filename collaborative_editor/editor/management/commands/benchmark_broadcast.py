@@ -0,0 +1,73 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from editor.broadcast import fan_out, orjson
+
+ROOM_SIZES = [1, 10, 50, 200]
+
+FRAME = {
+    'type': 'text_change',
+    'user_id': 42,
+    'revision': 1234,
+    'operation': 'insert',
+    'position': 18231,
+    'text': 'x',
+    'length': 1,
+}
+
+
+async def per_member_encode(layer, group, channels, sender):
+    # Previous behaviour: the raw event goes to everyone, each member encodes
+    # it and the sender throws its own copy away
+    await layer.group_send(group, {'type': 'broadcast_text_change', 'sender': sender, **FRAME})
+    for channel in channels:
+        event = await layer.receive(channel)
+        if event['sender'] != channel:
+            json.dumps({key: value for key, value in event.items() if key != 'sender'})
+
+
+async def encode_once(layer, group, channels, sender):
+    await fan_out(layer, group, FRAME, exclude=sender)
+    for channel in channels:
+        if channel != sender:
+            (await layer.receive(channel))['text']
+
+
+async def measure(strategy, size, rounds):
+    layer = InMemoryChannelLayer(capacity=rounds + 10)
+    channels = [await layer.new_channel() for _ in range(size)]
+    for channel in channels:
+        await layer.group_add('editor_bench', channel)
+    start = time.process_time()
+    for _ in range(rounds):
+        await strategy(layer, 'editor_bench', channels, channels[0])
+    return (time.process_time() - start) / rounds
+
+
+class Command(BaseCommand):
+    help = 'CPU cost per broadcast versus room size for per-member and serialize-once fan-out'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=200)
+
+    def handle(self, *args, **options):
+        encoders = {'json': 'json.dumps'}
+        if orjson is not None:
+            encoders['orjson'] = 'editor.broadcast.orjson_dumps'
+
+        header = f'{"members":>8} {"per-member":>12}'
+        header += ''.join(f' {"once/" + name:>12}' for name in encoders)
+        self.stdout.write(header)
+        for size in ROOM_SIZES:
+            row = f'{size:>8} '
+            row += f'{asyncio.run(measure(per_member_encode, size, options["rounds"])) * 1e6:>10.1f}us'
+            for path in encoders.values():
+                with override_settings(EDITOR_JSON_ENCODER=path):
+                    cost = asyncio.run(measure(encode_once, size, options['rounds']))
+                row += f' {cost * 1e6:>10.1f}us'
+            self.stdout.write(row)
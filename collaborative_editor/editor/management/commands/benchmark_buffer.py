@@ -0,0 +1,71 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from editor.buffer import Rope
+
+SIZES = {'10KB': 10_000, '1MB': 1_000_000, '10MB': 10_000_000}
+
+
+def sample_text(size, rng):
+    words = ['def', 'return', 'self', 'value', 'for', 'in', 'range', 'if', 'else', '(x)', '=', '+']
+    lines, total = [], 0
+    while total < size:
+        line = '    ' + ' '.join(rng.choice(words) for _ in range(rng.randint(3, 10)))
+        lines.append(line)
+        total += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def run_ops(ops, insert, delete, line_of):
+    start = time.perf_counter()
+    for kind, position in ops:
+        if kind == 'insert':
+            insert(position, 'x')
+        elif kind == 'delete':
+            delete(position, 1)
+        else:
+            line_of(position)
+    return (time.perf_counter() - start) / len(ops)
+
+
+class Command(BaseCommand):
+    help = 'Compare the rope document buffer against naive string slicing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ops', type=int, default=500, help='Edits per document size')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f'{"size":>6} {"str edit":>12} {"rope edit":>12} {"str line":>12} {"rope line":>12}')
+        for label, size in SIZES.items():
+            text = sample_text(size, rng)
+            ops = []
+            for _ in range(options['ops']):
+                ops.append((rng.choice(['insert', 'delete']), rng.randrange(size - options['ops'])))
+            lookups = [('line', rng.randrange(size - options['ops'])) for _ in range(options['ops'])]
+
+            state = {'text': text}
+
+            def str_insert(position, value):
+                state['text'] = state['text'][:position] + value + state['text'][position:]
+
+            def str_delete(position, length):
+                state['text'] = state['text'][:position] + state['text'][position + length:]
+
+            def str_line_of(position):
+                return state['text'].count('\n', 0, position)
+
+            rope = Rope(text)
+            str_edit = run_ops(ops, str_insert, str_delete, str_line_of)
+            rope_edit = run_ops(ops, rope.insert, rope.delete, rope.line_of)
+            str_line = run_ops(lookups, str_insert, str_delete, str_line_of)
+            rope_line = run_ops(lookups, rope.insert, rope.delete, rope.line_of)
+            assert str(rope) == state['text']
+
+            self.stdout.write(
+                f'{label:>6} {str_edit * 1e6:>10.1f}us {rope_edit * 1e6:>10.1f}us '
+                f'{str_line * 1e6:>10.1f}us {rope_line * 1e6:>10.1f}us'
+            )
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from editor.layers import HybridChannelLayer
+
+WORKER_COUNTS = [1, 2, 8]
+UNRELATED_GROUPS = [0, 1000, 10000]
+
+MESSAGE = {'type': 'send.frame', 'text': json.dumps({'type': 'text_change', 'revision': 1234, 'text': 'x'})}
+
+
+class SimulatedRedis(InMemoryChannelLayer):
+    # Stand-in for the Redis layer shared by all workers: every call
+    # serializes the message and costs one round trip
+    def __init__(self, rtt, **kwargs):
+        super().__init__(**kwargs)
+        self.rtt = rtt
+
+    async def _round_trip(self, message):
+        message = json.loads(json.dumps(message))
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        return message
+
+    async def send(self, channel, message):
+        await super().send(channel, await self._round_trip(message))
+
+    async def group_send(self, group, message):
+        await super().group_send(group, await self._round_trip(message))
+
+    async def receive(self, channel):
+        message = await super().receive(channel)
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        return message
+
+
+async def measure(mode, workers, placement, members, rounds, rtt):
+    backend = SimulatedRedis(rtt, capacity=rounds * 2 + 100)
+    if mode == 'redis':
+        layers = [backend] * workers
+    else:
+        layers = [HybridChannelLayer(backend=backend, capacity=rounds * 2 + 100) for _ in range(workers)]
+
+    room = []
+    for index in range(members):
+        layer = layers[index % workers if placement == 'spread' else 0]
+        channel = await layer.new_channel()
+        await layer.group_add('editor_bench', channel)
+        room.append((layer, channel))
+    # Let the workers finish introducing themselves to each other
+    await asyncio.sleep(HybridChannelLayer.settle if mode == 'hybrid' else 0)
+
+    sender_layer, sender = room[0]
+    receivers = room[1:]
+
+    async def drain(count):
+        await asyncio.gather(*(
+            layer.receive(channel) for layer, channel in receivers for _ in range(count)
+        ))
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await sender_layer.group_send('editor_bench', MESSAGE)
+        await drain(1)
+    latency = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await sender_layer.group_send('editor_bench', MESSAGE)
+    await drain(rounds)
+    throughput = rounds * len(receivers) / (time.perf_counter() - start)
+
+    for layer in set(layers):
+        await layer.close()
+    return latency, throughput
+
+
+async def measure_unrelated(groups, rounds):
+    # Per-send cost of a two-member room while the worker also holds
+    # `groups` other rooms; it should not grow with them
+    layer = HybridChannelLayer(capacity=rounds + 100)
+    for index in range(groups):
+        await layer.group_add(f'editor_other{index}', await layer.new_channel())
+    sender, receiver = await layer.new_channel(), await layer.new_channel()
+    for channel in (sender, receiver):
+        await layer.group_add('editor_bench', channel)
+    await asyncio.sleep(HybridChannelLayer.settle)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await layer.group_send('editor_bench', MESSAGE)
+        await layer.receive(receiver)
+    elapsed = (time.perf_counter() - start) / rounds
+    await layer.close()
+    return elapsed
+
+
+class Command(BaseCommand):
+    help = 'Group send latency and throughput through Redis alone versus the hybrid in-process layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=16)
+        parser.add_argument('--rounds', type=int, default=200)
+        parser.add_argument('--rtt', type=float, default=200, help='Simulated Redis round trip in microseconds')
+
+    def handle(self, *args, **options):
+        rtt = options['rtt'] / 1e6
+        self.stdout.write(f'{"workers":>8} {"layer":>8} {"placement":>9} {"latency":>12} {"throughput":>14}')
+        for workers in WORKER_COUNTS:
+            for mode, placement in (('redis', 'spread'), ('hybrid', 'local'), ('hybrid', 'spread')):
+                if workers == 1 and placement == 'spread' and mode == 'hybrid':
+                    continue
+                latency, throughput = asyncio.run(measure(
+                    mode, workers, placement, options['members'], options['rounds'], rtt
+                ))
+                self.stdout.write(
+                    f'{workers:>8} {mode:>8} {placement:>9} {latency * 1e6:>10.1f}us {throughput:>10.0f} msg/s'
+                )
+
+        self.stdout.write(f'\n{"other groups":>12} {"send + receive":>16}')
+        for groups in UNRELATED_GROUPS:
+            elapsed = asyncio.run(measure_unrelated(groups, options['rounds']))
+            self.stdout.write(f'{groups:>12} {elapsed * 1e6:>14.1f}us')
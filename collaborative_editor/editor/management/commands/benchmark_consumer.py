@@ -0,0 +1,225 @@
+import asyncio
+import json
+import random
+import resource
+import subprocess
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from django.utils import timezone
+
+from editor.models import Document, DocumentCollaborator
+from editor.routing import websocket_urlpatterns
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class WriteCounter:
+    # Counts write statements on every connection, including the ones
+    # database_sync_to_async opens in its worker threads
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith(WRITES):
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class Client:
+    # One simulated editor: types in bursts with one edit in flight at a
+    # time, like editor.js, and moves its cursor now and then
+    def __init__(self, run, room, user, rng):
+        self.run = run
+        self.room = room
+        self.rng = rng
+        self.communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/editor/{room.id}/'
+        )
+        self.communicator.scope['user'] = user
+        self.revision = 0
+        self.length = 0
+        self.acked = None  # set when the edit in flight is acknowledged
+
+    async def receive(self):
+        while True:
+            data = json.loads(await self.communicator.receive_from(timeout=3600))
+            received = time.perf_counter()
+            for frame in data['frames'] if data['type'] == 'batch' else [data]:
+                self.run.messages += 1
+                kind = frame['type']
+                if kind == 'document_content':
+                    self.revision, self.length = frame['revision'], len(frame['content'])
+                    if self.acked is not None:
+                        self.acked.set()
+                elif kind == 'ack':
+                    self.revision = frame['revision']
+                    self.run.sent_at[self.room.id, frame['revision']] = self.pending_since
+                    self.acked.set()
+                elif kind == 'text_change':
+                    self.revision = max(self.revision, frame['revision'])
+                    self.length += frame['length'] if frame['operation'] == 'insert' else -frame['length']
+                    self.run.received.append((self.room.id, frame['revision'], received))
+
+    async def type(self, deadline, rate):
+        while time.perf_counter() < deadline:
+            # Bursts of keystrokes with the odd pause to think
+            pause = self.rng.uniform(1, 3) if self.rng.random() < 0.05 else self.rng.expovariate(rate)
+            await asyncio.sleep(pause)
+            if self.length and self.rng.random() < 0.1:
+                operation = {'operation': 'delete', 'position': self.rng.randrange(self.length), 'length': 1}
+            else:
+                operation = {
+                    'operation': 'insert', 'position': self.rng.randint(0, self.length),
+                    'text': self.rng.choice('abcdefghijklmnopqrstuvwxyz \n')
+                }
+            self.acked = asyncio.Event()
+            self.pending_since = time.perf_counter()
+            await self.communicator.send_to(text_data=json.dumps({
+                'type': 'text_change', 'revision': self.revision, **operation
+            }))
+            self.run.edits += 1
+            try:
+                await asyncio.wait_for(self.acked.wait(), 5)
+            except asyncio.TimeoutError:
+                continue
+            if operation['operation'] == 'insert':
+                self.length += 1
+            else:
+                self.length = max(self.length - 1, 0)
+
+    async def move_cursor(self, deadline, rate):
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(self.rng.expovariate(rate))
+            await self.communicator.send_to(text_data=json.dumps({
+                'type': 'cursor_position', 'position': self.rng.randint(0, self.length)
+            }))
+
+
+class LoadRun:
+    def __init__(self):
+        self.edits = 0
+        self.messages = 0
+        self.sent_at = {}  # (document_id, revision) -> when its author sent it
+        self.received = []  # (document_id, revision, when a peer got it)
+
+
+class Command(BaseCommand):
+    help = 'Load test EditorConsumer with simulated typists over the in-memory channel layer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--clients', type=int, default=5, help='Clients per room')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of typing')
+        parser.add_argument('--typing-rate', type=float, default=5.0, help='Keystrokes per second per client')
+        parser.add_argument('--cursor-rate', type=float, default=2.0, help='Cursor moves per second per client')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='benchmark_consumer.json')
+
+    def handle(self, *args, **options):
+        # Runs against a throwaway test database so nothing touches real data
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        counter = WriteCounter()
+        try:
+            rooms = self.seed(options['rooms'], options['clients'])
+            connection_created.connect(counter.install)
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS), connection.execute_wrapper(counter):
+                run, elapsed = asyncio.run(self.load(rooms, options))
+        finally:
+            connection_created.disconnect(counter.install)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        latencies = [
+            (received - run.sent_at[document_id, revision]) * 1e3
+            for document_id, revision, received in run.received
+            if (document_id, revision) in run.sent_at
+        ]
+        results = {
+            'commit': self.commit(),
+            'date': timezone.now().isoformat(),
+            'config': {key: options[key] for key in ('rooms', 'clients', 'duration', 'typing_rate', 'cursor_rate', 'seed')},
+            'edits': run.edits,
+            'edit_to_peer_ms': {
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+            },
+            'messages_per_second': run.messages / elapsed,
+            'db_writes_per_second': counter.count / elapsed,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def seed(self, room_count, client_count):
+        users = [
+            User.objects.create_user(f'loadtest{i}', f'loadtest{i}@example.com', 'pw')
+            for i in range(client_count)
+        ]
+        rooms = []
+        for i in range(room_count):
+            document = Document.objects.create(title=f'Load test {i}', content='', created_by=users[0])
+            DocumentCollaborator.objects.bulk_create([
+                DocumentCollaborator(document=document, user=user, permission_level='edit', added_by=users[0])
+                for user in users[1:]
+            ])
+            rooms.append((document, users))
+        return rooms
+
+    async def load(self, rooms, options):
+        rng = random.Random(options['seed'])
+        run = LoadRun()
+        clients = [
+            Client(run, document, user, random.Random(rng.random()))
+            for document, users in rooms for user in users
+        ]
+        for client in clients:
+            await client.communicator.connect()
+        readers = [asyncio.create_task(client.receive()) for client in clients]
+
+        start = time.perf_counter()
+        deadline = start + options['duration']
+        await asyncio.gather(*(
+            task for client in clients for task in (
+                client.type(deadline, options['typing_rate']),
+                client.move_cursor(deadline, options['cursor_rate'])
+            )
+        ))
+        # Let the last broadcasts arrive before the clock stops
+        await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - start
+
+        for reader in readers:
+            reader.cancel()
+        for client in clients:
+            await client.communicator.disconnect()
+        return run, elapsed
+
+    @staticmethod
+    def commit():
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,66 @@
+import difflib
+import random
+import time
+from functools import lru_cache
+
+from django.core.management.base import BaseCommand
+
+from editor.diff import diff_lines, hunks
+
+SIZES = (1_000, 10_000, 50_000)
+
+
+def source_lines(count, rng):
+    words = ['def', 'return', 'self', 'value', 'for', 'in', 'range', 'if', 'else', '(x)', '=', '+']
+    return [
+        '    ' * rng.randint(0, 3) + ' '.join(rng.choice(words) for _ in range(rng.randint(2, 8)))
+        for _ in range(count)
+    ]
+
+
+def edited(lines, changes, rng):
+    # Scattered line edits, inserts and deletes, like two checkpoints apart
+    lines = list(lines)
+    for _ in range(changes):
+        index = rng.randrange(len(lines))
+        kind = rng.random()
+        if kind < 0.5:
+            lines[index] = lines[index] + ' # edited'
+        elif kind < 0.75:
+            lines.insert(index, f'new_line_{rng.random()}')
+        else:
+            del lines[index]
+    return lines
+
+
+def timed(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+class Command(BaseCommand):
+    help = 'Compare difflib with the line-hashed Myers diff used by the compare API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--changes', type=float, default=0.01, help='Fraction of lines edited')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f'{"lines":>8} {"difflib":>12} {"myers":>12} {"cached":>12}')
+        for size in SIZES:
+            old = source_lines(size, rng)
+            new = edited(old, max(int(size * options['changes']), 1), rng)
+
+            naive = timed(lambda: list(difflib.unified_diff(old, new, lineterm='')))
+            fast = timed(lambda: hunks(old, new, diff_lines(old, new)))
+
+            cached_compare = lru_cache(maxsize=1)(lambda pair: hunks(old, new, diff_lines(old, new)))
+            cached_compare((1, 2))
+            cached = timed(lambda: cached_compare((1, 2)), repeat=1000)
+
+            self.stdout.write(
+                f'{size:>8} {naive * 1e3:>10.1f}ms {fast * 1e3:>10.1f}ms {cached * 1e6:>10.2f}us'
+            )
@@ -0,0 +1,83 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from editor.document_search import enabled, rebuild, search_documents
+from editor.models import Document, DocumentCollaborator
+
+WORDS = [
+    'def', 'return', 'self', 'value', 'for', 'in', 'range', 'if', 'else', 'import', 'class',
+    'config', 'request', 'response', 'items', 'index', 'total', 'result', 'user', 'path'
+]
+
+
+def source(rng, lines):
+    return '\n'.join(
+        '    ' * rng.randint(0, 2) + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+        + (f'  # ticket_{rng.randint(0, 99999)}' if rng.random() < 0.05 else '')
+        for _ in range(lines)
+    )
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+class Command(BaseCommand):
+    help = 'Seed documents in a test database and compare indexed content search with icontains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=100_000)
+        parser.add_argument('--visible', type=int, default=1_000, help='Documents the searching user can open')
+        parser.add_argument('--lines', type=int, default=40)
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not enabled():
+            raise CommandError('The document search index needs SQLite')
+        rng = random.Random(options['seed'])
+        # Seeded into a throwaway test database so the live one is never
+        # locked or touched
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            start = time.perf_counter()
+            user = User.objects.create_user('benchmark_searcher')
+            others = User.objects.bulk_create([User(username=f'benchmark_{i}') for i in range(100)])
+            visible = options['visible']
+            documents = []
+            for i in range(options['documents']):
+                owner = user if i < visible // 2 else rng.choice(others)
+                documents.append(Document(title=f'file_{i}.py', content=source(rng, options['lines']), created_by=owner))
+                if len(documents) == 5_000:
+                    Document.objects.bulk_create(documents)
+                    documents = []
+            Document.objects.bulk_create(documents)
+            shared = Document.objects.exclude(created_by=user).values_list('id', flat=True)[:visible - visible // 2]
+            DocumentCollaborator.objects.bulk_create([
+                DocumentCollaborator(document_id=document_id, user=user, added_by=others[0]) for document_id in shared
+            ])
+            rebuild()
+            self.stdout.write(
+                f'Seeded and indexed {options["documents"]} documents in {time.perf_counter() - start:.1f}s'
+            )
+
+            self.stdout.write(f'{"query":>16} {"icontains":>12} {"index":>12} {"hits":>6}')
+            for query in ['config', 'request.items', 'ticket_4242', 'not_in_any_file']:
+                naive = timed(lambda: list(
+                    Document.objects.filter(Q(created_by=user) | Q(collaborators__user=user))
+                    .filter(content__icontains=query).distinct()[:20]
+                ), options['repeat'])
+                indexed = timed(lambda: search_documents(user, query), options['repeat'])
+                hits = len(search_documents(user, query))
+                self.stdout.write(f'{query:>16} {naive * 1e3:>10.2f}ms {indexed * 1e3:>10.2f}ms {hits:>6}')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
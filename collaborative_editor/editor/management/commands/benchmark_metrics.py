@@ -0,0 +1,127 @@
+import asyncio
+import json
+import statistics
+import time
+import timeit
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from editor import metrics
+from editor.models import Document, DocumentCollaborator
+from editor.routing import websocket_urlpatterns
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# Admission control (editor.limits) would otherwise set the pace
+UNLIMITED = {
+    'EDITOR_EDIT_RATE': 10 ** 9,
+    'EDITOR_ROOM_EDIT_RATE': 10 ** 9,
+    'EDITOR_CURSOR_INPUT_RATE': 10 ** 9,
+    'EDITOR_ROOM_CURSOR_INPUT_RATE': 10 ** 9,
+}
+
+
+async def receive_frames(communicator):
+    data = json.loads(await communicator.receive_from(timeout=10))
+    return data['frames'] if data['type'] == 'batch' else [data]
+
+
+class Command(BaseCommand):
+    help = 'Measure what editor.metrics costs per recorded sample and per realtime message'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500, help='Edits per round')
+        parser.add_argument('--rounds', type=int, default=5, help='Rounds per mode, alternating')
+
+    def handle(self, *args, **options):
+        was_enabled = metrics.registry.enabled
+        metrics.registry.enabled = True
+        counter = metrics.Counter('benchmark_counter', 'Benchmark only', ('label',))
+        histogram = metrics.Histogram('benchmark_histogram', 'Benchmark only', ('label',))
+        number = 200000
+        inc = min(timeit.repeat(lambda: counter.inc(('a',)), number=number, repeat=5)) / number
+        observe = min(timeit.repeat(lambda: histogram.observe(0.003, ('a',)), number=number, repeat=5)) / number
+        metrics.registry.metrics = [m for m in metrics.registry.metrics if m not in (counter, histogram)]
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # No send interval, so the round trip is CPU time rather than the outbox tick
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, EDITOR_SEND_INTERVAL=0, **UNLIMITED):
+                document = self.seed()
+                timings, samples = asyncio.run(self.measure(document, options['messages'], options['rounds']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            metrics.registry.enabled = was_enabled
+
+        on = statistics.median(timings[True])
+        off = statistics.median(timings[False])
+        # The end-to-end difference is within run-to-run noise; samples per
+        # message times the cost of one sample is the steadier figure
+        self.stdout.write(json.dumps({
+            'counter_inc_ns': round(inc * 1e9),
+            'histogram_observe_ns': round(observe * 1e9),
+            'samples_per_message': round(samples, 1),
+            'estimated_cost_per_message_us': round(samples * max(inc, observe) * 1e6, 2),
+            'edit_round_trip_us': {'metrics_on': round(on * 1e6, 1), 'metrics_off': round(off * 1e6, 1)},
+            'overhead_per_message_us': round((on - off) * 1e6, 1),
+            'overhead_percent': round((on - off) / off * 100, 2),
+        }, indent=2))
+
+    def seed(self):
+        owner = User.objects.create_user('bench-owner', password='pw')
+        peer = User.objects.create_user('bench-peer', password='pw')
+        document = Document.objects.create(title='Benchmark', content='', created_by=owner)
+        DocumentCollaborator.objects.create(document=document, user=peer, permission_level='edit', added_by=owner)
+        self.users = (owner, peer)
+        return document
+
+    async def measure(self, document, messages, rounds):
+        # An author typing with a peer watching; an edit is timed from
+        # sending it to its ack, which covers receive, the room, the fan-out
+        # and the outbox on both ends
+        clients = []
+        for user in self.users:
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/editor/{document.id}/')
+            communicator.scope['user'] = user
+            await communicator.connect()
+            clients.append(communicator)
+        author, peer = clients
+        revision = 0
+        while True:
+            frames = await receive_frames(author)
+            if any(frame['type'] == 'presence' for frame in frames):
+                break
+
+        metrics.registry.clear()
+        timings = {True: [], False: []}
+        for round_ in range(rounds * 2):
+            enabled = round_ % 2 == 0
+            metrics.registry.enabled = enabled
+            started = time.perf_counter()
+            for _ in range(messages):
+                await author.send_to(text_data=json.dumps({
+                    'type': 'text_change', 'operation': 'insert', 'position': revision,
+                    'text': 'x', 'revision': revision
+                }))
+                while not any(frame['type'] == 'ack' for frame in await receive_frames(author)):
+                    pass
+                revision += 1
+            timings[enabled].append((time.perf_counter() - started) / messages)
+            # Keep the peer's queue from backing up into a resync
+            while not await peer.receive_nothing(timeout=0.05):
+                await peer.receive_from()
+
+        # Off rounds record nothing, so this is what the on rounds recorded
+        samples = sum(
+            sum(value[0]) if isinstance(metric, metrics.Histogram) else abs(value)
+            for metric in metrics.registry.metrics for value in metric.values.values()
+        )
+        for communicator in clients:
+            await communicator.disconnect()
+        return timings, samples / (messages * rounds)
@@ -0,0 +1,69 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from editor.protocol import decode_binary, encode_binary
+
+
+def typing_session(keystrokes, rng):
+    # Frames seen by one peer while someone types into a ~2000 line file: the
+    # typist's text_change and ack, the rebroadcast and the coalesced cursors
+    position, revision = rng.randint(20_000, 80_000), rng.randint(1_000, 50_000)
+    frames = []
+    for seq in range(1, keystrokes + 1):
+        if rng.random() < 0.1:
+            operation = {'operation': 'delete', 'position': position - 1, 'text': '', 'length': 1}
+            position -= 1
+        else:
+            char = rng.choice('abcdefghijklmnopqrstuvwxyz    ()=:.\n')
+            operation = {'operation': 'insert', 'position': position, 'text': char, 'length': 1}
+            position += 1
+        frames.append({'type': 'text_change', 'revision': revision, 'seq': seq, **operation})
+        revision += 1
+        frames.append({'type': 'ack', 'revision': revision})
+        frames.append({'type': 'text_change', 'user_id': 42, 'revision': revision, 'seq': None, **operation})
+        if seq % 3 == 0:
+            frames.append({
+                'type': 'cursors',
+                'cursors': [{'user_id': 42, 'position': position, 'selection': None}],
+                'offscreen': []
+            })
+    return frames
+
+
+def timed(function, items):
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return results, (time.perf_counter() - start) / len(items)
+
+
+class Command(BaseCommand):
+    help = 'Compare JSON and binary frame encodings on a simulated typing session'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keystrokes', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        frames = typing_session(options['keystrokes'], random.Random(options['seed']))
+        keystrokes = options['keystrokes']
+
+        text, json_encode = timed(json.dumps, frames)
+        _, json_decode = timed(json.loads, text)
+        binary, binary_encode = timed(encode_binary, frames)
+        _, binary_decode = timed(decode_binary, binary)
+
+        json_bytes = sum(len(frame.encode()) for frame in text)
+        binary_bytes = sum(len(frame) for frame in binary)
+        self.stdout.write(f'{len(frames)} frames for {keystrokes} keystrokes')
+        self.stdout.write(f'{"":8} {"bytes/op":>10} {"encode":>10} {"decode":>10}')
+        self.stdout.write(
+            f'{"json":8} {json_bytes / keystrokes:>10.1f} '
+            f'{json_encode * 1e6:>8.2f}us {json_decode * 1e6:>8.2f}us'
+        )
+        self.stdout.write(
+            f'{"binary":8} {binary_bytes / keystrokes:>10.1f} '
+            f'{binary_encode * 1e6:>8.2f}us {binary_decode * 1e6:>8.2f}us'
+        )
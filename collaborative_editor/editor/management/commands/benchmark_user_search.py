@@ -0,0 +1,64 @@
+import random
+import string
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from editor.user_search import enabled, rebuild, search_users
+
+NAMES = ['anna', 'bilge', 'carlos', 'dmitri', 'elif', 'fatima', 'george', 'hiro', 'ines', 'jamal', 'kemal', 'lena']
+DOMAINS = ['example.com', 'mail.org', 'corp.net', 'uni.edu']
+
+
+def seed(count, rng):
+    batch = []
+    for i in range(count):
+        name = rng.choice(NAMES) + ''.join(rng.choice(string.ascii_lowercase) for _ in range(4))
+        batch.append(User(username=f'{name}{i}', email=f'{name}.{i}@{rng.choice(DOMAINS)}', password='!'))
+        if len(batch) == 10_000:
+            User.objects.bulk_create(batch)
+            batch = []
+    User.objects.bulk_create(batch)
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+class Command(BaseCommand):
+    help = 'Seed a large user table in a test database and compare indexed search with icontains'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not enabled():
+            raise CommandError('The user search index needs SQLite')
+        queries = ['an', 'ke', 'bilge', 'lena12', 'mail.org', '12345', 'zzzz']
+        # Seeded into a throwaway test database so the live one is never
+        # locked or touched
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            start = time.perf_counter()
+            seed(options['users'], random.Random(options['seed']))
+            rebuild()
+            self.stdout.write(f'Seeded and indexed {options["users"]} users in {time.perf_counter() - start:.1f}s')
+
+            self.stdout.write(f'{"query":>10} {"icontains":>12} {"index":>12}')
+            for query in queries:
+                naive = timed(lambda: list(
+                    User.objects.filter(Q(username__icontains=query) | Q(email__icontains=query))[:10]
+                ), options['repeat'])
+                indexed = timed(lambda: search_users(query), options['repeat'])
+                self.stdout.write(f'{query:>10} {naive * 1e3:>10.2f}ms {indexed * 1e3:>10.2f}ms')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
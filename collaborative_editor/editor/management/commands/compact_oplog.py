@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from editor.history import compact
+from editor.models import DocumentOperation
+
+
+class Command(BaseCommand):
+    help = 'Fold old op log entries into checkpoints; run it periodically, e.g. from cron'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=float,
+            default=getattr(settings, 'EDITOR_OPLOG_RETENTION', 7 * 24 * 3600),
+            help='Age in seconds after which operations are folded'
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(seconds=options['older_than'])
+        document_ids = (
+            DocumentOperation.objects
+            .filter(created_at__lte=before)
+            .values_list('document_id', flat=True)
+            .distinct()
+        )
+        total = 0
+        for document_id in list(document_ids):
+            removed = compact(document_id, before)
+            total += removed
+            if removed:
+                self.stdout.write(f'{document_id}: folded {removed} operations')
+        self.stdout.write(self.style.SUCCESS(f'Compacted {total} operations'))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from editor.models import DocumentVersion
+from editor.versions import encode_delta, encode_full, keyframe_interval, stored_size, version_content
+
+
+class Command(BaseCommand):
+    help = 'Re-encode stored versions as compressed reverse deltas and report the space saved'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the savings without writing')
+
+    def handle(self, *args, **options):
+        interval = keyframe_interval()
+        document_ids = DocumentVersion.objects.values_list('document_id', flat=True).distinct()
+        total_before = total_after = rows = 0
+        for document_id in list(document_ids):
+            with transaction.atomic():
+                versions = list(DocumentVersion.objects.filter(document_id=document_id).order_by('id'))
+                # Decode everything before rewriting the chain
+                contents = [version_content(version) for version in versions]
+                before = sum(stored_size(version) for version in versions)
+                newer = None
+                for age, (version, content) in enumerate(zip(reversed(versions), reversed(contents))):
+                    if age % interval == 0:
+                        encode_full(version, content)
+                    else:
+                        encode_delta(version, newer, content)
+                    newer = content
+                after = sum(stored_size(version) for version in versions)
+                if not options['dry_run']:
+                    DocumentVersion.objects.bulk_update(
+                        versions, ['storage', 'content', 'data', 'compressed'], batch_size=100
+                    )
+            rows += len(versions)
+            total_before += before
+            total_after += after
+            self.stdout.write(f'{document_id}: {len(versions)} versions, {before} -> {after} bytes')
+
+        saved = total_before - total_after
+        percent = 100 * saved / total_before if total_before else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{rows} versions: {total_before} -> {total_after} bytes, saved {saved} bytes ({percent:.1f}%)'
+            + (' [dry run]' if options['dry_run'] else '')
+        ))
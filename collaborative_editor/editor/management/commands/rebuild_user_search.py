@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from editor.user_search import enabled, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user search index from auth_user, e.g. after a bulk import'
+
+    def handle(self, *args, **options):
+        if not enabled():
+            self.stdout.write('User search index is only used on SQLite; nothing to do')
+            return
+        rebuild()
+        self.stdout.write(self.style.SUCCESS('User search index rebuilt'))
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+
+from editor.models import Document, DocumentCollaborator
+from editor.routing import websocket_urlpatterns
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+# For --unlimited: admission control (editor.limits) would otherwise set the pace
+UNLIMITED = {
+    'EDITOR_EDIT_RATE': 10 ** 9,
+    'EDITOR_ROOM_EDIT_RATE': 10 ** 9,
+    'EDITOR_CURSOR_INPUT_RATE': 10 ** 9,
+    'EDITOR_ROOM_CURSOR_INPUT_RATE': 10 ** 9,
+}
+
+
+def read_trace(path):
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or not isinstance(lines[0], dict) or 'content' not in lines[0]:
+        raise CommandError(f'{path} is not an editor trace')
+    header, events, final = lines[0], [], None
+    for line in lines[1:]:
+        if isinstance(line, dict):
+            # A handed-off room repeats nothing but may end with the final state
+            final = line.get('final', final)
+        else:
+            events.append(line)
+    return header, events, final
+
+
+class Connection:
+    def __init__(self, document, user):
+        self.communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/editor/{document.id}/'
+        )
+        self.communicator.scope['user'] = user
+        self.frames = asyncio.Queue()
+        self.reader = None
+
+    async def open(self):
+        await self.communicator.connect()
+        self.reader = asyncio.create_task(self.read())
+        await self.until('document_content', 'replay')
+
+    async def read(self):
+        while True:
+            data = json.loads(await self.communicator.receive_from(timeout=3600))
+            for frame in data['frames'] if data['type'] == 'batch' else [data]:
+                await self.frames.put(frame)
+
+    async def until(self, *kinds):
+        while (await asyncio.wait_for(self.frames.get(), 10))['type'] not in kinds:
+            pass
+
+    async def send(self, frame):
+        await self.communicator.send_to(text_data=json.dumps(frame))
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = 'Replay a recorded editor session (EDITOR_TRACE_DIR) through EditorConsumer and check the result'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trace')
+        parser.add_argument(
+            '--speed', type=float, default=1.0,
+            help='1 for real time, 10 for ten times faster, 0 for as fast as possible'
+        )
+        parser.add_argument(
+            '--unlimited', action='store_true',
+            help='Lift the recorded rate limits, e.g. for load testing; the result may then differ'
+        )
+
+    def handle(self, *args, **options):
+        header, events, final = read_trace(options['trace'])
+        # The limits the session ran under, so edits are deferred and merged
+        # as they were; traces from before they were recorded use the settings
+        limits = UNLIMITED if options['unlimited'] else header.get('limits', {})
+        # Runs against a throwaway test database so nothing touches real data
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, EDITOR_TRACE_DIR=None, **limits):
+                document, users = self.seed(header, events)
+                elapsed = asyncio.run(self.replay(document, users, events, options['speed']))
+            document.refresh_from_db()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f'Replayed {len(events)} events in {elapsed:.2f}s '
+            f'({events[-1][0] / 1000 if events else 0:.2f}s recorded)'
+        )
+        if final is None:
+            self.stdout.write('The trace has no final state to compare with')
+        elif document.content != final:
+            raise CommandError(f'Final document differs: expected {len(final)} chars, got {len(document.content)}')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Final document matches ({len(final)} chars)'))
+
+    def seed(self, header, events):
+        # Recorded users become fresh users who may all edit
+        recorded = {event[3]['user'] for event in events if event[2] == 'attach'}
+        owner = User.objects.create_user('replay-owner', password='pw')
+        document = Document.objects.create(
+            title='Replay', content=header['content'], revision=header['revision'], created_by=owner
+        )
+        users = {}
+        for i, user_id in enumerate(sorted(recorded, key=str)):
+            users[user_id] = User.objects.create_user(f'replay{i}', password='pw')
+            DocumentCollaborator.objects.create(
+                document=document, user=users[user_id], permission_level='edit', added_by=owner
+            )
+        return document, users
+
+    async def replay(self, document, users, events, speed):
+        connections = {}
+        start = time.perf_counter()
+        for at, key, op, payload in events:
+            if speed:
+                delay = start + at / 1000 / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if op == 'attach':
+                connections[key] = Connection(document, users[payload['user']])
+                await connections[key].open()
+                continue
+            current = connections.get(key)
+            if current is None:
+                # Attached before the trace started
+                continue
+            if op == 'detach':
+                await connections.pop(key).close()
+            elif op == 'submit':
+                await current.send(payload)
+                # Wait for the room to take it so edits reach it in the recorded order
+                await current.until('ack', 'document_content')
+            elif op == 'cursor':
+                await current.send({'type': 'cursor_position', 'position': payload[0], 'selection': payload[1]})
+            elif op == 'viewport':
+                await current.send({'type': 'viewport', 'from_line': payload[0], 'to_line': payload[1]})
+            elif op == 'resync':
+                await current.send({'type': 'resync'})
+        for current in connections.values():
+            await current.close()
+        return time.perf_counter() - start
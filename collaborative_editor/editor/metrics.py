@@ -0,0 +1,207 @@
+# In-process counters and histograms for the realtime layer, cheap enough to
+# leave on: recording is a dict update (and a bisect for histograms) with no
+# locks or allocation beyond the first sample of a label set. They are served
+# in the Prometheus text format at /metrics/ and, with
+# EDITOR_METRICS_LOG_INTERVAL set, logged as one JSON line that often.
+# Each ASGI worker has its own numbers; Prometheus adds them up per instance.
+import asyncio
+import bisect
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.enabled = True  # EDITOR_METRICS, applied in EditorConfig.ready
+        self._task = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics if metric.values}
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.values.clear()
+
+    def remove(self, name, value):
+        # Drops the series of e.g. a closed room so labels don't pile up
+        for metric in self.metrics:
+            if name in metric.labelnames:
+                index = metric.labelnames.index(name)
+                for labels in [labels for labels in metric.values if labels[index] == value]:
+                    del metric.values[labels]
+
+    @property
+    def log_interval(self):
+        return getattr(settings, 'EDITOR_METRICS_LOG_INTERVAL', None)
+
+    def start_logging(self):
+        if not self.log_interval:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._log())
+
+    async def _log(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            logger.info('metrics %s', json.dumps(self.snapshot(), separators=(',', ':'), default=str))
+
+
+registry = Registry()
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}  # label values -> total
+        registry.register(self)
+
+    def inc(self, labels=(), amount=1):
+        if registry.enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+    def snapshot(self):
+        if not self.labelnames:
+            return self.values.get((), 0)
+        return {','.join(map(str, labels)): value for labels, value in self.values.items()}
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        if registry.enabled:
+            self.values[labels] = value
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # label values -> [[count per bucket, then +Inf], sum]
+        registry.register(self)
+
+    def observe(self, value, labels=()):
+        if not registry.enabled:
+            return
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(self.labelnames + ("le",), labels + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}'
+
+    def quantile(self, labels, fraction):
+        # Upper bound of the bucket holding the given fraction of samples
+        counts, _ = self.values[labels]
+        target, cumulative = fraction * sum(counts), 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            ','.join(map(str, labels)) or 'all': {
+                'count': sum(counts),
+                'sum': round(total, 6),
+                'p50': self.quantile(labels, 0.5),
+                'p99': self.quantile(labels, 0.99),
+            }
+            for labels, (counts, total) in self.values.items()
+        }
+
+
+connections = Gauge('editor_connections', 'Open editor websockets')
+connect_seconds = Histogram('editor_connect_seconds', 'Time from websocket connect to the attach command being handled')
+frames_received = Counter('editor_frames_received_total', 'Client frames received, by type', ('type',))
+frames_sent = Counter('editor_frames_sent_total', 'Frames written to websockets, counting each frame of a batch')
+frame_bytes = Histogram('editor_frame_bytes', 'Size of websocket payloads', ('direction',), SIZE_BUCKETS)
+room_commands = Counter('editor_room_commands_total', 'Commands handled by the owning worker, by room', ('document',))
+db_seconds = Histogram('editor_db_seconds', 'Time spent in realtime database calls', ('query',))
+group_send_seconds = Histogram('editor_group_send_seconds', 'Time to fan a frame out to a room group')
+outbox_depth = Histogram('editor_outbox_depth', 'Frames written per batch', buckets=DEPTH_BUCKETS)
+outbox_overflows = Counter('editor_outbox_overflows_total', 'Outboxes that overflowed and fell back to a snapshot')
+rooms = Gauge('editor_rooms', 'Rooms held by this worker, live or evicted but with members', ('state',))
+room_memory = Gauge('editor_room_memory_bytes', 'Approximate memory held by each live room', ('document',))
+room_evictions = Counter('editor_room_evictions_total', 'Rooms evicted from memory, by reason', ('reason',))
+limited = Counter('editor_limited_total', 'Frames held back by admission control, by action', ('action',))
+request_seconds = Histogram('editor_request_seconds', 'Time spent in editor views', ('view',))
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        if match is not None and match.func.__module__ == 'editor.views':
+            request_seconds.observe(time.perf_counter() - started, (match.url_name,))
+        return response
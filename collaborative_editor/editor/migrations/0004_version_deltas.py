@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('editor', '0003_operation_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='compressed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='storage',
+            field=models.CharField(choices=[('full', 'Full'), ('delta', 'Delta')], default='full', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='documentversion',
+            name='content',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('editor', '0004_version_deltas'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['created_by', 'updated_at'], name='editor_docu_created_6900e8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='documentcollaborator',
+            index=models.Index(fields=['user', 'document'], name='editor_docu_user_id_fb4f57_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+TABLES = {
+    'editor_usersearch': "tokenize='trigram'",
+    'editor_usersearch_prefix': "prefix='2'",
+}
+
+
+def create_tables(apps, schema_editor):
+    # FTS5 tables backing editor.user_search; SQLite only
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table, options in TABLES.items():
+        schema_editor.execute(f'CREATE VIRTUAL TABLE {table} USING fts5(username, email, {options})')
+        schema_editor.execute(
+            f'INSERT INTO {table} (rowid, username, email) SELECT id, username, email FROM auth_user'
+        )
+
+
+def drop_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table in TABLES:
+        schema_editor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('editor', '0005_document_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_tables, drop_tables),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+
+def create_tables(apps, schema_editor):
+    # Trigram FTS5 index backing editor.document_search; SQLite only
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE TABLE editor_documentsearch_docs '
+        '(id INTEGER PRIMARY KEY, document_id char(32) NOT NULL UNIQUE)'
+    )
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE editor_documentsearch USING fts5(title, content, tokenize='trigram')"
+    )
+    schema_editor.execute('INSERT INTO editor_documentsearch_docs (document_id) SELECT id FROM editor_document')
+    schema_editor.execute(
+        'INSERT INTO editor_documentsearch (rowid, title, content) '
+        'SELECT ids.id, d.title, d.content FROM editor_document d '
+        'JOIN editor_documentsearch_docs ids ON ids.document_id = d.id'
+    )
+
+
+def drop_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS editor_documentsearch')
+    schema_editor.execute('DROP TABLE IF EXISTS editor_documentsearch_docs')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('editor', '0006_user_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_tables, drop_tables),
+    ]
@@ -9,25 +9,24 @@ class Document(models.Model):
     title = models.CharField(max_length=255)
     content = models.TextField(blank=True)
     language = models.CharField(max_length=50, default='python')
+    revision = models.PositiveIntegerField(default=0)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['created_by', 'updated_at'])]
+
     def __str__(self):
         return self.title
     
     def has_permission(self, user):
-        if self.created_by == user:
-            return True
-        return self.collaborators.filter(user=user).exists()
+        return self.get_permission_level(user) is not None
     
     def get_permission_level(self, user):
-        if self.created_by == user:
-            return 'owner'
-        collab = self.collaborators.filter(user=user).first()
-        if collab:
-            return collab.permission_level
-        return None
+        # Cached per document, see editor.permissions
+        from .permissions import permission_level
+        return permission_level(self.id, user)
 
 class DocumentCollaborator(models.Model):
     PERMISSION_CHOICES = [
@@ -43,13 +42,54 @@ class DocumentCollaborator(models.Model):
 
     class Meta:
         unique_together = ('document', 'user')
+        indexes = [models.Index(fields=['user', 'document'])]
 
     def __str__(self):
         return f"{self.user.username} - {self.document.title} ({self.permission_level})"
 
 class DocumentVersion(models.Model):
+    # Only the newest version and periodic keyframes hold full text. Other
+    # rows store a reverse delta against the next newer version of the same
+    # document; read them through editor.versions.version_content().
+    STORAGE_CHOICES = [
+        ('full', 'Full'),
+        ('delta', 'Delta'),
+    ]
+
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='versions')
-    content = models.TextField()
+    content = models.TextField(blank=True)
+    # Revision the content corresponds to; empty for versions saved before the op log
+    revision = models.PositiveIntegerField(null=True, blank=True)
+    storage = models.CharField(max_length=10, choices=STORAGE_CHOICES, default='full')
+    # Compressed full text or encoded delta; content is empty when set
+    data = models.BinaryField(null=True, blank=True)
+    compressed = models.BooleanField(default=False)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
-    change_description = models.CharField(max_length=255, blank=True)
\ No newline at end of file
+    change_description = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['document', 'revision'])]
+
+class DocumentOperation(models.Model):
+    # Append-only log of committed edits; revision is the document revision
+    # the operation produced
+    OPERATION_CHOICES = [
+        ('insert', 'Insert'),
+        ('delete', 'Delete'),
+    ]
+
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='operations')
+    revision = models.PositiveIntegerField()
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    position = models.PositiveIntegerField()
+    text = models.TextField(blank=True)
+    length = models.PositiveIntegerField(default=0)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('document', 'revision')
+
+    def __str__(self):
+        return f"{self.document_id} r{self.revision} {self.operation}@{self.position}"
\ No newline at end of file
@@ -0,0 +1,114 @@
+INSERT = 'insert'
+DELETE = 'delete'
+
+
+class InvalidOperation(ValueError):
+    pass
+
+
+class Operation:
+    # A single insert or delete at a flat character offset. An insert of ''
+    # or a delete of length 0 is a no-op; transforms produce those when one
+    # edit is swallowed by a concurrent delete.
+    __slots__ = ('kind', 'position', 'text', 'length')
+
+    def __init__(self, kind, position, text='', length=0):
+        self.kind = kind
+        self.position = position
+        self.text = text if kind == INSERT else ''
+        self.length = len(text) if kind == INSERT else length
+
+    @classmethod
+    def insert(cls, position, text):
+        return cls(INSERT, position, text)
+
+    @classmethod
+    def delete(cls, position, length):
+        return cls(DELETE, position, length=length)
+
+    @classmethod
+    def from_message(cls, data):
+        kind = data.get('operation')
+        position = data.get('position')
+        text = data.get('text') or ''
+        length = data.get('length') or 0
+        if kind not in (INSERT, DELETE):
+            raise InvalidOperation(f'unknown operation {kind!r}')
+        if type(position) is not int or type(length) is not int or not isinstance(text, str):
+            raise InvalidOperation('malformed operation')
+        if position < 0 or length < 0:
+            raise InvalidOperation('negative position or length')
+        return cls(kind, position, text, length)
+
+    def to_message(self):
+        return {
+            'operation': self.kind,
+            'position': self.position,
+            'text': self.text,
+            'length': self.length,
+        }
+
+    @property
+    def is_noop(self):
+        return self.length == 0
+
+    def apply(self, content):
+        if self.kind == INSERT:
+            if self.position > len(content):
+                raise InvalidOperation('insert out of range')
+            return content[:self.position] + self.text + content[self.position:]
+        if self.position + self.length > len(content):
+            raise InvalidOperation('delete out of range')
+        return content[:self.position] + content[self.position + self.length:]
+
+    def __eq__(self, other):
+        return isinstance(other, Operation) and (
+            (self.kind, self.position, self.text, self.length)
+            == (other.kind, other.position, other.text, other.length)
+        )
+
+    def __repr__(self):
+        if self.kind == INSERT:
+            return f'Operation.insert({self.position}, {self.text!r})'
+        return f'Operation.delete({self.position}, {self.length})'
+
+
+# Returns (a', b') such that applying a then b' gives the same text as applying
+# b then a'. When both insert at the same offset a's text ends up first; the
+# server always passes committed history as a, and clients pass the incoming
+# server op as a, so everyone breaks ties the same way.
+def transform(a, b):
+    if a.kind == INSERT and b.kind == INSERT:
+        if a.position <= b.position:
+            return a, Operation.insert(b.position + a.length, b.text)
+        return Operation.insert(a.position + b.length, a.text), b
+    if a.kind == INSERT:
+        return _transform_insert_delete(a, b)
+    if b.kind == INSERT:
+        b_prime, a_prime = _transform_insert_delete(b, a)
+        return a_prime, b_prime
+    return _delete_after_delete(a, b), _delete_after_delete(b, a)
+
+
+def _transform_insert_delete(ins, dele):
+    if ins.position <= dele.position:
+        return ins, Operation.delete(dele.position + ins.length, dele.length)
+    if ins.position >= dele.position + dele.length:
+        return Operation.insert(ins.position - dele.length, ins.text), dele
+    # The insert landed inside the deleted range, so it is deleted with it
+    return (
+        Operation.insert(dele.position, ''),
+        Operation.delete(dele.position, dele.length + ins.length),
+    )
+
+
+def _delete_after_delete(op, applied):
+    def shift(offset):
+        if offset <= applied.position:
+            return offset
+        if offset <= applied.position + applied.length:
+            return applied.position
+        return offset - applied.length
+
+    start = shift(op.position)
+    return Operation.delete(start, shift(op.position + op.length) - start)
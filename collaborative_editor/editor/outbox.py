@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+from django.conf import settings
+
+from . import metrics
+from .broadcast import encode
+from .protocol import decode_binary, encode_binary
+
+PRESENCE = ('user_joined', 'user_left')
+
+
+class Outbox:
+    # Frames on their way to one websocket. The consumer queues frames as the
+    # channel layer delivers them and a single task writes whatever has
+    # queued up as one batch frame, at most once every EDITOR_SEND_INTERVAL
+    # seconds, so a client that reads slowly backs up here rather than in
+    # the channel layer. Queued cursor frames are merged into the newest one,
+    # and a presence frame replaces an older one for the same user (or an
+    # older roster). Past EDITOR_SEND_QUEUE frames the queue is dropped,
+    # deltas are ignored and the client gets a single document_content
+    # snapshot instead.
+
+    def __init__(self, send, binary, resync):
+        self.send = send
+        self.binary = binary
+        self.resync = resync  # coroutine function asking the room for a snapshot
+        self.frames = []  # [kind, key, payload]
+        self.resyncing = False
+        self._task = None
+
+    @property
+    def interval(self):
+        return getattr(settings, 'EDITOR_SEND_INTERVAL', 0.02)
+
+    @property
+    def limit(self):
+        return getattr(settings, 'EDITOR_SEND_QUEUE', 256)
+
+    def decode(self, payload):
+        return decode_binary(payload) if self.binary else json.loads(payload)
+
+    def encode(self, frame):
+        return encode_binary(frame) if self.binary else encode(frame)
+
+    async def put(self, message):
+        kind = message.get('kind')
+        if not self.binary:
+            payload = message['text']
+        elif 'bytes' in message:
+            payload = message['bytes']
+        else:
+            # Sent before this room had binary members
+            payload = encode_binary(json.loads(message['text']))
+
+        key = None
+        if kind in PRESENCE:
+            key = ('presence', self.decode(payload)['user_id'])
+        elif kind == 'presence':
+            key = ('roster',)
+        if self.resyncing:
+            # Everything but presence is covered by the snapshot on its way
+            if kind == 'document_content':
+                self.resyncing = False
+            elif key is None:
+                return
+
+        if key is not None:
+            self.frames = [frame for frame in self.frames if frame[1] != key]
+        elif kind == 'cursors':
+            for index, frame in enumerate(self.frames):
+                if frame[0] == 'cursors':
+                    del self.frames[index]
+                    payload = self.encode(self.merge_cursors(self.decode(frame[2]), self.decode(payload)))
+                    break
+        self.frames.append([kind, key, payload])
+
+        if len(self.frames) > self.limit:
+            self.frames = [frame for frame in self.frames if frame[1] is not None]
+            self.resyncing = True
+            metrics.outbox_overflows.inc()
+            await self.resync()
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+
+    @staticmethod
+    def merge_cursors(old, new):
+        # Newer positions win; a user in one list of the newer frame leaves
+        # the other list of the older one
+        cursors = {cursor['user_id']: cursor for cursor in old['cursors']}
+        offscreen = {line['user_id']: line for line in old['offscreen']}
+        for cursor in new['cursors']:
+            offscreen.pop(cursor['user_id'], None)
+            cursors[cursor['user_id']] = cursor
+        for line in new['offscreen']:
+            cursors.pop(line['user_id'], None)
+            offscreen[line['user_id']] = line
+        return {'type': 'cursors', 'cursors': list(cursors.values()), 'offscreen': list(offscreen.values())}
+
+    async def _drain(self):
+        while self.frames:
+            frames, self.frames = self.frames, []
+            metrics.outbox_depth.observe(len(frames))
+            await self.write([payload for kind, key, payload in frames])
+            await asyncio.sleep(self.interval)
+
+    async def write(self, payloads):
+        metrics.frames_sent.inc(amount=len(payloads))
+        if self.binary:
+            payload = payloads[0] if len(payloads) == 1 else encode_binary({'type': 'batch', 'frames': payloads})
+            await self.send(bytes_data=payload)
+            metrics.frame_bytes.observe(len(payload), ('out',))
+        else:
+            # Frames are already JSON, so the batch is spliced together
+            payload = payloads[0] if len(payloads) == 1 else '{"type": "batch", "frames": [' + ', '.join(payloads) + ']}'
+            await self.send(text_data=payload)
+            metrics.frame_bytes.observe(len(payload), ('out',))
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.frames = []
@@ -0,0 +1,48 @@
+# Resolves a user's access to a document from one cached {user_id: level}
+# map per document, shared by the HTTP views and the WebSocket consumer.
+# The map is dropped by the signal handlers in editor.signals whenever the
+# owner or a collaborator changes. Use a shared CACHES backend when running
+# more than one process, otherwise invalidations stay process-local.
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Document, DocumentCollaborator
+
+OWNER = 'owner'
+EDIT = 'edit'
+VIEW = 'view'
+
+
+def _cache_key(document_id):
+    return f'editor:permissions:{document_id}'
+
+
+def document_permissions(document_id):
+    # {user_id: level}; empty when the document does not exist
+    key = _cache_key(document_id)
+    levels = cache.get(key)
+    if levels is None:
+        owner_id = Document.objects.filter(id=document_id).values_list('created_by_id', flat=True).first()
+        if owner_id is None:
+            return {}
+        levels = dict(
+            DocumentCollaborator.objects.filter(document_id=document_id).values_list('user_id', 'permission_level')
+        )
+        levels[owner_id] = OWNER
+        cache.set(key, levels, getattr(settings, 'EDITOR_PERMISSION_CACHE_TIMEOUT', 300))
+    return levels
+
+
+def permission_level(document_id, user):
+    # 'owner', 'edit', 'view' or None
+    if not user.is_authenticated:
+        return None
+    return document_permissions(document_id).get(user.id)
+
+
+def can_edit(level):
+    return level in (OWNER, EDIT)
+
+
+def invalidate(document_id):
+    cache.delete(_cache_key(document_id))
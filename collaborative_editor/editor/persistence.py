@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .document_search import index_document
+from .history import CHECKPOINT_DESCRIPTION, operation_row
+from .models import Document, DocumentOperation, DocumentVersion
+from .versions import store_version
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    # Rooms are marked dirty on every edit and written back in batches, so DB
+    # writes scale with the number of active documents rather than keystrokes.
+    # Each flush also appends the operations committed since the last one to
+    # the op log and, every EDITOR_CHECKPOINT_OPS operations or
+    # EDITOR_CHECKPOINT_INTERVAL seconds, a checkpoint (see editor.history).
+
+    def __init__(self):
+        self.dirty = {}  # document_id -> [room, first_change, last_change]
+        self._task = None
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'EDITOR_FLUSH_INTERVAL', 5.0)
+
+    @property
+    def idle_flush(self):
+        return getattr(settings, 'EDITOR_IDLE_FLUSH', 1.0)
+
+    @property
+    def checkpoint_ops(self):
+        return getattr(settings, 'EDITOR_CHECKPOINT_OPS', 500)
+
+    @property
+    def checkpoint_interval(self):
+        return getattr(settings, 'EDITOR_CHECKPOINT_INTERVAL', 600)
+
+    def mark_dirty(self, room):
+        now = time.monotonic()
+        entry = self.dirty.get(room.document_id)
+        if entry is None:
+            entry = self.dirty[room.document_id] = [room, now, now]
+        else:
+            entry[0] = room
+            entry[2] = now
+        if room.revision - room.flushed_revision >= room.history.maxlen // 2:
+            # Write the log out before the ring buffer drops unflushed commits
+            entry[1] = float('-inf')
+        self._ensure_running()
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [
+            document_id for document_id, (room, first, last) in self.dirty.items()
+            if now - first >= self.flush_interval or now - last >= self.idle_flush
+        ]
+
+    async def flush(self, document_ids=None):
+        if document_ids is None:
+            document_ids = list(self.dirty)
+        # Take the snapshot synchronously; edits made while the write is in
+        # flight mark the room dirty again and go out with the next flush
+        pending = {}
+        for document_id in document_ids:
+            entry = self.dirty.pop(document_id, None)
+            if entry is not None:
+                pending[document_id] = entry
+        if not pending:
+            return 0
+
+        snapshot, rollback = {}, {}
+        for document_id, entry in pending.items():
+            room = entry[0]
+            rollback[document_id] = (room.flushed_revision, room.checkpoint_revision, room.checkpoint_at)
+            snapshot[document_id] = self.take_snapshot(room)
+        try:
+            await database_sync_to_async(self.write)(snapshot)
+        except Exception:
+            for document_id, entry in pending.items():
+                room = entry[0]
+                flushed, room.checkpoint_revision, room.checkpoint_at = rollback[document_id]
+                room.flushed_revision = min(room.flushed_revision, flushed)
+                self.dirty.setdefault(document_id, entry)
+            raise
+        return len(snapshot)
+
+    def take_snapshot(self, room):
+        # Advances the room's flush bookkeeping up front so a concurrent flush
+        # of the same room does not log the same operations again
+        now = time.monotonic()
+        start, revision = room.flushed_revision, room.revision
+        commits = room.commits_since(start)
+        if commits is None:
+            # The ring buffer overflowed between flushes; log what is left and
+            # checkpoint so the current revision stays reachable
+            start, commits = room.oldest_revision, list(room.history)
+        operations = [
+            operation_row(room.document_id, start + i, commit)
+            for i, commit in enumerate(commits, 1)
+        ]
+        checkpoint = revision != room.checkpoint_revision and (
+            room.checkpoint_revision is None
+            or start > room.flushed_revision
+            or revision - room.checkpoint_revision >= self.checkpoint_ops
+            or now - room.checkpoint_at >= self.checkpoint_interval
+        )
+        author = room.owner_id
+        for commit in reversed(commits):
+            if type(commit.user_id) is int:
+                author = commit.user_id
+                break
+        # The first flush of a document also checkpoints the revision the log
+        # starts from, so every logged revision can be rebuilt
+        base = room.flushed_revision if room.checkpoint_revision is None and start == room.flushed_revision else None
+        room.flushed_revision = revision
+        if checkpoint:
+            room.checkpoint_revision, room.checkpoint_at = revision, now
+        return {
+            'content': room.content,
+            'revision': revision,
+            'operations': operations,
+            'checkpoint': checkpoint,
+            'base': base,
+            'author': author
+        }
+
+    @staticmethod
+    def write(snapshot):
+        with metrics.db_seconds.time(('flush',)):
+            now = timezone.now()
+            with transaction.atomic():
+                for document_id, state in snapshot.items():
+                    if state['base'] is not None:
+                        WriteBehind.write_base(document_id, state['base'])
+                    updated = Document.objects.filter(id=document_id).update(
+                        content=state['content'], revision=state['revision'], updated_at=now
+                    )
+                    if not updated:
+                        continue
+                    index_document(document_id)
+                    # A retried flush may resend operations that already made it
+                    DocumentOperation.objects.bulk_create(state['operations'], ignore_conflicts=True)
+                    if state['checkpoint'] and state['author'] is not None:
+                        store_version(
+                            document_id,
+                            state['content'],
+                            revision=state['revision'],
+                            created_by_id=state['author'],
+                            change_description=CHECKPOINT_DESCRIPTION
+                        )
+
+    @staticmethod
+    def write_base(document_id, revision):
+        # The row still holds the last flushed content, which is the base
+        row = Document.objects.filter(id=document_id).values_list('content', 'revision', 'created_by_id').first()
+        if row is None or row[1] != revision:
+            return
+        if DocumentVersion.objects.filter(document_id=document_id, revision=revision).exists():
+            return
+        store_version(
+            document_id,
+            row[0],
+            revision=revision,
+            created_by_id=row[2],
+            change_description=CHECKPOINT_DESCRIPTION
+        )
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        tick = max(min(self.flush_interval, self.idle_flush) / 2, 0.05)
+        while self.dirty:
+            await asyncio.sleep(tick)
+            try:
+                await self.flush(self.due())
+            except Exception:
+                logger.exception('Failed to flush dirty documents')
+
+
+write_behind = WriteBehind()
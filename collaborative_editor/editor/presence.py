@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+
+
+def heartbeat_interval():
+    return getattr(settings, 'EDITOR_PRESENCE_HEARTBEAT', 15.0)
+
+
+class Presence:
+    # Who is in a room, by user: several tabs of one user are a single entry
+    # that lasts until the last of their connections goes, so the room only
+    # hears about users arriving and leaving. Consumers heartbeat their
+    # connection every EDITOR_PRESENCE_HEARTBEAT seconds; connections missing
+    # three heartbeats are expired, which clears the ghosts a crashed worker
+    # would otherwise leave behind.
+
+    def __init__(self):
+        self.users = {}  # user_id -> {channel_name: last heartbeat}
+
+    def roster(self):
+        return list(self.users)
+
+    def add(self, user_id, channel, now=None):
+        # True when the user was not present before
+        channels = self.users.setdefault(user_id, {})
+        first = not channels
+        channels[channel] = time.monotonic() if now is None else now
+        return first
+
+    def touch(self, user_id, channel, now=None):
+        channels = self.users.get(user_id)
+        if channels is None or channel not in channels:
+            return False
+        channels[channel] = time.monotonic() if now is None else now
+        return True
+
+    def remove(self, user_id, channel):
+        # True when that was the user's last connection
+        channels = self.users.get(user_id)
+        if channels is None or channels.pop(channel, None) is None:
+            return False
+        if channels:
+            return False
+        del self.users[user_id]
+        return True
+
+    def expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        ttl = 3 * heartbeat_interval()
+        return [
+            (user_id, channel)
+            for user_id, channels in self.users.items()
+            for channel, seen in channels.items()
+            if now - seen > ttl
+        ]
@@ -0,0 +1,215 @@
+# Compact binary framing, negotiated with the 'editor.binary' WebSocket
+# subprotocol. A frame is a one-byte opcode followed by its fields in schema
+# order. Integers are unsigned LEB128 varints, strings are a varint byte
+# length followed by UTF-8. JSON text frames remain the default.
+BINARY_SUBPROTOCOL = 'editor.binary'
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# Field codecs are named by type; '?' marks fields that may be None/missing
+SCHEMAS = {
+    'document_content': (1, [('content', 'str'), ('revision', 'uint'), ('epoch', 'str'), ('user_id', 'user')]),
+    'replay': (2, [
+        ('operations', ('list', [
+            ('revision', 'uint'), ('user_id', 'user'), ('client_id', 'str?'), ('seq', 'uint?'), (None, 'operation'),
+        ])),
+        ('revision', 'uint'), ('epoch', 'str'), ('user_id', 'user'),
+    ]),
+    'ack': (3, [('revision', 'uint')]),
+    'text_change': (4, [('user_id', 'user'), ('revision', 'uint'), ('seq', 'uint?'), (None, 'operation')]),
+    'cursors': (5, [
+        ('cursors', ('list', [('user_id', 'user'), ('position', 'uint'), ('selection', 'selection')])),
+        ('offscreen', ('list', [('user_id', 'user'), ('line', 'uint')])),
+    ]),
+    'user_joined': (6, [('user_id', 'user')]),
+    'user_left': (7, [('user_id', 'user')]),
+    'cursor_position': (8, [('position', 'uint'), ('selection', 'selection')]),
+    'viewport': (9, [('from_line', 'uint'), ('to_line', 'uint')]),
+    'resync': (10, []),
+    # Frames written in one go by editor.outbox; each is length-prefixed
+    'batch': (11, [('frames', 'frames')]),
+    'presence': (12, [('users', 'users')]),
+}
+
+OPCODES = {opcode: (name, fields) for name, (opcode, fields) in SCHEMAS.items()}
+
+
+def _write_uint(out, value):
+    if type(value) is not int or value < 0:
+        raise ProtocolError(f'expected a non-negative integer, got {value!r}')
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_str(out, value):
+    data = value.encode()
+    _write_uint(out, len(data))
+    out += data
+
+
+def _write_field(out, frame, key, kind):
+    value = frame.get(key) if key is not None else None
+    if kind == 'uint':
+        _write_uint(out, value)
+    elif kind == 'str':
+        _write_str(out, value)
+    elif kind == 'uint?':
+        _write_uint(out, 0 if value is None else value + 1)
+    elif kind == 'str?':
+        if value is None:
+            out.append(0)
+        else:
+            data = value.encode()
+            _write_uint(out, len(data) + 1)
+            out += data
+    elif kind == 'user':
+        # 0 = none, 1 = anonymous, n + 2 = user n
+        _write_uint(out, 0 if value is None else 1 if value == 'anonymous' else value + 2)
+    elif kind == 'selection':
+        if isinstance(value, dict):
+            out.append(1)
+            _write_uint(out, value['from'])
+            _write_uint(out, value['to'])
+        else:
+            out.append(0)
+    elif kind == 'users':
+        _write_uint(out, len(value))
+        for user_id in value:
+            _write_field(out, {'user_id': user_id}, 'user_id', 'user')
+    elif kind == 'frames':
+        _write_uint(out, len(value))
+        for item in value:
+            data = item if isinstance(item, bytes) else encode_binary(item)
+            _write_uint(out, len(data))
+            out += data
+    elif kind == 'operation':
+        # Flattened into the enclosing frame: 0 = insert + text, 1 = delete + length
+        if frame['operation'] == 'insert':
+            out.append(0)
+            _write_uint(out, frame['position'])
+            _write_str(out, frame['text'])
+        else:
+            out.append(1)
+            _write_uint(out, frame['position'])
+            _write_uint(out, frame['length'])
+    else:
+        _, fields = kind
+        _write_uint(out, len(value))
+        for item in value:
+            for item_key, item_kind in fields:
+                _write_field(out, item, item_key, item_kind)
+
+
+def encode_binary(frame):
+    try:
+        opcode, fields = SCHEMAS[frame['type']]
+    except KeyError:
+        raise ProtocolError(f'no binary encoding for {frame.get("type")!r}')
+    out = bytearray([opcode])
+    try:
+        for key, kind in fields:
+            _write_field(out, frame, key, kind)
+    except (KeyError, TypeError, AttributeError, UnicodeEncodeError) as e:
+        raise ProtocolError(f'malformed {frame["type"]} frame: {e!r}')
+    return bytes(out)
+
+
+class _Reader:
+    __slots__ = ('data', 'offset')
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def uint(self):
+        result = shift = 0
+        while True:
+            if self.offset >= len(self.data):
+                raise ProtocolError('truncated frame')
+            byte = self.data[self.offset]
+            self.offset += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def bytes(self, length):
+        end = self.offset + length
+        if end > len(self.data):
+            raise ProtocolError('truncated frame')
+        chunk = self.data[self.offset:end]
+        self.offset = end
+        return chunk
+
+    def str(self, length=None):
+        try:
+            return self.bytes(self.uint() if length is None else length).decode()
+        except UnicodeDecodeError:
+            raise ProtocolError('invalid UTF-8')
+
+
+def _read_field(reader, frame, key, kind):
+    if kind == 'uint':
+        frame[key] = reader.uint()
+    elif kind == 'str':
+        frame[key] = reader.str()
+    elif kind == 'uint?':
+        value = reader.uint()
+        frame[key] = None if value == 0 else value - 1
+    elif kind == 'str?':
+        length = reader.uint()
+        frame[key] = None if length == 0 else reader.str(length - 1)
+    elif kind == 'user':
+        value = reader.uint()
+        frame[key] = None if value == 0 else 'anonymous' if value == 1 else value - 2
+    elif kind == 'selection':
+        frame[key] = {'from': reader.uint(), 'to': reader.uint()} if reader.uint() else None
+    elif kind == 'users':
+        users = []
+        for _ in range(reader.uint()):
+            _read_field(reader, frame, key, 'user')
+            users.append(frame[key])
+        frame[key] = users
+    elif kind == 'frames':
+        frame[key] = [decode_binary(reader.bytes(reader.uint()), nested=True) for _ in range(reader.uint())]
+    elif kind == 'operation':
+        is_delete = reader.uint()
+        frame['operation'] = 'delete' if is_delete else 'insert'
+        frame['position'] = reader.uint()
+        if is_delete:
+            frame['text'], frame['length'] = '', reader.uint()
+        else:
+            frame['text'] = reader.str()
+            frame['length'] = len(frame['text'])
+    else:
+        _, fields = kind
+        items = []
+        for _ in range(reader.uint()):
+            item = {}
+            for item_key, item_kind in fields:
+                _read_field(reader, item, item_key, item_kind)
+            items.append(item)
+        frame[key] = items
+
+
+def decode_binary(data, nested=False):
+    reader = _Reader(data)
+    try:
+        name, fields = OPCODES[reader.uint()]
+    except KeyError:
+        raise ProtocolError('unknown opcode')
+    if nested and name == 'batch':
+        # The outbox never nests batches; refusing them bounds the recursion
+        raise ProtocolError('nested batch')
+    frame = {'type': name}
+    for key, kind in fields:
+        _read_field(reader, frame, key, kind)
+    if reader.offset != len(data):
+        raise ProtocolError('trailing bytes')
+    return frame
+
@@ -0,0 +1,249 @@
+import asyncio
+import sys
+import time
+import uuid
+from collections import deque
+from itertools import islice
+
+from django.conf import settings
+
+from .buffer import Rope
+from .cursors import CursorCoalescer, ViewportIndex
+from .limits import TokenBucket, room_cursor_input_rate, room_edit_rate
+from .metrics import registry
+from .ot import INSERT, InvalidOperation, Operation, transform
+from .presence import Presence
+
+# Rough per-connection overhead (membership, presence, viewport, budgets)
+MEMBER_SIZE = 1024
+
+
+def idle_timeout():
+    return getattr(settings, 'EDITOR_ROOM_IDLE_TIMEOUT', 600)
+
+
+def memory_budget():
+    return getattr(settings, 'EDITOR_ROOM_MEMORY_BUDGET', 256 * 1024 * 1024)
+
+
+class Commit:
+    __slots__ = ('operation', 'user_id', 'client_id', 'seq')
+
+    def __init__(self, operation, user_id=None, client_id=None, seq=None):
+        self.operation = operation
+        self.user_id = user_id
+        self.client_id = client_id
+        self.seq = seq
+
+
+class Room:
+    # Authoritative server-side copy of a document while it has connected editors.
+    # Clients only exchange deltas; the full text is sent on connect or resync.
+    # Every accepted operation bumps the revision. The last EDITOR_HISTORY_SIZE
+    # commits are kept in a ring buffer so operations can be rebased and
+    # reconnecting clients can be caught up without a full snapshot; the epoch
+    # tells a reconnecting client whether it is talking to the same room.
+    # Revisions continue from the persisted Document.revision so they line up
+    # with the op log.
+
+    def __init__(self, document_id, content='', revision=0, owner_id=None, checkpoint_revision=None):
+        self.document_id = document_id
+        self.epoch = uuid.uuid4().hex
+        self.buffer = Rope(content)
+        self.revision = revision
+        self.owner_id = owner_id
+        # Write-behind bookkeeping, see editor.persistence
+        self.flushed_revision = revision
+        self.checkpoint_revision = checkpoint_revision
+        self.checkpoint_at = time.monotonic()
+        self.history = deque(maxlen=getattr(settings, 'EDITOR_HISTORY_SIZE', 1000))
+        self.members = {}  # channel_name -> user_id
+        self.presence = Presence()
+        self.binary_channels = set()  # members speaking the binary protocol
+        self.viewports = ViewportIndex()
+        self.cursors = CursorCoalescer(self)
+        # Admission control, see editor.limits and Worker.on_submit
+        self.edit_budget = TokenBucket(room_edit_rate())
+        self.cursor_budget = TokenBucket(room_cursor_input_rate())
+        self.edit_budgets = {}  # channel_name -> TokenBucket
+        self.deferred = []  # submit commands waiting for budget, in arrival order
+        self.draining = None
+        # Last command other than a heartbeat, for RoomManager
+        self.last_active = time.monotonic()
+        # Layer of the worker holding the room, see editor.sharding
+        self.channel_layer = None
+        # Held while an operation is committed and fanned out so peers see
+        # operations in revision order
+        self.lock = asyncio.Lock()
+
+    @property
+    def group_name(self):
+        return f'editor_{self.document_id}'
+
+    @property
+    def content(self):
+        return str(self.buffer)
+
+    @property
+    def oldest_revision(self):
+        return self.revision - len(self.history)
+
+    def memory_usage(self):
+        # Approximate bytes held: the text, the history ring buffer and
+        # per-connection state
+        size = self.buffer.memory_usage() + MEMBER_SIZE * len(self.members)
+        for commit in self.history:
+            operation = commit.operation
+            size += sys.getsizeof(commit) + sys.getsizeof(operation) + sys.getsizeof(operation.text)
+        return size
+
+    def commits_since(self, revision):
+        # None when revision is unknown or already fell out of the ring buffer
+        if type(revision) is not int or not self.oldest_revision <= revision <= self.revision:
+            return None
+        return list(islice(self.history, revision - self.oldest_revision, None))
+
+    def submit(self, operation, revision, user_id=None, client_id=None, seq=None):
+        # operation was made against `revision`; rebase it over everything
+        # committed since then before applying it
+        commits = self.commits_since(revision)
+        if commits is None:
+            raise InvalidOperation(f'unknown revision {revision!r}')
+        for commit in commits:
+            _, operation = transform(commit.operation, operation)
+        try:
+            if operation.kind == INSERT:
+                self.buffer.insert(operation.position, operation.text)
+            else:
+                self.buffer.delete(operation.position, operation.length)
+        except IndexError as e:
+            raise InvalidOperation(str(e))
+        self.history.append(Commit(operation, user_id, client_id, seq))
+        self.revision += 1
+        return operation
+
+    def to_state(self):
+        # Plain data for handing the room to another worker; cursors in
+        # flight are dropped
+        return {
+            'document_id': self.document_id,
+            'epoch': self.epoch,
+            'content': self.content,
+            'revision': self.revision,
+            'owner_id': self.owner_id,
+            'flushed_revision': self.flushed_revision,
+            'checkpoint_revision': self.checkpoint_revision,
+            'history': [
+                [commit.user_id, commit.client_id, commit.seq, commit.operation.to_message()]
+                for commit in self.history
+            ],
+            'members': dict(self.members),
+            'binary_channels': list(self.binary_channels),
+            'viewports': dict(self.viewports.ranges)
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        room = cls(
+            state['document_id'], state['content'], state['revision'],
+            state['owner_id'], state['checkpoint_revision']
+        )
+        room.epoch = state['epoch']
+        room.flushed_revision = state['flushed_revision']
+        for user_id, client_id, seq, operation in state['history']:
+            room.history.append(Commit(Operation.from_message(operation), user_id, client_id, seq))
+        room.members = dict(state['members'])
+        for channel, user_id in room.members.items():
+            room.presence.add(user_id, channel)
+        room.binary_channels = set(state['binary_channels'])
+        for channel, (first_line, last_line) in state['viewports'].items():
+            room.viewports.update(channel, first_line, last_line)
+        return room
+
+
+class RoomManager(dict):
+    # The rooms held by one worker, by document id. Rooms idle for
+    # EDITOR_ROOM_IDLE_TIMEOUT seconds, and the least recently active ones
+    # while all rooms together are over EDITOR_ROOM_MEMORY_BUDGET bytes, are
+    # evicted by the worker (Worker.evict_rooms): flushed and dropped, keeping
+    # only who is connected. The next command for the document loads it
+    # again from the database and gives it back its members, so connected
+    # clients carry on without noticing.
+
+    def __init__(self):
+        super().__init__()
+        self.dormant = {}  # document_id -> membership of an evicted room
+
+    def memory_usage(self):
+        return {document_id: room.memory_usage() for document_id, room in self.items()}
+
+    def evictable(self, usage=None, now=None):
+        # (room, reason) to evict, least recently active first
+        usage = self.memory_usage() if usage is None else usage
+        now = time.monotonic() if now is None else now
+        total, budget, timeout = sum(usage.values()), memory_budget(), idle_timeout()
+        victims = []
+        for room in sorted(self.values(), key=lambda room: room.last_active):
+            if now - room.last_active >= timeout:
+                reason = 'idle'
+            elif total > budget:
+                reason = 'memory'
+            else:
+                break
+            victims.append((room, reason))
+            total -= usage[room.document_id]
+        return victims
+
+    def sleep(self, room):
+        self.dormant[room.document_id] = {
+            'epoch': room.epoch,
+            'revision': room.revision,
+            'members': dict(room.members),
+            'presence': room.presence,
+            'binary_channels': set(room.binary_channels),
+            'viewports': dict(room.viewports.ranges)
+        }
+
+    def leave(self, document_id, channel, user_id):
+        # A member of an evicted room disconnecting. True when that was the
+        # user's last connection; the room is forgotten with its last member.
+        state = self.dormant[document_id]
+        left = state['presence'].remove(user_id, channel)
+        state['members'].pop(channel, None)
+        state['binary_channels'].discard(channel)
+        state['viewports'].pop(channel, None)
+        if not state['members']:
+            del self.dormant[document_id]
+        return left
+
+    def wake(self, room):
+        state = self.dormant.pop(room.document_id, None)
+        if state is None:
+            return
+        if state['revision'] == room.revision:
+            # Nothing changed in between, so clients may still resume
+            room.epoch = state['epoch']
+        room.members.update(state['members'])
+        room.presence = state['presence']
+        room.binary_channels |= state['binary_channels']
+        for channel, (first_line, last_line) in state['viewports'].items():
+            room.viewports.update(channel, first_line, last_line)
+
+
+_rooms = RoomManager()
+
+
+def get_room(document_id, rooms=_rooms):
+    return rooms.get(document_id)
+
+
+def open_room(document_id, content, rooms=_rooms, **state):
+    # A concurrent connect may have loaded the room while we were reading the DB
+    return rooms.setdefault(document_id, Room(document_id, content, **state))
+
+
+def close_room(room, rooms=_rooms):
+    if rooms.get(room.document_id) is room:
+        del rooms[room.document_id]
+        room.cursors.cancel()
+        registry.remove('document', room.document_id)
@@ -0,0 +1,563 @@
+# Rooms are sharded over the ASGI workers: each document's Room lives in
+# exactly one worker, picked by consistent hashing of the document id over the
+# live workers, so its buffer, history and op ordering need no cross-process
+# locking. Consumers send every room command (attach, submit, cursor, ...) to
+# the owner, running it in place when that is their own worker and forwarding
+# it over the channel layer otherwise; replies reach them as send.frame
+# messages like any broadcast. Workers find each other through the
+# editor_workers group and heartbeat there. When a worker joins or leaves,
+# the rooms whose owner changed are handed over with their history, so
+# clients keep their epoch and in-flight operations still rebase. A worker
+# that dies without stopping hands nothing over: commands forwarded to it are
+# lost until the others drop it after three missed heartbeats, and the room
+# then reloads from the database at the last flushed revision, clients
+# reattaching on their next presence heartbeat.
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .broadcast import encode, fan_out
+from .limits import TokenBucket, edit_rate, max_room_members, merge_edits
+from .models import Document, DocumentVersion
+from .ot import InvalidOperation, Operation
+from .persistence import write_behind
+from .protocol import encode_binary
+from .rooms import Room, RoomManager, _rooms, close_room, open_room
+from .trace import recorder
+
+logger = logging.getLogger(__name__)
+
+WORKERS_GROUP = 'editor_workers'
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    # Consistent hashing with virtual nodes: adding or removing a worker only
+    # moves the documents hashing next to its points
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []  # sorted (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            bisect.insort(self._points, (_hash(f'{node}#{i}'), node))
+
+    def remove(self, node):
+        if node in self.nodes:
+            self.nodes.discard(node)
+            self._points = [point for point in self._points if point[1] != node]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, (_hash(str(key)),))
+        return self._points[index % len(self._points)][1]
+
+
+@database_sync_to_async
+def load_room(document_id):
+    with metrics.db_seconds.time(('load',)):
+        try:
+            doc = Document.objects.only('content', 'revision', 'created_by').get(id=document_id)
+        except Document.DoesNotExist:
+            return {'content': ''}
+        checkpoint = (
+            DocumentVersion.objects
+            .filter(document=doc, revision__isnull=False)
+            .order_by('-revision')
+            .values_list('revision', flat=True)
+            .first()
+        )
+    return {
+        'content': doc.content,
+        'revision': doc.revision,
+        'owner_id': doc.created_by_id,
+        'checkpoint_revision': checkpoint
+    }
+
+
+def content_frame(room, user_id):
+    return {
+        'type': 'document_content',
+        'content': room.content,
+        'revision': room.revision,
+        'epoch': room.epoch,
+        'user_id': user_id
+    }
+
+
+def replay_frame(room, revision, commits, user_id):
+    operations = []
+    for commit in commits:
+        revision += 1
+        operations.append({
+            'revision': revision,
+            'user_id': commit.user_id,
+            'client_id': commit.client_id,
+            'seq': commit.seq,
+            **commit.operation.to_message()
+        })
+    return {
+        'type': 'replay',
+        'operations': operations,
+        'revision': room.revision,
+        'epoch': room.epoch,
+        'user_id': user_id
+    }
+
+
+class Worker:
+    # This process's share of the rooms, bound to one channel layer
+
+    def __init__(self, layer, rooms):
+        self.layer = layer
+        self.rooms = rooms
+        self.channel = None
+        self.ring = HashRing()
+        self.changed_at = 0  # when the ring last changed
+        self.seen = {}  # worker channel -> last heartbeat
+        # document_id -> (commands, workers still to answer) while we ask
+        # the other workers whether one of them still holds the room
+        self.parked = {}
+        self._started = None
+        self._tasks = []
+
+    @property
+    def heartbeat(self):
+        return getattr(settings, 'EDITOR_WORKER_HEARTBEAT', 5.0)
+
+    @property
+    def grace(self):
+        # A worker missing this many heartbeats is dropped from the ring,
+        # and for as long after a ring change rooms may still be in transit
+        return 3 * self.heartbeat
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        started = self._started
+        if started is None or started.get_loop() is not loop or (
+            started.done() and (started.cancelled() or started.exception() is not None)
+        ):
+            self._started = loop.create_task(self._start())
+        await asyncio.shield(self._started)
+
+    async def _start(self):
+        self.channel = await self.layer.new_channel('worker.')
+        self.ring = HashRing([self.channel])
+        self.changed_at = time.monotonic()
+        self.seen = {}
+        self.parked = {}
+        await self.layer.group_add(WORKERS_GROUP, self.channel)
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._read()), loop.create_task(self._beat())]
+        await self.layer.group_send(WORKERS_GROUP, {'type': 'worker.join', 'worker': self.channel})
+        metrics.registry.start_logging()
+
+    async def stop(self):
+        # Graceful shutdown: hand every room to its next owner, then leave
+        remaining = HashRing(self.ring.nodes - {self.channel})
+        if remaining.nodes:
+            self.ring, self.changed_at = remaining, time.monotonic()
+        for room in list(self.rooms.values()):
+            await self._hand_off(room, remaining.owner(room.document_id))
+        await self.layer.group_send(WORKERS_GROUP, {'type': 'worker.leave', 'worker': self.channel})
+        await self.layer.group_discard(WORKERS_GROUP, self.channel)
+        for task in self._tasks:
+            task.cancel()
+        self._started = None
+
+    def owns(self, document_id):
+        return self.ring.owner(document_id) == self.channel
+
+    async def _read(self):
+        while True:
+            message = await self.layer.receive(self.channel)
+            try:
+                await self.dispatch(message)
+            except Exception:
+                logger.exception('Failed to handle %s', message.get('type'))
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            # Group memberships lapse after the layer's group_expiry
+            await self.layer.group_add(WORKERS_GROUP, self.channel)
+            await self.layer.group_send(WORKERS_GROUP, {'type': 'worker.heartbeat', 'worker': self.channel})
+            now = time.monotonic()
+            for worker, seen in list(self.seen.items()):
+                if now - seen > self.grace:
+                    # Handled by the reader like any other membership change
+                    await self.layer.send(self.channel, {'type': 'worker.leave', 'worker': worker})
+            try:
+                await self.expire_presence(now)
+            except Exception:
+                logger.exception('Failed to expire presence')
+            try:
+                await self.evict_rooms()
+            except Exception:
+                logger.exception('Failed to evict rooms')
+
+    async def expire_presence(self, now=None):
+        # Connections whose consumer stopped heartbeating, e.g. because its
+        # worker died, leave like any other
+        presences = [(document_id, room.presence) for document_id, room in self.rooms.items()]
+        presences += [(document_id, state['presence']) for document_id, state in self.rooms.dormant.items()]
+        for document_id, presence in presences:
+            for user_id, channel in presence.expired(now):
+                await self.command(document_id, {'op': 'detach', 'channel': channel, 'user_id': user_id})
+
+    async def evict_rooms(self, now=None):
+        # See RoomManager; the gauges double as the per-room memory report
+        usage = self.rooms.memory_usage()
+        for document_id, size in usage.items():
+            metrics.room_memory.set((document_id,), size)
+        for room, reason in self.rooms.evictable(usage, now):
+            await self.evict(room, reason)
+        metrics.rooms.set(('live',), len(self.rooms))
+        metrics.rooms.set(('dormant',), len(self.rooms.dormant))
+
+    async def evict(self, room, reason):
+        async with room.lock:
+            if self.rooms.get(room.document_id) is not room or room.deferred:
+                return
+            # Saved before it goes; a room that fails to save stays
+            await write_behind.flush([room.document_id])
+            close_room(room, self.rooms)
+            recorder.stop(room)
+            self.rooms.sleep(room)
+        metrics.room_evictions.inc((reason,))
+
+    async def dispatch(self, message):
+        kind = message['type']
+        document_id = message.get('document_id')
+        if kind == 'room.command':
+            await self.command(document_id, message)
+        elif kind == 'room.handoff':
+            await self._adopt(message)
+        elif kind == 'room.request':
+            room = self.rooms.get(document_id)
+            if room is not None:
+                await self._hand_off(room, message['worker'])
+            else:
+                await self.layer.send(message['worker'], {
+                    'type': 'room.none', 'document_id': document_id, 'worker': self.channel
+                })
+        elif kind == 'room.none':
+            await self._answered(document_id, message['worker'])
+        elif message.get('worker') == self.channel:
+            return
+        elif kind == 'worker.join':
+            await self.layer.send(message['worker'], {'type': 'worker.heartbeat', 'worker': self.channel})
+            await self._join(message['worker'])
+        elif kind == 'worker.heartbeat':
+            await self._join(message['worker'])
+        elif kind == 'worker.leave':
+            self.seen.pop(message['worker'], None)
+            if message['worker'] in self.ring.nodes:
+                await self._rebalance(self.ring.nodes - {message['worker']})
+            for document_id in list(self.parked):
+                await self._answered(document_id, message['worker'])
+
+    async def _join(self, worker):
+        self.seen[worker] = time.monotonic()
+        if worker not in self.ring.nodes:
+            await self._rebalance(self.ring.nodes | {worker})
+
+    async def _rebalance(self, nodes):
+        self.ring, self.changed_at = HashRing(nodes), time.monotonic()
+        for document_id in list(self.rooms.dormant):
+            if not self.owns(document_id):
+                # Its clients rejoin the new owner on their next heartbeat
+                del self.rooms.dormant[document_id]
+        for document_id, room in list(self.rooms.items()):
+            if not self.owns(document_id):
+                await self._hand_off(room, self.ring.owner(document_id))
+
+    async def _hand_off(self, room, owner):
+        async with room.lock:
+            if self.rooms.get(room.document_id) is not room:
+                return
+            close_room(room, self.rooms)
+            recorder.stop(room)
+        # Written out first so nothing is lost if the new owner never gets it,
+        # and the trace before the new owner appends to it
+        await write_behind.flush([room.document_id])
+        await recorder.flush()
+        if owner is None or owner == self.channel:
+            return
+        await self.layer.send(owner, {
+            'type': 'room.handoff',
+            'document_id': room.document_id,
+            'worker': self.channel,
+            'room': room.to_state()
+        })
+        # Edits still held back by admission control follow the room
+        for message in room.deferred:
+            await self.layer.send(owner, {**message, 'type': 'room.command', 'document_id': room.document_id})
+
+    async def _adopt(self, message):
+        document_id = message['document_id']
+        if document_id not in self.rooms:
+            room = Room.from_state(message['room'])
+            room.channel_layer = self.layer
+            self.rooms[document_id] = room
+            recorder.start(room)
+        await self._answered(document_id, message['worker'])
+
+    async def _answered(self, document_id, worker):
+        entry = self.parked.get(document_id)
+        if entry is None:
+            return
+        commands, waiting = entry
+        waiting.discard(worker)
+        if waiting and document_id not in self.rooms:
+            return
+        del self.parked[document_id]
+        for message in commands:
+            await self.command(document_id, message, ask=False)
+
+    async def command(self, document_id, message, ask=True):
+        # Runs a room command if this worker owns the document, otherwise
+        # forwards it to the worker that does
+        owner = self.ring.owner(document_id)
+        if owner != self.channel:
+            await self.layer.send(owner, {**message, 'type': 'room.command', 'document_id': document_id})
+            return
+        room = self.rooms.get(document_id)
+        dormant = self.rooms.dormant.get(document_id)
+        if room is None and dormant is not None and message['op'] == 'heartbeat':
+            # Evicted rooms are not loaded again just to keep members alive
+            if dormant['presence'].touch(message['user_id'], message['channel']):
+                return
+        if room is None and dormant is not None and message['op'] == 'detach':
+            # Nor to see them out
+            if self.rooms.leave(document_id, message['channel'], message['user_id']):
+                frame = {'type': 'user_left', 'user_id': message['user_id']}
+                await fan_out(
+                    self.layer, f'editor_{document_id}', frame,
+                    exclude=message['channel'], binary=bool(dormant['binary_channels'])
+                )
+            return
+        if room is None and dormant is not None and message['op'] == 'viewport':
+            dormant['viewports'][message['channel']] = (message['from_line'], message['to_line'])
+            return
+        if room is None:
+            if document_id in self.parked:
+                self.parked[document_id][0].append(message)
+                return
+            others = self.ring.nodes - {self.channel}
+            if ask and others and dormant is None and time.monotonic() - self.changed_at < self.grace:
+                # The previous owner may still be handing the room over
+                self.parked[document_id] = ([message], set(others))
+                for other in others:
+                    await self.layer.send(other, {
+                        'type': 'room.request', 'document_id': document_id, 'worker': self.channel
+                    })
+                return
+            state = await load_room(document_id)
+            room = open_room(document_id, rooms=self.rooms, **state)
+            room.channel_layer = self.layer
+            # Back from eviction: same members as before
+            self.rooms.wake(room)
+            recorder.start(room)
+        async with room.lock:
+            handled = self.rooms.get(document_id) is room
+            if handled:
+                if message['op'] != 'heartbeat':
+                    room.last_active = time.monotonic()
+                metrics.room_commands.inc((document_id,))
+                recorder.record(room, message)
+                await getattr(self, 'on_' + message['op'])(room, message)
+        if not handled:
+            # Handed off or closed while we waited for the lock
+            await self.command(document_id, message, ask)
+
+    async def reply(self, room, channel, frame):
+        if channel in room.binary_channels:
+            message = {'type': 'send.frame', 'kind': frame['type'], 'bytes': encode_binary(frame)}
+        else:
+            message = {'type': 'send.frame', 'kind': frame['type'], 'text': encode(frame)}
+        try:
+            await self.layer.send(channel, message)
+        except ChannelFull:
+            pass
+
+    async def broadcast(self, room, frame, exclude):
+        started = time.perf_counter()
+        await fan_out(self.layer, room.group_name, frame, exclude=exclude, binary=bool(room.binary_channels))
+        metrics.group_send_seconds.observe(time.perf_counter() - started)
+
+    async def on_attach(self, room, message):
+        channel, user_id = message['channel'], message['user_id']
+        if channel not in room.members and len(room.members) >= max_room_members():
+            metrics.limited.inc(('room_full',))
+            try:
+                await self.layer.send(channel, {'type': 'room.full'})
+            except ChannelFull:
+                pass
+            return
+        room.members[channel] = user_id
+        if message['binary']:
+            room.binary_channels.add(channel)
+        joined = room.presence.add(user_id, channel)
+        # Replay what the client missed if the ring buffer still covers it,
+        # otherwise send the current document content
+        revision = message.get('revision')
+        commits = room.commits_since(revision) if message.get('epoch') == room.epoch else None
+        if commits is None:
+            await self.reply(room, channel, content_frame(room, user_id))
+        else:
+            await self.reply(room, channel, replay_frame(room, revision, commits, user_id))
+        # Who is here now; after this only arrivals and departures are sent
+        await self.reply(room, channel, {'type': 'presence', 'users': room.presence.roster()})
+        if joined:
+            await self.broadcast(room, {'type': 'user_joined', 'user_id': user_id}, channel)
+
+    async def on_heartbeat(self, room, message):
+        if not room.presence.touch(message['user_id'], message['channel']):
+            # The room was rebuilt without us (its worker died): join again
+            # and start over from the current content
+            await self.on_attach(room, message)
+
+    async def on_detach(self, room, message):
+        channel, user_id = message['channel'], message['user_id']
+        if room.presence.remove(user_id, channel):
+            await self.broadcast(room, {'type': 'user_left', 'user_id': user_id}, channel)
+        room.members.pop(channel, None)
+        room.binary_channels.discard(channel)
+        room.edit_budgets.pop(channel, None)
+        room.deferred = [deferred for deferred in room.deferred if deferred['channel'] != channel]
+        room.viewports.remove(channel)
+        if user_id not in room.members.values():
+            room.cursors.discard(user_id)
+        if not room.members:
+            # Last editor left: persist before dropping the in-memory copy
+            await write_behind.flush([room.document_id])
+            close_room(room, self.rooms)
+            recorder.stop(room, final=True)
+
+    async def on_submit(self, room, message):
+        # Each connection gets EDITOR_EDIT_RATE edits a second and the room
+        # EDITOR_ROOM_EDIT_RATE in all. Edits over either budget wait in
+        # room.deferred, merged where they extend the connection's previous
+        # one, so a flood costs one commit and broadcast per merged run.
+        channel = message['channel']
+        budget = room.edit_budgets.get(channel)
+        if budget is None:
+            budget = room.edit_budgets[channel] = TokenBucket(edit_rate())
+        waiting = any(deferred['channel'] == channel for deferred in room.deferred)
+        if waiting or not (budget.peek() and room.edit_budget.peek()):
+            await self.defer(room, message, budget)
+            return
+        budget.take()
+        room.edit_budget.take()
+        await self.apply(room, message)
+
+    async def defer(self, room, message, budget):
+        channel = message['channel']
+        queued = [deferred for deferred in room.deferred if deferred['channel'] == channel]
+        if queued:
+            merged = merge_edits(queued[-1]['data'], message['data'])
+            if merged is not None:
+                queued[-1]['data'] = merged
+                metrics.limited.inc(('edit_merged',))
+                return
+        if len(queued) >= budget.burst:
+            # Too far behind to catch up: start the client over from a snapshot
+            room.deferred = [deferred for deferred in room.deferred if deferred['channel'] != channel]
+            metrics.limited.inc(('edit_dropped',))
+            await self.reply(room, channel, content_frame(room, message['user_id']))
+            return
+        room.deferred.append(message)
+        metrics.limited.inc(('edit_deferred',))
+        if room.draining is None or room.draining.done():
+            room.draining = asyncio.get_running_loop().create_task(self._drain(room))
+
+    async def _drain(self, room):
+        while room.deferred:
+            await asyncio.sleep(max(room.edit_budget.wait(), min(
+                room.edit_budgets[deferred['channel']].wait() for deferred in room.deferred
+            ), 0.005))
+            async with room.lock:
+                if self.rooms.get(room.document_id) is not room:
+                    return
+                blocked = set()
+                for message in list(room.deferred):
+                    channel = message['channel']
+                    budget = room.edit_budgets[channel]
+                    if channel in blocked or not (budget.peek() and room.edit_budget.peek()):
+                        # Later edits of this connection wait their turn
+                        blocked.add(channel)
+                        continue
+                    budget.take()
+                    room.edit_budget.take()
+                    room.deferred.remove(message)
+                    await self.apply(room, message)
+
+    async def apply(self, room, message):
+        channel, user_id, data = message['channel'], message['user_id'], message['data']
+        try:
+            operation = Operation.from_message(data)
+            operation = room.submit(
+                operation, data.get('revision'), user_id, message['client_id'], data.get('seq')
+            )
+        except InvalidOperation:
+            # The client has drifted from the server copy, bring it back in line
+            await self.reply(room, channel, content_frame(room, user_id))
+            return
+
+        # Persisted by the write-behind flusher
+        write_behind.mark_dirty(room)
+
+        await self.reply(room, channel, {'type': 'ack', 'revision': room.revision})
+        # Broadcast the rebased operation to all users except the sender
+        await self.broadcast(room, {
+            'type': 'text_change',
+            'user_id': user_id,
+            'revision': room.revision,
+            **operation.to_message()
+        }, channel)
+
+    async def on_resync(self, room, message):
+        await self.reply(room, message['channel'], content_frame(room, message['user_id']))
+
+    async def on_cursor(self, room, message):
+        if not room.cursor_budget.take():
+            metrics.limited.inc(('cursor_dropped',))
+            return
+        # Coalesced per user and flushed to the room at a bounded rate
+        room.cursors.update(message['user_id'], message['position'], message['selection'])
+
+    async def on_viewport(self, room, message):
+        room.viewports.update(message['channel'], message['from_line'], message['to_line'])
+
+
+_workers = {}  # channel layer alias -> Worker
+
+
+def get_worker(alias=DEFAULT_CHANNEL_LAYER):
+    layer = get_channel_layer(alias)
+    worker = _workers.get(alias)
+    if worker is None or worker.layer is not layer:
+        # Rooms of the default layer stay visible through editor.rooms.get_room
+        worker = _workers[alias] = Worker(layer, _rooms if alias == DEFAULT_CHANNEL_LAYER else RoomManager())
+    return worker
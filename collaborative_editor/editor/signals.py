@@ -0,0 +1,57 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .document_search import index_document, unindex_document
+from .models import Document, DocumentCollaborator
+from .permissions import invalidate
+from .user_search import index_user, unindex_user
+
+
+def permissions_changed(document_id):
+    # Dropped again after commit so a read racing the transaction cannot
+    # leave stale levels behind
+    invalidate(document_id)
+
+    def notify():
+        invalidate(document_id)
+        # Connected editors re-check their access (see EditorConsumer.permissions_changed)
+        layer = get_channel_layer()
+        if layer is not None:
+            async_to_sync(layer.group_send)(f'editor_{document_id}', {'type': 'permissions.changed'})
+
+    transaction.on_commit(notify)
+
+
+@receiver(post_save, sender=DocumentCollaborator)
+@receiver(post_delete, sender=DocumentCollaborator)
+def collaborator_changed(sender, instance, **kwargs):
+    permissions_changed(instance.document_id)
+
+
+@receiver(post_save, sender=Document)
+def document_saved(sender, instance, created, **kwargs):
+    index_document(instance.id)
+    if not created:
+        permissions_changed(instance.id)
+
+
+@receiver(post_delete, sender=Document)
+def document_deleted(sender, instance, **kwargs):
+    unindex_document(instance.id)
+    permissions_changed(instance.id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login
+    if update_fields is None or {'username', 'email'} & set(update_fields):
+        index_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    unindex_user(instance.id)
@@ -2,6 +2,7 @@
     const documentId = window.EDITOR_CONFIG.documentId;
     const documentLanguage = window.EDITOR_CONFIG.documentLanguage;
     const canEdit = window.EDITOR_CONFIG.canEdit;
+    const binaryProtocol = window.EDITOR_CONFIG.binaryProtocol;
     
     // Initialize CodeMirror
     const editor = CodeMirror.fromTextArea(document.getElementById('codeEditor'), {
@@ -26,6 +27,23 @@
     let connectedUsers = new Map();
     let remoteCursors = new Map();
     
+    // Operational transform state: the last server revision we have applied,
+    // the operation waiting for its ack and local operations queued behind it
+    let revision = 0;
+    let inflight = null;
+    let inflightSeq = null;
+    let pending = [];
+    // Waiting for a snapshot after missing an operation
+    let resyncing = false;
+    let nextSeq = 1;
+    
+    // Identifies this tab across reconnects so the server can replay what we
+    // missed and we can recognise our own operations in the replay
+    const clientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+    // Close code the server uses when the room has no space left (editor.limits)
+    const ROOM_FULL = 4008;
+    let epoch = null;
+    
     const userColors = [
         '#3b82f6', '#ef4444', '#10b981', '#f59e0b', 
         '#8b5cf6', '#ec4899', '#14b8a6', '#f97316'
@@ -34,19 +52,28 @@
     // WebSocket connection
     function connect() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/editor/${documentId}/`;
+        let wsUrl = `${protocol}//${window.location.host}/ws/editor/${documentId}/?client_id=${clientId}`;
+        if (epoch) {
+            wsUrl += `&epoch=${epoch}&revision=${revision}`;
+        }
         
-        socket = new WebSocket(wsUrl);
+        if (binaryProtocol) {
+            socket = new WebSocket(wsUrl, [EditorProtocol.SUBPROTOCOL]);
+            socket.binaryType = 'arraybuffer';
+        } else {
+            socket = new WebSocket(wsUrl);
+        }
         
         socket.onopen = () => {
             updateConnectionStatus(true);
             console.log('WebSocket connected');
         };
         
-        socket.onclose = () => {
+        socket.onclose = (event) => {
             updateConnectionStatus(false);
             console.log('WebSocket disconnected');
-            setTimeout(connect, 3000);
+            // A full room is unlikely to have space again right away
+            setTimeout(connect, event.code === ROOM_FULL ? 30000 : 3000);
         };
         
         socket.onerror = (error) => {
@@ -54,93 +81,286 @@
         };
         
         socket.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            const data = typeof event.data === 'string'
+                ? JSON.parse(event.data)
+                : EditorProtocol.decode(event.data);
             handleMessage(data);
         };
     }
 
+    function sendFrame(frame) {
+        socket.send(socket.protocol === EditorProtocol.SUBPROTOCOL
+            ? EditorProtocol.encode(frame)
+            : JSON.stringify(frame));
+    }
+
     function handleMessage(data) {
         switch(data.type) {
             case 'document_content':
+                resyncing = false;
                 userId = data.user_id;
+                epoch = data.epoch;
+                revision = data.revision;
+                inflight = null;
+                pending = [];
                 isLocalChange = true;
+                astral = /[\uD800-\uDFFF]/.test(data.content);
                 editor.setValue(data.content);
                 isLocalChange = false;
+                sendViewport();
+                break;
+                
+            case 'replay':
+                resyncing = false;
+                userId = data.user_id;
+                epoch = data.epoch;
+                data.operations.forEach((op) => {
+                    if (inflight && op.client_id === clientId && op.seq === inflightSeq) {
+                        // Our in-flight edit made it before the connection dropped
+                        revision = op.revision;
+                        inflight = null;
+                    } else if (op.revision > revision) {
+                        revision = op.revision;
+                        applyRemoteChange(op);
+                    }
+                });
+                if (inflight) {
+                    // Lost with the old connection, send it again
+                    pending.unshift(inflight);
+                    inflight = null;
+                }
+                sendNextOperation();
+                sendViewport();
+                break;
+                
+            case 'ack':
+                revision = data.revision;
+                inflight = null;
+                sendNextOperation();
                 break;
                 
             case 'text_change':
-                if (data.user_id !== userId) {
-                    applyRemoteChange(data);
+                // Anything at or below our revision is already in the snapshot
+                if (data.revision <= revision || resyncing) break;
+                if (data.revision > revision + 1) {
+                    // A frame was dropped on the way (e.g. a full channel):
+                    // rebasing over a gap would corrupt the document
+                    resyncing = true;
+                    sendFrame({ type: 'resync' });
+                    break;
                 }
+                revision = data.revision;
+                applyRemoteChange(data);
                 break;
                 
-            case 'cursor_position':
-                updateRemoteCursor(data.user_id, data.position, data.selection);
+            case 'cursors':
+                // Latest cursor of every user who moved inside our viewport
+                // since the last flush, and just the line for everyone else
+                data.cursors.forEach((cursor) => {
+                    if (cursor.user_id !== userId) {
+                        setOffscreenLine(cursor.user_id, null);
+                        updateRemoteCursor(cursor.user_id, cursor.position, cursor.selection);
+                    }
+                });
+                data.offscreen.forEach((summary) => {
+                    if (summary.user_id !== userId) {
+                        removeRemoteCursor(summary.user_id);
+                        setOffscreenLine(summary.user_id, summary.line);
+                    }
+                });
                 break;
                 
             case 'user_joined':
-                addUser(data.user_id);
+                // Our own other tabs announce themselves too
+                if (data.user_id !== userId) {
+                    addUser(data.user_id);
+                }
                 break;
                 
             case 'user_left':
                 removeUser(data.user_id);
                 break;
+
+            case 'presence':
+                // Everyone in the room when we joined; user_joined and
+                // user_left keep it current from here
+                Array.from(connectedUsers.keys()).forEach((uid) => {
+                    if (!data.users.includes(uid)) {
+                        removeUser(uid);
+                    }
+                });
+                data.users.forEach((uid) => {
+                    if (uid !== userId) {
+                        addUser(uid);
+                    }
+                });
+                break;
+
+            case 'batch':
+                // Frames the server had queued for us, oldest first
+                data.frames.forEach(handleMessage);
+                break;
+        }
+    }
+
+    // Positions and lengths on the wire count code points, like Python
+    // strings on the server; CodeMirror counts UTF-16 units. They only differ
+    // once the document holds characters outside the BMP (emoji and the like),
+    // which `astral` tracks so the common case skips the conversion.
+    const SURROGATE_PAIR = /[\uD800-\uDBFF][\uDC00-\uDFFF]/g;
+    let astral = false;
+
+    function pointLength(text) {
+        return text.length - (text.match(SURROGATE_PAIR) || []).length;
+    }
+
+    function toPoint(doc, pos) {
+        if (!astral) return doc.indexFromPos(pos);
+        return pointLength(doc.getRange({ line: 0, ch: 0 }, pos));
+    }
+
+    function fromPoint(doc, point) {
+        if (!astral) return doc.posFromIndex(point);
+        const text = doc.getValue();
+        let index = 0;
+        for (let i = 0; i < point && index < text.length; i++) {
+            const code = text.charCodeAt(index);
+            index += code >= 0xD800 && code <= 0xDBFF && index + 1 < text.length ? 2 : 1;
+        }
+        return doc.posFromIndex(index);
+    }
+
+    // Mirrors editor/ot.py: returns [a', b'] so that a then b' equals b then a'.
+    // On an insert tie a goes first; remote operations are always passed as a.
+    function transform(a, b) {
+        if (a.operation === 'insert' && b.operation === 'insert') {
+            if (a.position <= b.position) {
+                return [a, insertOp(b.position + a.length, b.text)];
+            }
+            return [insertOp(a.position + b.length, a.text), b];
+        }
+        if (a.operation === 'insert') {
+            return transformInsertDelete(a, b);
+        }
+        if (b.operation === 'insert') {
+            const [bPrime, aPrime] = transformInsertDelete(b, a);
+            return [aPrime, bPrime];
+        }
+        return [deleteAfterDelete(a, b), deleteAfterDelete(b, a)];
+    }
+
+    function transformInsertDelete(ins, del) {
+        if (ins.position <= del.position) {
+            return [ins, deleteOp(del.position + ins.length, del.length)];
+        }
+        if (ins.position >= del.position + del.length) {
+            return [insertOp(ins.position - del.length, ins.text), del];
+        }
+        return [insertOp(del.position, ''), deleteOp(del.position, del.length + ins.length)];
+    }
+
+    function deleteAfterDelete(op, applied) {
+        const shift = (offset) => {
+            if (offset <= applied.position) return offset;
+            if (offset <= applied.position + applied.length) return applied.position;
+            return offset - applied.length;
+        };
+        const start = shift(op.position);
+        return deleteOp(start, shift(op.position + op.length) - start);
+    }
+
+    function insertOp(position, text) {
+        return { operation: 'insert', position: position, text: text, length: pointLength(text) };
+    }
+
+    function deleteOp(position, length) {
+        return { operation: 'delete', position: position, text: '', length: length };
+    }
+
+    function queueOperation(op) {
+        // Keystrokes typed while waiting for an ack go out as one operation
+        const last = pending[pending.length - 1];
+        if (last && last.operation === 'insert' && op.operation === 'insert'
+                && op.position === last.position + last.length) {
+            last.text += op.text;
+            last.length += op.length;
+        } else if (last && last.operation === 'delete' && op.operation === 'delete'
+                && (op.position === last.position || op.position + op.length === last.position)) {
+            last.position = Math.min(last.position, op.position);
+            last.length += op.length;
+        } else {
+            pending.push(op);
         }
     }
 
+    function sendNextOperation() {
+        if (inflight || pending.length === 0 || !socket || socket.readyState !== WebSocket.OPEN) return;
+        
+        inflight = pending.shift();
+        inflightSeq = nextSeq++;
+        sendFrame({
+            type: 'text_change',
+            revision: revision,
+            seq: inflightSeq,
+            operation: inflight.operation,
+            position: inflight.position,
+            text: inflight.text,
+            length: inflight.length
+        });
+    }
+
     function applyRemoteChange(data) {
+        // Rebase the server operation over our unacknowledged local edits
+        let op = insertOrDelete(data);
+        if (inflight) {
+            [op, inflight] = transform(op, inflight);
+        }
+        pending = pending.map((local) => {
+            let rebased;
+            [op, rebased] = transform(op, local);
+            return rebased;
+        });
+        
         isLocalChange = true;
         const doc = editor.getDoc();
-        
-        switch(data.operation) {
-            case 'insert':
-                const pos = doc.posFromIndex(data.position);
-                doc.replaceRange(data.text, pos);
-                break;
-                
-            case 'delete':
-                const from = doc.posFromIndex(data.position);
-                const to = doc.posFromIndex(data.position + data.length);
-                doc.replaceRange('', from, to);
-                break;
-                
-            case 'replace':
-                editor.setValue(data.content);
-                break;
+        const from = fromPoint(doc, op.position);
+        if (op.operation === 'insert') {
+            astral = astral || /[\uD800-\uDFFF]/.test(op.text);
+            doc.replaceRange(op.text, from);
+        } else if (op.length > 0) {
+            doc.replaceRange('', from, fromPoint(doc, op.position + op.length));
         }
-        
         isLocalChange = false;
     }
 
+    function insertOrDelete(data) {
+        if (data.operation === 'insert') {
+            return insertOp(data.position, data.text);
+        }
+        return deleteOp(data.position, data.length);
+    }
+
     editor.on('change', (instance, changeObj) => {
-        if (isLocalChange || !socket || socket.readyState !== WebSocket.OPEN) return;
+        // Edits made while disconnected are queued and sent after a resume
+        if (isLocalChange) return;
         
         const doc = instance.getDoc();
-        const from = doc.indexFromPos(changeObj.from);
-        const content = instance.getValue();
-        
-        let operation, text, length;
-        
-        if (changeObj.origin === '+input' || changeObj.origin === 'paste') {
-            operation = 'insert';
-            text = changeObj.text.join('\n');
-        } else if (changeObj.origin === '+delete' || changeObj.origin === 'cut') {
-            operation = 'delete';
-            text = '';
-            length = changeObj.removed.join('\n').length;
-        } else {
-            operation = 'replace';
-            text = changeObj.text.join('\n');
-        }
+        const text = changeObj.text.join('\n');
+        const removed = changeObj.removed.join('\n');
+        // The text before the change is untouched, so this is its old offset
+        const from = toPoint(doc, changeObj.from);
+        const length = pointLength(removed);
+        astral = astral || /[\uD800-\uDFFF]/.test(text);
         
-        socket.send(JSON.stringify({
-            type: 'text_change',
-            operation: operation,
-            position: from,
-            text: text,
-            length: length,
-            content: content
-        }));
+        // Only the delta goes over the wire, the server keeps the full text.
+        // A replacement is sent as a delete followed by an insert.
+        if (length > 0) {
+            queueOperation(deleteOp(from, length));
+        }
+        if (text !== '') {
+            queueOperation(insertOp(from, text));
+        }
+        sendNextOperation();
     });
 
     editor.on('cursorActivity', () => {
@@ -148,22 +368,43 @@
         
         const doc = editor.getDoc();
         const cursor = doc.getCursor();
-        const position = doc.indexFromPos(cursor);
+        const position = toPoint(doc, cursor);
         
         let selection = null;
         if (doc.somethingSelected()) {
-            const from = doc.indexFromPos(doc.getCursor('from'));
-            const to = doc.indexFromPos(doc.getCursor('to'));
+            const from = toPoint(doc, doc.getCursor('from'));
+            const to = toPoint(doc, doc.getCursor('to'));
             selection = { from, to };
         }
         
-        socket.send(JSON.stringify({
+        sendFrame({
             type: 'cursor_position',
             position: position,
             selection: selection
-        }));
+        });
     });
 
+    // Lets the server send us full cursors only for the lines we can see
+    let viewportTimer = null;
+    function sendViewport() {
+        if (!socket || socket.readyState !== WebSocket.OPEN) return;
+        
+        const info = editor.getScrollInfo();
+        sendFrame({
+            type: 'viewport',
+            from_line: editor.lineAtHeight(info.top, 'local'),
+            to_line: editor.lineAtHeight(info.top + info.clientHeight, 'local')
+        });
+    }
+
+    function scheduleViewport() {
+        clearTimeout(viewportTimer);
+        viewportTimer = setTimeout(sendViewport, 100);
+    }
+
+    editor.on('scroll', scheduleViewport);
+    window.addEventListener('resize', scheduleViewport);
+
     function addUser(uid) {
         if (!connectedUsers.has(uid)) {
             const color = userColors[connectedUsers.size % userColors.length];
@@ -189,13 +430,24 @@
             badge.style.background = user.color + '33';
             badge.style.color = user.color;
             badge.textContent = `User ${uid.toString().substring(0, 4)}`;
+            if (user.line !== null && user.line !== undefined) {
+                badge.textContent += ` · L${user.line + 1}`;
+            }
             usersList.appendChild(badge);
         });
     }
 
+    function setOffscreenLine(uid, line) {
+        const user = connectedUsers.get(uid);
+        if (user && user.line !== line) {
+            user.line = line;
+            updateUsersList();
+        }
+    }
+
     function updateRemoteCursor(uid, position, selection) {
         const doc = editor.getDoc();
-        const pos = doc.posFromIndex(position);
+        const pos = fromPoint(doc, position);
         const coords = editor.cursorCoords(pos, 'local');
         
         let cursorEl = remoteCursors.get(uid);
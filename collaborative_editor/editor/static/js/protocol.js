@@ -0,0 +1,195 @@
+// Binary frame codec, the client half of editor/protocol.py. A frame is a
+// one-byte opcode followed by its fields: unsigned LEB128 varints and
+// length-prefixed UTF-8 strings.
+window.EditorProtocol = (function () {
+    const SUBPROTOCOL = 'editor.binary';
+
+    const SCHEMAS = {
+        document_content: [1, [['content', 'str'], ['revision', 'uint'], ['epoch', 'str'], ['user_id', 'user']]],
+        replay: [2, [
+            ['operations', ['list', [
+                ['revision', 'uint'], ['user_id', 'user'], ['client_id', 'str?'], ['seq', 'uint?'], [null, 'operation']
+            ]]],
+            ['revision', 'uint'], ['epoch', 'str'], ['user_id', 'user']
+        ]],
+        ack: [3, [['revision', 'uint']]],
+        text_change: [4, [['user_id', 'user'], ['revision', 'uint'], ['seq', 'uint?'], [null, 'operation']]],
+        cursors: [5, [
+            ['cursors', ['list', [['user_id', 'user'], ['position', 'uint'], ['selection', 'selection']]]],
+            ['offscreen', ['list', [['user_id', 'user'], ['line', 'uint']]]]
+        ]],
+        user_joined: [6, [['user_id', 'user']]],
+        user_left: [7, [['user_id', 'user']]],
+        cursor_position: [8, [['position', 'uint'], ['selection', 'selection']]],
+        viewport: [9, [['from_line', 'uint'], ['to_line', 'uint']]],
+        resync: [10, []],
+        batch: [11, [['frames', 'frames']]],
+        presence: [12, [['users', 'users']]]
+    };
+
+    const OPCODES = {};
+    Object.keys(SCHEMAS).forEach((name) => {
+        OPCODES[SCHEMAS[name][0]] = [name, SCHEMAS[name][1]];
+    });
+
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function writeUint(out, value) {
+        while (value > 0x7f) {
+            out.push((value % 0x80) | 0x80);
+            value = Math.floor(value / 0x80);
+        }
+        out.push(value);
+    }
+
+    function writeBytes(out, bytes, extra) {
+        writeUint(out, bytes.length + extra);
+        for (let i = 0; i < bytes.length; i++) out.push(bytes[i]);
+    }
+
+    function writeField(out, frame, key, kind) {
+        const value = key === null ? null : frame[key];
+        if (kind === 'uint') {
+            writeUint(out, value);
+        } else if (kind === 'str') {
+            writeBytes(out, textEncoder.encode(value), 0);
+        } else if (kind === 'uint?') {
+            writeUint(out, value === null || value === undefined ? 0 : value + 1);
+        } else if (kind === 'str?') {
+            if (value === null || value === undefined) out.push(0);
+            else writeBytes(out, textEncoder.encode(value), 1);
+        } else if (kind === 'user') {
+            writeUint(out, value === null || value === undefined ? 0 : value === 'anonymous' ? 1 : value + 2);
+        } else if (kind === 'selection') {
+            if (value) {
+                out.push(1);
+                writeUint(out, value.from);
+                writeUint(out, value.to);
+            } else {
+                out.push(0);
+            }
+        } else if (kind === 'users') {
+            writeUint(out, value.length);
+            value.forEach((userId) => writeField(out, { user_id: userId }, 'user_id', 'user'));
+        } else if (kind === 'frames') {
+            writeUint(out, value.length);
+            value.forEach((item) => {
+                const bytes = encode(item);
+                writeBytes(out, bytes, 0);
+            });
+        } else if (kind === 'operation') {
+            if (frame.operation === 'insert') {
+                out.push(0);
+                writeUint(out, frame.position);
+                writeBytes(out, textEncoder.encode(frame.text), 0);
+            } else {
+                out.push(1);
+                writeUint(out, frame.position);
+                writeUint(out, frame.length);
+            }
+        } else {
+            writeUint(out, value.length);
+            value.forEach((item) => {
+                kind[1].forEach(([itemKey, itemKind]) => writeField(out, item, itemKey, itemKind));
+            });
+        }
+    }
+
+    function encode(frame) {
+        const [opcode, fields] = SCHEMAS[frame.type];
+        const out = [opcode];
+        fields.forEach(([key, kind]) => writeField(out, frame, key, kind));
+        return new Uint8Array(out);
+    }
+
+    function Reader(bytes) {
+        let offset = 0;
+        this.uint = () => {
+            let result = 0;
+            let scale = 1;
+            while (true) {
+                const byte = bytes[offset++];
+                result += (byte & 0x7f) * scale;
+                if (byte < 0x80) return result;
+                scale *= 0x80;
+            }
+        };
+        this.bytes = (length) => {
+            const chunk = bytes.subarray(offset, offset + length);
+            offset += length;
+            return chunk;
+        };
+        this.str = (length) => {
+            const size = length === undefined ? this.uint() : length;
+            const value = textDecoder.decode(bytes.subarray(offset, offset + size));
+            offset += size;
+            return value;
+        };
+    }
+
+    function readField(reader, frame, key, kind) {
+        if (kind === 'uint') {
+            frame[key] = reader.uint();
+        } else if (kind === 'str') {
+            frame[key] = reader.str();
+        } else if (kind === 'uint?') {
+            const value = reader.uint();
+            frame[key] = value === 0 ? null : value - 1;
+        } else if (kind === 'str?') {
+            const length = reader.uint();
+            frame[key] = length === 0 ? null : reader.str(length - 1);
+        } else if (kind === 'user') {
+            const value = reader.uint();
+            frame[key] = value === 0 ? null : value === 1 ? 'anonymous' : value - 2;
+        } else if (kind === 'selection') {
+            frame[key] = reader.uint() ? { from: reader.uint(), to: reader.uint() } : null;
+        } else if (kind === 'users') {
+            const count = reader.uint();
+            const users = [];
+            for (let i = 0; i < count; i++) {
+                readField(reader, frame, key, 'user');
+                users.push(frame[key]);
+            }
+            frame[key] = users;
+        } else if (kind === 'frames') {
+            const count = reader.uint();
+            const frames = [];
+            for (let i = 0; i < count; i++) {
+                frames.push(decode(reader.bytes(reader.uint())));
+            }
+            frame[key] = frames;
+        } else if (kind === 'operation') {
+            const isDelete = reader.uint();
+            frame.operation = isDelete ? 'delete' : 'insert';
+            frame.position = reader.uint();
+            if (isDelete) {
+                frame.text = '';
+                frame.length = reader.uint();
+            } else {
+                frame.text = reader.str();
+                // Code points, like the server counts them
+                frame.length = [...frame.text].length;
+            }
+        } else {
+            const count = reader.uint();
+            const items = [];
+            for (let i = 0; i < count; i++) {
+                const item = {};
+                kind[1].forEach(([itemKey, itemKind]) => readField(reader, item, itemKey, itemKind));
+                items.push(item);
+            }
+            frame[key] = items;
+        }
+    }
+
+    function decode(buffer) {
+        const reader = new Reader(new Uint8Array(buffer));
+        const [type, fields] = OPCODES[reader.uint()];
+        const frame = { type: type };
+        fields.forEach(([key, kind]) => readField(reader, frame, key, kind));
+        return frame;
+    }
+
+    return { SUBPROTOCOL, encode, decode };
+})();
@@ -0,0 +1,205 @@
+# Multi-process test harness for the sharded workers (see editor.sharding).
+# Broker is a local stand-in for Redis: one process holds the channel queues
+# and groups, and other processes reach them over TCP through
+# BrokerChannelLayer, with messages packed by msgpack as channels_redis does.
+# `python -m editor.testing PORT DATABASE [SETTINGS]` runs one worker process
+# against a broker and a SQLite file until it gets SIGTERM.
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import string
+import sys
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+def _pack(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _unpacker():
+    return msgpack.Unpacker(raw=False, strict_map_key=False)
+
+
+class Broker:
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.channels = {}  # channel -> asyncio.Queue
+        self.groups = {}  # group -> set of channels
+        self.server = None
+        self.connections = {}  # writer -> task serving it
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    def _queue(self, channel):
+        return self.channels.setdefault(channel, asyncio.Queue(self.capacity))
+
+    async def _serve(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        unpacker, tasks = _unpacker(), set()
+        try:
+            while data := await reader.read(65536):
+                unpacker.feed(data)
+                for request_id, op, args in unpacker:
+                    # Started in arrival order; only receive ever waits
+                    task = asyncio.create_task(self._handle(writer, request_id, op, args))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def _handle(self, writer, request_id, op, args):
+        try:
+            reply = [request_id, None, await getattr(self, 'op_' + op)(*args)]
+        except ChannelFull:
+            reply = [request_id, 'full', None]
+        if not writer.is_closing():
+            writer.write(_pack(reply))
+
+    async def op_send(self, channel, message):
+        try:
+            self._queue(channel).put_nowait(message)
+        except asyncio.QueueFull:
+            raise ChannelFull(channel)
+
+    async def op_receive(self, channel):
+        return await self._queue(channel).get()
+
+    async def op_group_add(self, group, channel):
+        self.groups.setdefault(group, set()).add(channel)
+
+    async def op_group_discard(self, group, channel):
+        self.groups.get(group, set()).discard(channel)
+
+    async def op_group_send(self, group, message):
+        for channel in list(self.groups.get(group, ())):
+            try:
+                self._queue(channel).put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+    async def op_flush(self):
+        self.channels, self.groups = {}, {}
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, host='127.0.0.1', port=6379, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}  # request id -> future
+        self._ids = itertools.count()
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        if self._writer is None or self._writer.is_closing() or self._reader_task.get_loop() is not loop:
+            reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            self._reader_task = loop.create_task(self._read(reader))
+        return self._writer
+
+    async def _read(self, reader):
+        unpacker = _unpacker()
+        while data := await reader.read(65536):
+            unpacker.feed(data)
+            for request_id, error, result in unpacker:
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((error, result))
+
+    async def _call(self, op, *args):
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        writer.write(_pack([request_id, op, list(args)]))
+        error, result = await future
+        if error == 'full':
+            raise ChannelFull(args[0])
+        return result
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.broker!' + ''.join(random.choice(string.ascii_letters) for _ in range(12))
+
+    async def send(self, channel, message):
+        self.require_valid_channel_name(channel)
+        await self._call('send', channel, message)
+
+    async def receive(self, channel):
+        # A cancelled receive may still take one message off the broker
+        self.require_valid_channel_name(channel)
+        return await self._call('receive', channel)
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        await self._call('group_add', group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        await self._call('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        self.require_valid_group_name(group)
+        await self._call('group_send', group, message)
+
+    async def flush(self):
+        await self._call('flush')
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def serve_worker():
+    from .sharding import get_worker
+
+    worker = get_worker()
+    await worker.start()
+    print(worker.channel, flush=True)
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    await stopping.wait()
+    await worker.stop()
+
+
+def main(port, database, overrides='{}'):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'collaborative_editor.settings')
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = database
+    settings.CHANNEL_LAYERS = {'default': {
+        'BACKEND': 'editor.layers.HybridChannelLayer',
+        'CONFIG': {'backend': {'BACKEND': 'editor.testing.BrokerChannelLayer', 'CONFIG': {'port': int(port)}}},
+    }}
+    for name, value in json.loads(overrides).items():
+        setattr(settings, name, value)
+    django.setup()
+    asyncio.run(serve_worker())
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
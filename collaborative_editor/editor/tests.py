@@ -1,3 +1,1485 @@
-from django.test import TestCase
+import asyncio
+import difflib
+import json
+import os
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.db import connection
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import re_path, reverse
+from django.utils import timezone
+
+from .broadcast import fan_out
+from .buffer import MAX_CHUNK, Rope
+from .consumers import EditorConsumer
+from .cursors import ViewportIndex
+from .diff import compare_versions, diff_lines, hunks
+from .history import compact, document_at
+from . import metrics
+from .layers import HybridChannelLayer
+from .limits import FRAME_TOO_LARGE, ROOM_FULL, TokenBucket, merge_edits
+from .models import Document, DocumentCollaborator, DocumentOperation, DocumentVersion
+from .ot import InvalidOperation, Operation, transform
+from .outbox import Outbox
+from .permissions import permission_level
+from .persistence import WriteBehind
+from .protocol import BINARY_SUBPROTOCOL, ProtocolError, decode_binary, encode_binary
+from .rooms import Room, RoomManager, get_room
+from .sharding import HashRing, get_worker
+from .testing import Broker, BrokerChannelLayer
+from .trace import recorder
+from .management.commands.replay_trace import Command as ReplayTrace, read_trace
+from .routing import websocket_urlpatterns
+from .versions import store_version, stored_size, version_content
+from .views import DOCUMENTS_PER_PAGE
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+async def receive_frame(communicator):
+    # Frames written in the same tick arrive as one batch
+    queued = communicator.__dict__.setdefault('queued_frames', [])
+    if not queued:
+        data = await communicator.receive_from()
+        frame = decode_binary(data) if isinstance(data, bytes) else json.loads(data)
+        queued += frame['frames'] if frame['type'] == 'batch' else [frame]
+    return queued.pop(0)
+
+
+def random_operation(rng, content):
+    if content and rng.random() < 0.4:
+        position = rng.randrange(len(content))
+        return Operation.delete(position, rng.randint(1, min(4, len(content) - position)))
+    text = ''.join(rng.choice('abcxyz\n') for _ in range(rng.randint(1, 3)))
+    return Operation.insert(rng.randint(0, len(content)), text)
+
+
+class SimulatedClient:
+    # Python twin of the client OT state machine in static/js/editor.js
+
+    def __init__(self, content, revision):
+        self.content = content
+        self.revision = revision
+        self.inflight = None
+        self.pending = []
+        self.inbox = []
+        self.outbox = []
+
+    def edit(self, operation):
+        self.content = operation.apply(self.content)
+        self.pending.append(operation)
+        self.send_next()
+
+    def send_next(self):
+        if self.inflight is None and self.pending:
+            self.inflight = self.pending.pop(0)
+            self.outbox.append((self.inflight, self.revision))
+
+    def receive(self):
+        kind, revision, operation = self.inbox.pop(0)
+        self.revision = revision
+        if kind == 'ack':
+            self.inflight = None
+            self.send_next()
+            return
+        if self.inflight is not None:
+            operation, self.inflight = transform(operation, self.inflight)
+        rebased = []
+        for local in self.pending:
+            operation, local = transform(operation, local)
+            rebased.append(local)
+        self.pending = rebased
+        self.content = operation.apply(self.content)
+
+
+class OperationalTransformTests(TestCase):
+    def test_transform_converges_for_random_pairs(self):
+        rng = random.Random(1234)
+        for _ in range(5000):
+            content = ''.join(rng.choice('abcdef') for _ in range(rng.randint(0, 12)))
+            a, b = random_operation(rng, content), random_operation(rng, content)
+            a_prime, b_prime = transform(a, b)
+            self.assertEqual(
+                b_prime.apply(a.apply(content)), a_prime.apply(b.apply(content)),
+                f'{content!r}: {a} / {b}'
+            )
+
+    def test_positions_count_code_points(self):
+        # Clients convert CodeMirror's UTF-16 offsets to code points, so an
+        # emoji (a surrogate pair in JavaScript) is one position here
+        room = Room('doc', '😀 hi 😀')
+        room.submit(Operation.from_message({'operation': 'insert', 'position': 3, 'text': '🎉'}), 0)
+        room.submit(Operation.from_message({'operation': 'delete', 'position': 5, 'length': 1}), 0)
+        self.assertEqual(room.content, '😀 h🎉i ')
+        frame = {'type': 'text_change', 'user_id': 1, 'revision': 1, 'seq': None,
+                 'operation': 'insert', 'position': 1, 'text': '👍🏽', 'length': 2}
+        self.assertEqual(decode_binary(encode_binary(frame)), frame)
+
+    def test_concurrent_sessions_converge(self):
+        for seed in range(2000):
+            rng = random.Random(seed)
+            room = Room('doc', 'hello world')
+            clients = [SimulatedClient(room.content, room.revision) for _ in range(rng.randint(2, 4))]
+            for _ in range(rng.randint(5, 40)):
+                client = rng.choice(clients)
+                roll = rng.random()
+                if roll < 0.4:
+                    client.edit(random_operation(rng, client.content))
+                elif roll < 0.7 and client.outbox:
+                    self.deliver(room, clients, client)
+                elif client.inbox:
+                    client.receive()
+            while any(c.outbox or c.inbox for c in clients):
+                for client in clients:
+                    if client.outbox:
+                        self.deliver(room, clients, client)
+                    while client.inbox:
+                        client.receive()
+            for client in clients:
+                self.assertEqual(client.content, room.content, f'seed {seed}')
+                self.assertEqual(client.revision, room.revision, f'seed {seed}')
+
+    def deliver(self, room, clients, sender):
+        operation, revision = sender.outbox.pop(0)
+        operation = room.submit(operation, revision)
+        for client in clients:
+            if client is sender:
+                client.inbox.append(('ack', room.revision, None))
+            else:
+                client.inbox.append(('op', room.revision, operation))
+
+    def test_room_rejects_stale_or_invalid_operations(self):
+        room = Room('doc', 'abc')
+        with self.assertRaises(InvalidOperation):
+            room.submit(Operation.delete(2, 5), 0)
+        with self.assertRaises(InvalidOperation):
+            room.submit(Operation.insert(0, 'x'), 3)
+        with self.assertRaises(InvalidOperation):
+            Operation.from_message({'operation': 'replace', 'position': 0})
+        self.assertEqual((room.content, room.revision), ('abc', 0))
+
+
+class RopeTests(TestCase):
+    def test_matches_string_slicing(self):
+        rng = random.Random(42)
+        text = ''.join(rng.choice('ab\ncd') for _ in range(5 * MAX_CHUNK))
+        rope = Rope(text)
+        for _ in range(500):
+            if rng.random() < 0.4:
+                position = rng.randrange(len(text))
+                length = rng.randint(0, min(2 * MAX_CHUNK, len(text) - position))
+                text = text[:position] + text[position + length:]
+                rope.delete(position, length)
+            else:
+                position = rng.randint(0, len(text))
+                insert = 'xy\n' * rng.choice([1, 50, MAX_CHUNK])
+                text = text[:position] + insert + text[position:]
+                rope.insert(position, insert)
+            self.assertEqual(len(rope), len(text))
+            start = rng.randint(0, len(text))
+            self.assertEqual(rope.substring(start, start + 100), text[start:start + 100])
+            self.assertEqual(rope.line_of(start), text.count('\n', 0, start))
+        self.assertEqual(str(rope), text)
+
+    def test_line_index(self):
+        rope = Rope('one\ntwo\n\nfour')
+        self.assertEqual(rope.line_count, 4)
+        self.assertEqual([rope.line_start(line) for line in range(4)], [0, 4, 8, 9])
+        self.assertEqual(rope.line_of(5), 1)
+        with self.assertRaises(IndexError):
+            rope.line_start(4)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.documents = [
+            Document.objects.create(title=f'Doc {i}', content='', created_by=owner) for i in range(3)
+        ]
+
+    async def test_coalesces_edits_per_document(self):
+        engine = WriteBehind()
+        rooms = [Room(str(doc.id), '') for doc in self.documents]
+        for i in range(50):
+            for room in rooms:
+                room.submit(Operation.insert(i, 'x'), room.revision)
+                engine.mark_dirty(room)
+        self.assertEqual(len(engine.dirty), 3)
+
+        self.assertEqual(await engine.flush(), 3)
+        self.assertFalse(engine.dirty)
+        async for doc in Document.objects.all():
+            self.assertEqual(doc.content, 'x' * 50)
+
+    def test_write_only_touches_content(self):
+        snapshot = {
+            str(doc.id): {'content': 'new', 'revision': 1, 'operations': [], 'checkpoint': False, 'base': None, 'author': None}
+            for doc in self.documents
+        }
+        with CaptureQueriesContext(connection) as queries:
+            WriteBehind.write(snapshot)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+        self.assertNotIn('"title"', updates[0])
+        self.assertEqual(Document.objects.filter(content='new').count(), 3)
+
+    @override_settings(EDITOR_FLUSH_INTERVAL=10, EDITOR_IDLE_FLUSH=1)
+    def test_due_after_interval_or_idle(self):
+        engine = WriteBehind()
+        engine.dirty['busy'] = [None, 2, 9.5]
+        engine.dirty['idle'] = [None, 5, 5]
+        engine.dirty['old'] = [None, 0, 10]
+        self.assertEqual(sorted(engine.due(now=10)), ['idle', 'old'])
+
+
+class OperationLogTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.document = Document.objects.create(title='Log', content='', created_by=self.owner)
+        self.room = Room(str(self.document.id), '', owner_id=self.owner.id)
+        # contents[r] is the text at revision r
+        self.contents = ['']
+        rng = random.Random(3)
+        engine = WriteBehind()
+        with self.settings(EDITOR_CHECKPOINT_OPS=10):
+            for _ in range(8):
+                for _ in range(4):
+                    operation = random_operation(rng, self.room.content)
+                    self.room.submit(operation, self.room.revision, self.owner.id)
+                    self.contents.append(self.room.content)
+                engine.write({self.room.document_id: engine.take_snapshot(self.room)})
+
+    def test_flush_appends_log_and_checkpoints(self):
+        self.assertEqual(DocumentOperation.objects.filter(document=self.document).count(), 32)
+        checkpoints = DocumentVersion.objects.filter(document=self.document).order_by('revision')
+        self.assertEqual([version.revision for version in checkpoints], [0, 4, 16, 28])
+        self.document.refresh_from_db()
+        self.assertEqual((self.document.revision, self.document.content), (32, self.contents[32]))
+
+    def test_any_revision_costs_one_checkpoint_and_bounded_replay(self):
+        # From the base content the log started at
+        for revision in range(33):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(document_at(self.document.id, revision), self.contents[revision])
+            # Checkpoint, its delta chain when it is not the newest, operations
+            self.assertEqual(len(queries), 2 if revision >= 28 else 3)
+
+    def test_compaction_folds_old_operations_into_a_checkpoint(self):
+        old = timezone.now() - timedelta(days=30)
+        DocumentOperation.objects.filter(document=self.document, revision__lte=20).update(created_at=old)
+        self.assertEqual(compact(self.document.id, old + timedelta(seconds=1)), 20)
+
+        self.assertEqual(DocumentOperation.objects.filter(document=self.document).count(), 12)
+        self.assertTrue(DocumentVersion.objects.filter(document=self.document, revision=20).exists())
+        for revision in (16, 20, 25, 32):
+            self.assertEqual(document_at(self.document.id, revision), self.contents[revision])
+        with self.assertRaises(LookupError):
+            document_at(self.document.id, 18)
+
+
+class VersionStorageTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.document = Document.objects.create(title='Versions', content='', created_by=self.owner)
+        rng = random.Random(5)
+        lines = [f'line {i}\n' for i in range(300)]
+        self.contents = []
+        for _ in range(12):
+            for _ in range(3):
+                lines[rng.randrange(len(lines))] = f'edited {rng.random()}\n'
+            self.contents.append(''.join(lines))
+
+    def store_all(self):
+        for content in self.contents:
+            store_version(self.document.id, content, created_by=self.owner)
+        return list(DocumentVersion.objects.filter(document=self.document).order_by('id'))
+
+    @override_settings(EDITOR_VERSION_KEYFRAME=5)
+    def test_reverse_deltas_with_keyframes(self):
+        versions = self.store_all()
+        self.assertEqual(
+            [version.storage for version in versions],
+            (['delta'] * 4 + ['full']) * 2 + ['delta', 'full']
+        )
+        for version, content in zip(versions, self.contents):
+            with self.assertNumQueries(1 if version.storage == 'delta' else 0):
+                self.assertEqual(version_content(version), content)
+        full = sum(len(content) for content in self.contents)
+        self.assertLess(sum(stored_size(version) for version in versions), full / 5)
+
+    @override_settings(EDITOR_VERSION_KEYFRAME=4, EDITOR_VERSION_COMPRESSION=False)
+    def test_compress_versions_command_rewrites_full_rows(self):
+        for content in self.contents:
+            DocumentVersion.objects.create(document=self.document, content=content, created_by=self.owner)
+        out = StringIO()
+        with self.settings(EDITOR_VERSION_COMPRESSION=True):
+            call_command('compress_versions', stdout=out)
+        self.assertIn('saved', out.getvalue())
+        versions = list(DocumentVersion.objects.filter(document=self.document).order_by('id'))
+        self.assertEqual([version.storage for version in versions].count('full'), 3)
+        self.assertEqual([version_content(version) for version in versions], self.contents)
+
+
+class VersionDiffTests(TestCase):
+    def test_myers_diff_is_minimal(self):
+        rng = random.Random(11)
+        for _ in range(500):
+            old = [rng.choice('abcd') for _ in range(rng.randint(0, 12))]
+            new = [rng.choice('abcd') for _ in range(rng.randint(0, 12))]
+            opcodes = diff_lines(old, new)
+            rebuilt, kept = [], 0
+            for tag, i1, i2, j1, j2 in opcodes:
+                rebuilt += new[j1:j2]
+                if tag == 'equal':
+                    self.assertEqual(old[i1:i2], new[j1:j2])
+                    kept += i2 - i1
+            self.assertEqual(rebuilt, new)
+            matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+            self.assertGreaterEqual(kept, sum(block.size for block in matcher.get_matching_blocks()))
+
+    def test_hunks_match_unified_diff(self):
+        old = [f'line {i}' for i in range(40)]
+        new = old[:5] + ['inserted'] + old[5:20] + old[21:38] + ['changed'] + old[39:]
+        lines = [line for hunk in hunks(old, new, diff_lines(old, new)) for line in hunk['lines']]
+        expected = [line for line in difflib.unified_diff(old, new, lineterm='') if line[:2] not in ('--', '++', '@@')]
+        self.assertEqual(lines, expected)
+
+    def test_compare_endpoint(self):
+        compare_versions.cache_clear()
+        owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        User.objects.create_user('outsider', 'outsider@example.com', 'pw')
+        document = Document.objects.create(title='Diff', content='', created_by=owner)
+        first = store_version(document.id, 'a\nb\nc\n', created_by=owner)
+        second = store_version(document.id, 'a\nB\nc\nd\n', created_by=owner)
+        url = reverse('compare_versions', args=[document.id, first.id, second.id])
+
+        self.client.login(username='owner', password='pw')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['added'], data['removed']), (2, 1))
+        self.assertEqual(data['hunks'][0]['lines'], [' a', '-b', '+B', ' c', '+d'])
+        # Served from the cache: no version contents are read again
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).json(), data)
+        self.assertFalse([q for q in queries if 'data' in q['sql'] and 'editor_documentversion' in q['sql']])
+        # The cache size is read when comparing, so it can be turned off at runtime
+        with self.settings(EDITOR_DIFF_CACHE_SIZE=0), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).json(), data)
+        self.assertTrue([q for q in queries if 'data' in q['sql'] and 'editor_documentversion' in q['sql']])
+
+        other = Document.objects.create(title='Other', content='', created_by=owner)
+        self.assertEqual(
+            self.client.get(reverse('compare_versions', args=[other.id, first.id, second.id])).status_code, 404
+        )
+        self.client.login(username='outsider', password='pw')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class PermissionTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.user = User.objects.create_user('user', 'user@example.com', 'pw')
+        self.document = Document.objects.create(title='Doc', content='', created_by=self.owner)
+
+    def test_levels_are_cached_until_collaborators_change(self):
+        self.assertEqual(permission_level(self.document.id, self.owner), 'owner')
+        with self.assertNumQueries(0):
+            self.assertIsNone(permission_level(self.document.id, self.user))
+            self.assertIsNone(permission_level(self.document.id, AnonymousUser()))
+
+        collaborator = DocumentCollaborator.objects.create(
+            document=self.document, user=self.user, permission_level='view', added_by=self.owner
+        )
+        self.assertEqual(permission_level(self.document.id, self.user), 'view')
+        collaborator.permission_level = 'edit'
+        collaborator.save()
+        self.assertEqual(permission_level(self.document.id, self.user), 'edit')
+        collaborator.delete()
+        self.assertIsNone(permission_level(self.document.id, self.user))
+
+    def test_editor_view_resolves_permissions_once(self):
+        self.client.login(username='owner', password='pw')
+        url = reverse('editor', args=[self.document.id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertTrue(response.context['is_owner'])
+        self.assertFalse([q for q in queries if 'editor_documentcollaborator' in q['sql']])
+
+    def test_owner_adds_collaborator_and_changes_permission(self):
+        self.client.login(username='owner', password='pw')
+        response = self.client.post(
+            reverse('add_collaborator', args=[self.document.id]),
+            json.dumps({'user_id': self.user.id, 'permission_level': 'view'}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        collaborator = response.json()['collaborator']
+        self.assertEqual(collaborator['permission_level'], 'view')
+        self.assertEqual(permission_level(self.document.id, self.user), 'view')
+
+        url = reverse('update_collaborator_permission', args=[self.document.id, collaborator['id']])
+        response = self.client.post(url, json.dumps({'permission_level': 'edit'}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(permission_level(self.document.id, self.user), 'edit')
+        response = self.client.post(url, json.dumps({'permission_level': 'admin'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # Only the owner manages collaborators
+        self.client.login(username='user', password='pw')
+        response = self.client.post(url, json.dumps({'permission_level': 'view'}), content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class DocumentListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'pw')
+        other = User.objects.create_user('other', 'other@example.com', 'pw')
+        for i in range(30):
+            owned = Document.objects.create(title=f'Mine {i}', content='x' * 1000, created_by=self.user)
+            DocumentCollaborator.objects.create(document=owned, user=other, added_by=self.user)
+            shared = Document.objects.create(title=f'Theirs {i}', content='x' * 1000, created_by=other)
+            DocumentCollaborator.objects.create(document=shared, user=self.user, added_by=other)
+        # Several documents share a timestamp so the id tie-break is exercised
+        Document.objects.filter(title__in=['Mine 3', 'Mine 4', 'Mine 5']).update(
+            updated_at=Document.objects.get(title='Mine 3').updated_at
+        )
+        self.client.login(username='user', password='pw')
+
+    def test_pages_with_constant_queries(self):
+        url = reverse('document_list')
+        self.client.get(url)
+        # Session, user, owned documents, shared documents
+        with self.assertNumQueries(4), CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        sections = [q['sql'] for q in queries if 'editor_document' in q['sql']]
+        # One query per section, neither loading document content
+        self.assertEqual(len(sections), 2)
+        self.assertFalse([sql for sql in sections if '"editor_document"."content"' in sql])
+
+        owned = list(response.context['owned_documents'])
+        self.assertEqual(len(owned), DOCUMENTS_PER_PAGE)
+        self.assertEqual({doc.collaborator_count for doc in owned}, {1})
+        self.assertEqual(len(response.context['shared_documents']), DOCUMENTS_PER_PAGE)
+
+        seen = {doc.id for doc in owned}
+        response = self.client.get(url, {'owned': response.context['owned_next']})
+        rest = list(response.context['owned_documents'])
+        self.assertEqual(len(rest), 30 - DOCUMENTS_PER_PAGE)
+        self.assertFalse(seen & {doc.id for doc in rest})
+        self.assertIsNone(response.context['owned_next'])
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        self.me = User.objects.create_user('searcher', 'me@example.com', 'pw')
+        self.ada = User.objects.create_user('ada_lovelace', 'ada@engines.org', 'pw')
+        self.alan = User.objects.create_user('alan', 'turing@bletchley.uk', 'pw')
+        self.client.login(username='searcher', password='pw')
+
+    def search(self, query):
+        response = self.client.get(reverse('search_users'), {'q': query})
+        return sorted(user['username'] for user in response.json()['users'])
+
+    def test_prefix_and_infix_matches(self):
+        self.assertEqual(self.search('ad'), ['ada_lovelace'])
+        self.assertEqual(self.search('LOVE'), ['ada_lovelace'])
+        self.assertEqual(self.search('bletch'), ['alan'])
+        # Too short for the trigram index but still found inside a word
+        self.assertEqual(self.search('ov'), ['ada_lovelace'])
+        self.assertEqual(self.search('la'), ['ada_lovelace', 'alan'])
+        self.assertEqual(self.search('a"l'), [])
+        # The searcher never finds themselves
+        self.assertEqual(self.search('example'), [])
+
+    def test_index_follows_user_changes(self):
+        self.alan.email = 'alan@manchester.uk'
+        self.alan.save()
+        self.assertEqual(self.search('bletch'), [])
+        self.assertEqual(self.search('manchester'), ['alan'])
+        self.ada.delete()
+        self.assertEqual(self.search('love'), [])
+
+        User.objects.bulk_create([User(username='grace_hopper', email='grace@navy.mil')])
+        self.assertEqual(self.search('hopper'), [])
+        call_command('rebuild_user_search', stdout=StringIO())
+        self.assertEqual(self.search('hopper'), ['grace_hopper'])
+
+
+class DocumentSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user', 'user@example.com', 'pw')
+        other = User.objects.create_user('other', 'other@example.com', 'pw')
+        self.mine = Document.objects.create(
+            title='utils.py', content='import os\n\ndef load_config(path):\n    return open(path)\n', created_by=self.user
+        )
+        self.shared = Document.objects.create(title='app.py', content='config = load_config("a")\n', created_by=other)
+        DocumentCollaborator.objects.create(document=self.shared, user=self.user, added_by=other)
+        Document.objects.create(title='secret.py', content='load_config(secret)\n', created_by=other)
+        self.client.login(username='user', password='pw')
+
+    def search(self, query):
+        response = self.client.get(reverse('search_documents'), {'q': query})
+        return {result['title']: result['matches'] for result in response.json()['results']}
+
+    def test_finds_lines_in_accessible_documents(self):
+        self.assertEqual(self.search('LOAD_CONFIG'), {
+            'utils.py': [{'line': 3, 'text': 'def load_config(path):'}],
+            'app.py': [{'line': 1, 'text': 'config = load_config("a")'}],
+        })
+        self.assertEqual(self.search('ut'), {})
+
+    def test_index_follows_saves_and_flushes(self):
+        room = Room(str(self.mine.id), self.mine.content, owner_id=self.user.id)
+        room.submit(Operation.insert(0, '# needle\n'), room.revision, self.user.id)
+        WriteBehind.write({room.document_id: WriteBehind().take_snapshot(room)})
+        self.assertEqual(self.search('needle'), {'utils.py': [{'line': 1, 'text': '# needle'}]})
+
+        self.shared.title = 'renamed.py'
+        self.shared.save()
+        self.assertEqual(list(self.search('renamed')), ['renamed.py'])
+        self.shared.delete()
+        self.assertEqual(list(self.search('load_config')), ['utils.py'])
+
+
+class FanOutTests(TestCase):
+    async def test_encodes_once_and_skips_sender(self):
+        layer = InMemoryChannelLayer()
+        channels = [await layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await layer.group_add('editor_test', channel)
+
+        await fan_out(layer, 'editor_test', {'type': 'user_joined', 'user_id': 1}, exclude=channels[0])
+        for channel in channels[1:]:
+            message = await layer.receive(channel)
+            self.assertEqual(message['text'], '{"type": "user_joined", "user_id": 1}')
+        self.assertNotIn(channels[0], layer.channels)
+
+
+class HybridChannelLayerTests(TestCase):
+    async def test_local_members_bypass_backend(self):
+        backend = InMemoryChannelLayer()
+        layer = HybridChannelLayer(backend=backend)
+        layer.settle = 0  # nobody else to hear from
+        channels = [await layer.new_channel() for _ in range(2)]
+        for channel in channels:
+            await layer.group_add('editor_test', channel)
+        await asyncio.sleep(0)
+
+        sent = []
+        backend.send = lambda channel, message: sent.append(channel)
+        await layer.group_send_except('editor_test', {'type': 'send.frame', 'text': 'x'}, channels[0])
+        self.assertEqual((await layer.receive(channels[1]))['text'], 'x')
+        self.assertNotIn(channels[0], layer.channels)
+        self.assertEqual(sent, [])
+        await layer.close()
+
+    async def test_delivers_across_processes(self):
+        backend = InMemoryChannelLayer()
+        first, second = HybridChannelLayer(backend=backend), HybridChannelLayer(backend=backend)
+        a = await first.new_channel()
+        b = await second.new_channel()
+        await first.group_add('editor_test', a)
+        await second.group_add('editor_test', b)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(first.peers['editor_test'], {second.relay})
+
+        await first.group_send('editor_test', {'type': 'send.frame', 'text': 'hello'})
+        self.assertEqual((await first.receive(a))['text'], 'hello')
+        self.assertEqual((await asyncio.wait_for(second.receive(b), 1))['text'], 'hello')
+
+        # Direct sends and sends from a process with no members
+        await first.send(b, {'type': 'send.frame', 'text': 'direct'})
+        self.assertEqual((await asyncio.wait_for(second.receive(b), 1))['text'], 'direct')
+        third = HybridChannelLayer(backend=backend)
+        await third.group_send('editor_test', {'type': 'permissions.changed'})
+        self.assertEqual((await asyncio.wait_for(first.receive(a), 1))['type'], 'permissions.changed')
+        self.assertEqual((await asyncio.wait_for(second.receive(b), 1))['type'], 'permissions.changed')
+
+        await second.group_discard('editor_test', b)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(first.peers['editor_test'], set())
+        for layer in (first, second, third):
+            await layer.close()
+
+    async def test_sends_only_expire_their_own_group(self):
+        layer = HybridChannelLayer(group_expiry=10)
+        layer.settle = 0
+        stale, fresh, other = [await layer.new_channel() for _ in range(3)]
+        for group, channel in (('editor_a', stale), ('editor_a', fresh), ('editor_b', other)):
+            await layer.group_add(group, channel)
+        for group, channel in (('editor_a', stale), ('editor_b', other)):
+            layer.groups[group][channel] -= 60
+
+        await layer.group_send('editor_a', {'type': 'send.frame', 'text': 'x'})
+        self.assertEqual(list(layer.groups['editor_a']), [fresh])
+        # Left for the periodic sweep
+        self.assertIn(other, layer.groups['editor_b'])
+        layer._cleaned -= layer.cleanup_interval
+        await layer.group_send('editor_a', {'type': 'send.frame', 'text': 'x'})
+        self.assertEqual(layer.groups['editor_b'], {})
+        await layer.close()
+
+
+class LimitsTests(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(2)
+        now = bucket.updated
+        self.assertEqual([bucket.take(now) for _ in range(5)], [True] * 4 + [False])
+        self.assertAlmostEqual(bucket.wait(), 0.5)
+        self.assertTrue(bucket.take(now + 0.5))
+        self.assertFalse(bucket.take(now + 0.5))
+        # Idle time refills up to the burst only
+        self.assertEqual(sum(bucket.take(now + 60) for _ in range(10)), 4)
+
+    def test_merge_edits(self):
+        def edit(operation, position, text='', length=0, revision=3):
+            return {'type': 'text_change', 'operation': operation, 'position': position,
+                    'text': text, 'length': length, 'revision': revision}
+
+        # Positions are against the shared revision, as the room reads them
+        merged = merge_edits(edit('insert', 4, 'ab'), edit('insert', 4, 'c'))
+        self.assertEqual((merged['position'], merged['text']), (4, 'abc'))
+        self.assertIsNone(merge_edits(edit('insert', 4, 'ab'), edit('insert', 6, 'c')))
+        self.assertIsNone(merge_edits(edit('insert', 4, 'ab'), edit('insert', 4, 'c', revision=4)))
+        # Forward delete and backspace
+        merged = merge_edits(edit('delete', 4, length=1), edit('delete', 5, length=2))
+        self.assertEqual((merged['position'], merged['length']), (4, 3))
+        merged = merge_edits(edit('delete', 4, length=1), edit('delete', 3, length=1))
+        self.assertEqual((merged['position'], merged['length']), (3, 2))
+        self.assertIsNone(merge_edits(edit('delete', 4, length=1), edit('insert', 4, 'x')))
+
+        # Whatever merges commits the same text as the room rebasing each edit
+        for first, second in (
+            (edit('insert', 2, 'ab'), edit('insert', 2, 'c')),
+            (edit('delete', 2, length=2), edit('delete', 3, length=2)),
+            (edit('delete', 4, length=1), edit('delete', 3, length=1)),
+        ):
+            room = Room('doc', 'hello world', 3)
+            room.submit(Operation.from_message(first), 3)
+            room.submit(Operation.from_message(second), 3)
+            merged = Room('doc', 'hello world', 3)
+            merged.submit(Operation.from_message(merge_edits(first, second)), 3)
+            self.assertEqual(merged.content, room.content)
+
+
+class RoomManagerTests(TestCase):
+    def test_evicts_idle_then_least_recently_active(self):
+        rooms = RoomManager()
+        for document_id, content, idle in (('a', 'x' * 5000, 10), ('b', 'y' * 5000, 700), ('c', 'z' * 5000, 20)):
+            room = rooms[document_id] = Room(document_id, content)
+            room.last_active -= idle
+        usage = rooms.memory_usage()
+        self.assertGreater(usage['a'], 5000)
+
+        self.assertEqual([(room.document_id, reason) for room, reason in rooms.evictable()], [('b', 'idle')])
+        # Over budget the least recently active go next until it fits
+        with self.settings(EDITOR_ROOM_MEMORY_BUDGET=usage['a'] + 1):
+            self.assertEqual(
+                [(room.document_id, reason) for room, reason in rooms.evictable()],
+                [('b', 'idle'), ('c', 'memory')]
+            )
+
+
+class HashRingTests(TestCase):
+    def test_only_neighbouring_keys_move(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = [str(i) for i in range(3000)]
+        before = {key: ring.owner(key) for key in keys}
+        self.assertEqual(set(before.values()), {'a', 'b', 'c'})
+
+        ring.add('d')
+        moved = [key for key in keys if ring.owner(key) != before[key]]
+        self.assertTrue(all(ring.owner(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+        ring.remove('d')
+        self.assertEqual({key: ring.owner(key) for key in keys}, before)
+
+
+class ShardingTests(TestCase):
+    # Two workers in one process, each with its own hybrid layer, sharing an
+    # in-memory layer in place of Redis
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.editor = User.objects.create_user('editor', 'editor@example.com', 'pw')
+        self.document = Document.objects.create(title='Doc', content='hello', created_by=self.owner)
+        DocumentCollaborator.objects.create(
+            document=self.document, user=self.editor, permission_level='edit', added_by=self.owner
+        )
+        backend = InMemoryChannelLayer()
+        layers = {
+            alias: {'BACKEND': 'editor.layers.HybridChannelLayer', 'CONFIG': {'backend': backend}}
+            for alias in ('default', 'second')
+        }
+        self.settings_override = self.settings(CHANNEL_LAYERS=layers)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def communicator(self, user, alias):
+        application = URLRouter([
+            re_path(r'ws/editor/(?P<document_id>[\w-]+)/$', EditorConsumer.as_asgi(channel_layer_alias=alias))
+        ])
+        communicator = WebsocketCommunicator(application, f'/ws/editor/{self.document.id}/')
+        communicator.scope['user'] = user
+        return communicator
+
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('condition not reached')
+
+    async def test_room_lives_on_its_owner_and_moves_on_leave(self):
+        workers = [get_worker('default'), get_worker('second')]
+        for worker in workers:
+            await worker.start()
+        await self.wait_for(lambda: all(len(worker.ring.nodes) == 2 for worker in workers))
+        document_id = str(self.document.id)
+        owner = next(worker for worker in workers if worker.owns(document_id))
+        other = workers[1 - workers.index(owner)]
+
+        first, second = self.communicator(self.owner, 'default'), self.communicator(self.editor, 'second')
+        await first.connect()
+        snapshot = await receive_frame(first)
+        await receive_frame(first)  # presence
+        self.assertEqual(snapshot['content'], 'hello')
+        await second.connect()
+        self.assertEqual((await receive_frame(second))['content'], 'hello')
+        await receive_frame(second)  # presence
+        self.assertEqual((await receive_frame(first))['type'], 'user_joined')
+        self.assertIn(document_id, owner.rooms)
+        self.assertNotIn(document_id, other.rooms)
+
+        await second.send_json_to({
+            'type': 'text_change', 'operation': 'insert', 'position': 5, 'text': '!', 'revision': 0
+        })
+        self.assertEqual(await receive_frame(second), {'type': 'ack', 'revision': 1})
+        self.assertEqual((await receive_frame(first))['text'], '!')
+
+        # The owner shuts down: the room moves with its epoch and history,
+        # so an operation made against the old revision still rebases
+        await owner.stop()
+        await self.wait_for(lambda: document_id in other.rooms)
+        room = other.rooms[document_id]
+        self.assertEqual((room.epoch, room.content, room.revision), (snapshot['epoch'], 'hello!', 1))
+        await first.send_json_to({
+            'type': 'text_change', 'operation': 'insert', 'position': 0, 'text': '>', 'revision': 0
+        })
+        self.assertEqual(await receive_frame(first), {'type': 'ack', 'revision': 2})
+        self.assertEqual((await receive_frame(second))['position'], 0)
+
+        await first.disconnect()
+        await second.disconnect()
+        await self.wait_for(lambda: document_id not in other.rooms)
+        await self.document.arefresh_from_db()
+        self.assertEqual((self.document.content, self.document.revision), ('>hello!', 2))
+        await other.stop()
+
+
+    async def test_workers_stay_in_the_ring_past_group_expiry(self):
+        backend = InMemoryChannelLayer(group_expiry=1)
+        layers = {
+            alias: {'BACKEND': 'editor.layers.HybridChannelLayer', 'CONFIG': {'backend': backend, 'group_expiry': 1}}
+            for alias in ('default', 'second')
+        }
+        with self.settings(CHANNEL_LAYERS=layers, EDITOR_WORKER_HEARTBEAT=0.2):
+            workers = [get_worker('default'), get_worker('second')]
+            for worker in workers:
+                await worker.start()
+            await self.wait_for(lambda: all(len(worker.ring.nodes) == 2 for worker in workers))
+            await asyncio.sleep(2.5)
+            self.assertEqual([len(worker.ring.nodes) for worker in workers], [2, 2])
+            for worker in workers:
+                await worker.stop()
+
+
+class MultiProcessShardingTests(TransactionTestCase):
+    # Worker processes talking through a local stand-in for Redis (see
+    # editor.testing), with a SQLite file copied from the test database.
+    # The test process plays the consumers, sending room commands straight
+    # to the workers.
+    WORKER_SETTINGS = {'EDITOR_WORKER_HEARTBEAT': 0.2, 'EDITOR_FLUSH_INTERVAL': 0.1, 'EDITOR_IDLE_FLUSH': 0.05}
+
+    def setUp(self):
+        owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.document = Document.objects.create(title='Doc', content='hello', created_by=owner)
+        self.document_id = str(self.document.id)
+        self.user_id = owner.id
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, 'db.sqlite3')
+        connection.ensure_connection()
+        target = sqlite3.connect(self.database)
+        connection.connection.backup(target)
+        target.close()
+
+    @asynccontextmanager
+    async def cluster(self, count):
+        broker = Broker()
+        port = await broker.start()
+        self.processes, channels = [], []
+        self.client = HybridChannelLayer(backend=BrokerChannelLayer(port=port))
+        reader = None
+        try:
+            for _ in range(count):
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable, '-m', 'editor.testing', str(port), self.database,
+                    json.dumps(self.WORKER_SETTINGS), cwd=settings.BASE_DIR, stdout=asyncio.subprocess.PIPE
+                )
+                self.processes.append(process)
+                channels.append((await asyncio.wait_for(process.stdout.readline(), 30)).decode().strip())
+            self.channel = await self.client.new_channel()
+            self.frames = asyncio.Queue()
+            reader = asyncio.create_task(self.read())
+            # Let the workers hear about each other
+            await asyncio.sleep(1)
+            yield channels
+        finally:
+            if reader is not None:
+                reader.cancel()
+            for process in self.processes:
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            await self.client.close()
+            await broker.close()
+
+    async def read(self):
+        while True:
+            message = await self.client.receive(self.channel)
+            await self.frames.put(json.loads(message['text']))
+
+    async def command(self, worker, op, **fields):
+        await self.client.send(worker, {
+            'type': 'room.command', 'document_id': self.document_id, 'op': op,
+            'channel': self.channel, 'user_id': self.user_id, **fields
+        })
+
+    async def until(self, kind, timeout=5):
+        while True:
+            frame = await asyncio.wait_for(self.frames.get(), timeout)
+            if frame['type'] == kind:
+                return frame
+
+    async def retry(self, worker, op, kind, **fields):
+        # Sends until the worker answers; commands sent to an owner that is
+        # gone are lost
+        for _ in range(30):
+            await self.command(worker, op, **fields)
+            try:
+                return await self.until(kind, 0.3)
+            except asyncio.TimeoutError:
+                pass
+        self.fail(f'no {kind} from {worker}')
+
+    async def submit(self, worker, position, text, revision):
+        await self.command(worker, 'submit', client_id='client', data={
+            'type': 'text_change', 'operation': 'insert', 'position': position, 'text': text, 'revision': revision
+        })
+        return await self.until('ack')
+
+    def stored(self):
+        with sqlite3.connect(self.database) as db:
+            return db.execute(
+                'SELECT content, revision FROM editor_document WHERE id = ?', [self.document.id.hex]
+            ).fetchone()
+
+    async def wait_for_stored(self, expected):
+        for _ in range(100):
+            if self.stored() == expected:
+                return
+            await asyncio.sleep(0.05)
+        self.fail(f'{expected} never stored, got {self.stored()}')
+
+    async def test_commands_reach_the_owner_and_the_room_moves_on_shutdown(self):
+        async with self.cluster(2) as channels:
+            owner = HashRing(channels).owner(self.document_id)
+            other = next(channel for channel in channels if channel != owner)
+
+            # Sent to the other worker, which forwards to the owner
+            await self.command(other, 'attach', binary=False, epoch=None, revision=None)
+            snapshot = await self.until('document_content')
+            self.assertEqual((snapshot['content'], snapshot['revision']), ('hello', 0))
+            self.assertEqual(await self.submit(other, 5, '!', 0), {'type': 'ack', 'revision': 1})
+
+            # The owner shuts down and hands the room over with its history,
+            # so an edit against the old revision still rebases
+            process = self.processes[channels.index(owner)]
+            process.send_signal(signal.SIGTERM)
+            await asyncio.wait_for(process.wait(), 10)
+            moved = await self.retry(other, 'resync', 'document_content')
+            self.assertEqual((moved['epoch'], moved['content'], moved['revision']), (snapshot['epoch'], 'hello!', 1))
+            self.assertEqual(await self.submit(other, 0, '>', 0), {'type': 'ack', 'revision': 2})
+            await self.wait_for_stored(('>hello!', 2))
+
+    async def test_owner_crash_loses_commands_until_it_is_dropped(self):
+        async with self.cluster(2) as channels:
+            owner = HashRing(channels).owner(self.document_id)
+            other = next(channel for channel in channels if channel != owner)
+            await self.command(owner, 'attach', binary=False, epoch=None, revision=None)
+            snapshot = await self.until('document_content')
+            self.assertEqual(await self.submit(owner, 5, '!', 0), {'type': 'ack', 'revision': 1})
+            await self.wait_for_stored(('hello!', 1))
+
+            self.processes[channels.index(owner)].kill()
+            # Until the survivor misses three heartbeats it still forwards to
+            # the dead owner, and those commands are silently dropped
+            await self.command(other, 'resync')
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.until('document_content', 0.5)
+
+            # Then it takes over from the database; the consumer's next
+            # presence heartbeat rejoins and starts over from the content
+            recovered = await self.retry(other, 'heartbeat', 'document_content', binary=False)
+            self.assertEqual((recovered['content'], recovered['revision']), ('hello!', 1))
+            self.assertNotEqual(recovered['epoch'], snapshot['epoch'])
+            self.assertEqual(await self.submit(other, 0, '>', 1), {'type': 'ack', 'revision': 2})
+            await self.wait_for_stored(('>hello!', 2))
+
+
+class ViewportTests(TestCase):
+    def test_overlapping_viewports(self):
+        index = ViewportIndex()
+        index.update('a', 0, 40)
+        index.update('b', 30, 80)
+        index.update('c', 5000, 5040)
+        index.update('a', 100, 140)
+        self.assertEqual(sorted(index.overlapping(35, 35)), ['b'])
+        self.assertEqual(sorted(index.overlapping(70, 120)), ['a', 'b'])
+        index.remove('b')
+        self.assertEqual(index.overlapping(0, 99), [])
+        # A tall viewport reaches lines far below where it starts
+        index.update('tall', 0, 4000)
+        self.assertEqual(sorted(index.overlapping(3000, 3000)), ['tall'])
+        self.assertEqual(sorted(index.overlapping(4040, 6000)), ['c'])
+        index.remove('tall')
+        self.assertEqual(index.overlapping(3000, 3000), [])
+
+    def test_offscreen_members_get_line_summary(self):
+        room = Room('doc', '\n'.join(f'line {i}' for i in range(6000)))
+        room.members = {'near': 1, 'far': 2, 'legacy': 3}
+        room.viewports.update('near', 0, 50)
+        room.viewports.update('far', 5000, 5050)
+        cursor = {'user_id': 4, 'position': room.buffer.line_start(10), 'selection': None}
+
+        frames = room.cursors.frames([cursor])
+        self.assertEqual(frames['near']['cursors'], [cursor])
+        self.assertEqual(frames['legacy']['cursors'], [cursor])
+        self.assertEqual(frames['far'], {'type': 'cursors', 'cursors': [], 'offscreen': [{'user_id': 4, 'line': 10}]})
+
+        # Moving within the same line is not worth telling off-screen members about
+        cursor = dict(cursor, position=cursor['position'] + 2)
+        self.assertNotIn('far', room.cursors.frames([cursor]))
+
+
+class BinaryProtocolTests(TestCase):
+    def test_round_trip(self):
+        frames = [
+            {'type': 'document_content', 'content': 'héllo\n', 'revision': 3, 'epoch': 'abc', 'user_id': 'anonymous'},
+            {'type': 'ack', 'revision': 2 ** 40},
+            {'type': 'text_change', 'user_id': 7, 'revision': 9, 'seq': None,
+             'operation': 'delete', 'position': 300, 'text': '', 'length': 4},
+            {'type': 'replay', 'operations': [
+                {'revision': 1, 'user_id': 1, 'client_id': 'tab', 'seq': 0,
+                 'operation': 'insert', 'position': 0, 'text': 'x', 'length': 1},
+            ], 'revision': 1, 'epoch': 'abc', 'user_id': 1},
+            {'type': 'cursors', 'cursors': [{'user_id': 1, 'position': 5, 'selection': {'from': 2, 'to': 5}}],
+             'offscreen': [{'user_id': 2, 'line': 4000}]},
+            {'type': 'viewport', 'from_line': 10, 'to_line': 60},
+            {'type': 'resync'},
+        ]
+        for frame in frames:
+            self.assertEqual(decode_binary(encode_binary(frame)), frame)
+        self.assertLess(len(encode_binary(frames[2])), 10)
+
+    def test_rejects_malformed_frames(self):
+        for data in [b'', b'\xff', b'\x03', b'\x03\x01\x00']:
+            with self.assertRaises(ProtocolError):
+                decode_binary(data)
+        with self.assertRaises(ProtocolError):
+            encode_binary({'type': 'ack', 'revision': -1})
+        with self.assertRaises(ProtocolError):
+            # A lone surrogate has no UTF-8 encoding
+            encode_binary({'type': 'document_content', 'content': '\ud800', 'revision': 0, 'epoch': 'e', 'user_id': 1})
+
+    def test_rejects_nested_batches(self):
+        # Deep enough to overflow the stack if decoding recursed into it
+        data = encode_binary({'type': 'resync'})
+        for _ in range(1500):
+            data = encode_binary({'type': 'batch', 'frames': [data]})
+        with self.assertRaises(ProtocolError):
+            decode_binary(data)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+
+    def test_prometheus_text(self):
+        metrics.frames_received.inc(('cursor_position',))
+        metrics.frames_received.inc(('cursor_position',), 2)
+        for value in (0.0002, 0.003, 0.003, 10):
+            metrics.db_seconds.observe(value, ('load',))
+        text = metrics.registry.render()
+        self.assertIn('# TYPE editor_frames_received_total counter', text)
+        self.assertIn('editor_frames_received_total{type="cursor_position"} 3', text)
+        self.assertIn('editor_db_seconds_bucket{query="load",le="0.0005"} 1', text)
+        self.assertIn('editor_db_seconds_bucket{query="load",le="0.005"} 3', text)
+        self.assertIn('editor_db_seconds_bucket{query="load",le="+Inf"} 4', text)
+        self.assertIn('editor_db_seconds_count{query="load"} 4', text)
+        self.assertEqual(metrics.db_seconds.snapshot()['load']['p50'], 0.005)
+
+        # Series for a closed room go away with it
+        metrics.room_commands.inc(('a',))
+        metrics.room_commands.inc(('b',))
+        metrics.registry.remove('document', 'a')
+        self.assertEqual(metrics.room_commands.snapshot(), {'b': 1})
+
+    def test_endpoint_requires_staff_or_token(self):
+        User.objects.create_user('staff', password='pw', is_staff=True)
+        User.objects.create_user('member', password='pw')
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.login(username='member', password='pw')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        # Views record their own timings
+        self.client.get(reverse('document_list'))
+        self.client.login(username='staff', password='pw')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('editor_request_seconds_count{view="document_list"} 1', response.content.decode())
+
+        self.client.logout()
+        with self.settings(EDITOR_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class OutboxTests(TestCase):
+    def outbox(self, binary=False):
+        self.sent, self.resyncs = [], []
+
+        async def send(text_data=None, bytes_data=None):
+            self.sent.append(decode_binary(bytes_data) if binary else json.loads(text_data))
+
+        async def resync():
+            self.resyncs.append(True)
+        return Outbox(send, binary, resync)
+
+    def message(self, frame, binary=False):
+        if binary:
+            return {'type': 'send.frame', 'kind': frame['type'], 'bytes': encode_binary(frame)}
+        return {'type': 'send.frame', 'kind': frame['type'], 'text': json.dumps(frame)}
+
+    def cursors(self, *positions, offscreen=()):
+        return {
+            'type': 'cursors',
+            'cursors': [{'user_id': user, 'position': position, 'selection': None} for user, position in positions],
+            'offscreen': [{'user_id': user, 'line': line} for user, line in offscreen]
+        }
+
+    async def test_batches_and_collapses(self):
+        for binary in (False, True):
+            outbox = self.outbox(binary)
+            await outbox.put(self.message({'type': 'ack', 'revision': 1}, binary))
+            await asyncio.sleep(0)
+            self.assertEqual(self.sent, [{'type': 'ack', 'revision': 1}])
+
+            # Queued while the first write's tick runs
+            for frame in [
+                self.cursors((1, 5), (2, 7)),
+                {'type': 'user_joined', 'user_id': 3},
+                self.cursors((1, 6), offscreen=[(2, 4)]),
+                {'type': 'user_left', 'user_id': 3},
+            ]:
+                await outbox.put(self.message(frame, binary))
+            await asyncio.sleep(outbox.interval * 2)
+            self.assertEqual(self.sent[1], {'type': 'batch', 'frames': [
+                self.cursors((1, 6), offscreen=[(2, 4)]),
+                {'type': 'user_left', 'user_id': 3},
+            ]})
+            outbox.close()
+
+    async def test_slow_client_gets_one_snapshot(self):
+        outbox = self.outbox()
+        with self.settings(EDITOR_SEND_QUEUE=3):
+            for revision in range(1, 6):
+                await outbox.put(self.message({
+                    'type': 'text_change', 'user_id': 1, 'revision': revision,
+                    'operation': 'insert', 'position': 0, 'text': 'x', 'length': 1
+                }))
+            self.assertEqual(self.resyncs, [True])
+            await outbox.put(self.message({'type': 'user_joined', 'user_id': 2}))
+            await outbox.put(self.message({
+                'type': 'document_content', 'content': 'xxxxx', 'revision': 5, 'epoch': 'e', 'user_id': 1
+            }))
+        await asyncio.sleep(outbox.interval * 2)
+        frames = self.sent[0]['frames']
+        self.assertEqual([frame['type'] for frame in frames], ['user_joined', 'document_content'])
+        outbox.close()
+
+    def test_binary_batch_round_trip(self):
+        frames = [{'type': 'ack', 'revision': 3}, {'type': 'user_left', 'user_id': 'anonymous'}]
+        batch = encode_binary({'type': 'batch', 'frames': [encode_binary(frame) for frame in frames]})
+        self.assertEqual(decode_binary(batch), {'type': 'batch', 'frames': frames})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class EditorConsumerTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'pw')
+        self.editor = User.objects.create_user('editor', 'editor@example.com', 'pw')
+        self.document = Document.objects.create(title='Doc', content='hello', created_by=self.owner)
+        DocumentCollaborator.objects.create(
+            document=self.document, user=self.editor, permission_level='edit', added_by=self.owner
+        )
+
+    def communicator(self, user=None, query=''):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/editor/{self.document.id}/?{query}'
+        )
+        communicator.scope['user'] = user or self.editor
+        return communicator
+
+    async def test_text_change_sends_only_delta(self):
+        first, second = self.communicator(self.owner), self.communicator()
+        await first.connect()
+        self.assertEqual((await receive_frame(first))['content'], 'hello')
+        self.assertEqual(await receive_frame(first), {'type': 'presence', 'users': [self.owner.id]})
+        await second.connect()
+        self.assertEqual((await receive_frame(second))['content'], 'hello')
+        self.assertEqual(await receive_frame(second), {'type': 'presence', 'users': [self.owner.id, self.editor.id]})
+        await receive_frame(first)  # user_joined
+
+        await second.send_json_to({
+            'type': 'text_change', 'operation': 'insert', 'position': 5, 'text': '!', 'revision': 0
+        })
+        self.assertEqual(await receive_frame(second), {'type': 'ack', 'revision': 1})
+        change = await receive_frame(first)
+        self.assertEqual(change['type'], 'text_change')
+        self.assertEqual(change['revision'], 1)
+        self.assertNotIn('content', change)
+        self.assertEqual(get_room(str(self.document.id)).content, 'hello!')
+
+        for position in range(5):
+            await second.send_json_to({'type': 'cursor_position', 'position': position})
+        await first.send_json_to({'type': 'cursor_position', 'position': 1})
+        cursors = await receive_frame(first)
+        self.assertEqual(cursors['type'], 'cursors')
+        self.assertEqual(
+            {c['user_id']: c['position'] for c in cursors['cursors']},
+            {self.owner.id: 1, self.editor.id: 4}
+        )
+
+        await first.disconnect()
+        await second.disconnect()
+        self.assertIsNone(get_room(str(self.document.id)))
+        await self.document.arefresh_from_db()
+        self.assertEqual(self.document.content, 'hello!')
+
+    async def insert(self, communicator, position, text, revision, seq=None):
+        await communicator.send_json_to({
+            'type': 'text_change', 'operation': 'insert', 'position': position,
+            'text': text, 'revision': revision, 'seq': seq
+        })
+        return await receive_frame(communicator)
+
+    async def test_reconnect_replays_missed_operations(self):
+        first, second = self.communicator(self.owner), self.communicator(query='client_id=tab')
+        await first.connect()
+        snapshot = await receive_frame(first)
+        await receive_frame(first)  # presence
+        await second.connect()
+        await receive_frame(second)
+        await receive_frame(second)  # presence
+        await receive_frame(first)  # user_joined
+
+        await self.insert(second, 0, 'a', 0, seq=1)
+        await receive_frame(first)
+        await second.disconnect()
+        await receive_frame(first)  # user_left
+        await self.insert(first, 0, 'b', 1)
+
+        second = self.communicator(query=f'client_id=tab&epoch={snapshot["epoch"]}&revision=0')
+        await second.connect()
+        replay = await receive_frame(second)
+        await receive_frame(second)  # presence
+        self.assertEqual(replay['type'], 'replay')
+        self.assertEqual(replay['revision'], 2)
+        self.assertEqual(
+            [(op['revision'], op['client_id'], op['seq'], op['text']) for op in replay['operations']],
+            [(1, 'tab', 1, 'a'), (2, None, None, 'b')]
+        )
+        await second.disconnect()
+
+        with self.settings(EDITOR_HISTORY_SIZE=1):
+            await first.disconnect()
+            first = self.communicator(self.owner)
+            await first.connect()
+            snapshot = await receive_frame(first)
+            await receive_frame(first)  # presence
+            epoch = snapshot['epoch']
+            # Revisions carry on from the persisted document
+            self.assertEqual(snapshot['revision'], 2)
+            await self.insert(first, 0, 'c', 2)
+            await self.insert(first, 0, 'd', 3)
+            stale = self.communicator(query=f'epoch={epoch}&revision=2')
+            await stale.connect()
+            self.assertEqual(await receive_frame(stale), {
+                'type': 'document_content', 'content': 'dcbahello', 'revision': 4,
+                'epoch': epoch, 'user_id': self.editor.id
+            })
+            await stale.disconnect()
+        await first.disconnect()
+
+    async def test_binary_subprotocol(self):
+        binary = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/editor/{self.document.id}/',
+            subprotocols=[BINARY_SUBPROTOCOL]
+        )
+        binary.scope['user'] = self.owner
+        text = self.communicator()
+        connected, subprotocol = await binary.connect()
+        self.assertEqual(subprotocol, BINARY_SUBPROTOCOL)
+        self.assertEqual((await receive_frame(binary))['content'], 'hello')
+        await receive_frame(binary)  # presence
+        await text.connect()
+        await receive_frame(text)
+        await receive_frame(text)  # presence
+        await receive_frame(binary)  # user_joined
+
+        await text.send_json_to({
+            'type': 'text_change', 'operation': 'insert', 'position': 0, 'text': '>', 'revision': 0
+        })
+        change = await receive_frame(binary)
+        self.assertEqual((change['type'], change['text'], change['user_id']), ('text_change', '>', self.editor.id))
+
+        await binary.send_to(bytes_data=encode_binary({
+            'type': 'text_change', 'revision': 1, 'seq': 1,
+            'operation': 'delete', 'position': 0, 'text': '', 'length': 1
+        }))
+        self.assertEqual(await receive_frame(binary), {'type': 'ack', 'revision': 2})
+        await receive_frame(text)  # ack for our own insert
+        self.assertEqual((await receive_frame(text))['operation'], 'delete')
+
+        # Hostile input is dropped and both connections stay usable
+        nested = encode_binary({'type': 'resync'})
+        for _ in range(1500):
+            nested = encode_binary({'type': 'batch', 'frames': [nested]})
+        await binary.send_to(bytes_data=nested)
+        await text.send_to(
+            text_data='{"type": "text_change", "operation": "insert", "position": 0, "text": "\\ud800", "revision": 2}'
+        )
+        await binary.send_to(bytes_data=encode_binary({'type': 'resync'}))
+        self.assertEqual((await receive_frame(binary))['content'], 'hello')
+        await text.send_json_to({'type': 'resync'})
+        self.assertEqual((await receive_frame(text))['content'], 'hello')
+
+        await binary.disconnect()
+        await text.disconnect()
+
+    async def test_presence_collapses_tabs_and_expires(self):
+        first, tab, other_tab = self.communicator(self.owner), self.communicator(), self.communicator()
+        await first.connect()
+        await receive_frame(first)
+        await receive_frame(first)  # presence
+        await tab.connect()
+        await receive_frame(tab)
+        self.assertEqual(await receive_frame(tab), {'type': 'presence', 'users': [self.owner.id, self.editor.id]})
+        self.assertEqual(await receive_frame(first), {'type': 'user_joined', 'user_id': self.editor.id})
+
+        # A second tab arriving and the first one leaving are not news
+        await other_tab.connect()
+        await receive_frame(other_tab)
+        await receive_frame(other_tab)
+        await tab.disconnect()
+        self.assertTrue(await first.receive_nothing())
+
+        # The remaining tab stops heartbeating, e.g. because its worker died
+        room = get_room(str(self.document.id))
+        tabs = room.presence.users[self.editor.id]
+        for channel in tabs:
+            tabs[channel] -= 3600
+        await get_worker().expire_presence()
+        self.assertEqual(await receive_frame(first), {'type': 'user_left', 'user_id': self.editor.id})
+        self.assertEqual(room.presence.roster(), [self.owner.id])
+
+        await other_tab.disconnect()
+        await first.disconnect()
+
+    async def test_recorded_session_replays_to_same_content(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(EDITOR_TRACE_DIR=directory):
+            first, second = self.communicator(self.owner), self.communicator()
+            await first.connect()
+            await receive_frame(first)
+            await receive_frame(first)  # presence
+            await second.connect()
+            await receive_frame(second)
+            await receive_frame(second)  # presence
+            await receive_frame(first)  # user_joined
+            # Concurrent edits against the same revision are rebased by the room
+            await first.send_json_to({
+                'type': 'text_change', 'operation': 'insert', 'position': 0, 'text': '>', 'revision': 0
+            })
+            await self.insert(second, 5, ' world', 0)
+            await second.send_json_to({'type': 'cursor_position', 'position': 3})
+            await first.disconnect()
+            await second.disconnect()
+            await recorder.flush()
+
+            [name] = os.listdir(directory)
+            header, events, final = read_trace(os.path.join(directory, name))
+        self.assertEqual(header['content'], 'hello')
+        self.assertEqual(header['limits']['EDITOR_EDIT_RATE'], 20)
+        self.assertEqual([event[2] for event in events], ['attach', 'attach', 'submit', 'submit', 'cursor', 'detach', 'detach'])
+        self.assertEqual(final, '>hello world')
+
+        command = ReplayTrace()
+        document, users = await database_sync_to_async(command.seed)(header, events)
+        await command.replay(document, users, events, 0)
+        await document.arefresh_from_db()
+        self.assertEqual(document.content, final)
+
+    @override_settings(EDITOR_EDIT_RATE=1)
+    async def test_edit_flood_is_merged(self):
+        first, second = self.communicator(self.owner), self.communicator()
+        await first.connect()
+        await receive_frame(first)
+        await receive_frame(first)  # presence
+        await second.connect()
+        await receive_frame(second)
+        await receive_frame(second)  # presence
+        await receive_frame(first)  # user_joined
+
+        # The burst of two goes straight through
+        self.assertEqual(await self.insert(second, 5, 'a', 0), {'type': 'ack', 'revision': 1})
+        self.assertEqual(await self.insert(second, 6, 'b', 1), {'type': 'ack', 'revision': 2})
+        # The rest waits for budget and is committed as one operation
+        for text in 'cde':
+            await second.send_json_to({
+                'type': 'text_change', 'operation': 'insert', 'position': 7, 'text': text, 'revision': 2
+            })
+        self.assertEqual(await receive_frame(second), {'type': 'ack', 'revision': 3})
+        changes = [await receive_frame(first) for _ in range(3)]
+        self.assertEqual([change['text'] for change in changes], ['a', 'b', 'cde'])
+        self.assertEqual(get_room(str(self.document.id)).content, 'helloabcde')
+
+        await first.disconnect()
+        await second.disconnect()
+
+    @override_settings(EDITOR_MAX_ROOM_MEMBERS=1, EDITOR_MAX_FRAME_BYTES=100)
+    async def test_room_and_frame_caps(self):
+        first, second = self.communicator(self.owner), self.communicator()
+        await first.connect()
+        await receive_frame(first)
+        await receive_frame(first)  # presence
+        await second.connect()
+        self.assertEqual(await second.receive_output(), {'type': 'websocket.close', 'code': ROOM_FULL})
+        self.assertTrue(await first.receive_nothing())
+
+        # Frames that are JSON but not objects are ignored
+        for payload in ('[]', '1', '"x"'):
+            await first.send_to(text_data=payload)
+        await first.send_json_to({'type': 'resync'})
+        self.assertEqual((await receive_frame(first))['type'], 'document_content')
+
+        # The cap is in bytes: under 100 characters but well over 100 bytes
+        frame = json.dumps({
+            'type': 'text_change', 'operation': 'insert', 'position': 0, 'text': '😀' * 10, 'revision': 0
+        }, ensure_ascii=False)
+        self.assertLess(len(frame), 100)
+        await first.send_to(text_data=frame)
+        self.assertEqual(await first.receive_output(), {'type': 'websocket.close', 'code': FRAME_TOO_LARGE})
+        self.assertEqual(get_room(str(self.document.id)).content, 'hello')
+        await first.disconnect()
+
+    async def test_idle_room_is_evicted_and_rehydrated(self):
+        first, second = self.communicator(self.owner), self.communicator()
+        await first.connect()
+        await receive_frame(first)
+        await receive_frame(first)  # presence
+        await second.connect()
+        await receive_frame(second)
+        await receive_frame(second)  # presence
+        await receive_frame(first)  # user_joined
+        self.assertEqual(await self.insert(second, 5, '!', 0), {'type': 'ack', 'revision': 1})
+        await receive_frame(first)  # text_change
+
+        worker = get_worker()
+        room = get_room(str(self.document.id))
+        epoch, members = room.epoch, dict(room.members)
+        room.last_active -= 3600
+        await worker.evict_rooms()
+        self.assertIsNone(get_room(str(self.document.id)))
+        await self.document.arefresh_from_db()
+        self.assertEqual(self.document.content, 'hello!')
+
+        # Heartbeats keep the members without loading the room
+        channel, user_id = next(iter(members.items()))
+        await worker.command(str(self.document.id), {'op': 'heartbeat', 'channel': channel, 'user_id': user_id, 'binary': False})
+        self.assertIsNone(get_room(str(self.document.id)))
+
+        # The next edit loads it again, with its members and epoch
+        self.assertEqual(await self.insert(second, 6, '?', 1), {'type': 'ack', 'revision': 2})
+        self.assertEqual((await receive_frame(first))['text'], '?')
+        room = get_room(str(self.document.id))
+        self.assertEqual((room.content, room.epoch, room.members), ('hello!?', epoch, members))
+
+        # Members leaving an evicted room do not load it either
+        room.last_active -= 3600
+        await worker.evict_rooms()
+        await first.disconnect()
+        self.assertEqual(await receive_frame(second), {'type': 'user_left', 'user_id': self.owner.id})
+        self.assertIsNone(get_room(str(self.document.id)))
+        await second.disconnect()
+        await asyncio.sleep(0.1)
+        self.assertIsNone(get_room(str(self.document.id)))
+        self.assertEqual(worker.rooms.dormant, {})
+
+    async def test_permissions_are_enforced(self):
+        stranger = await User.objects.acreate_user('stranger', 'stranger@example.com', 'pw')
+        for user in (AnonymousUser(), stranger):
+            connected, _ = await self.communicator(user).connect()
+            self.assertFalse(connected)
+
+        collaborator = await DocumentCollaborator.objects.aget(document=self.document, user=self.editor)
+        collaborator.permission_level = 'view'
+        await collaborator.asave()
+        viewer = self.communicator()
+        await viewer.connect()
+        await receive_frame(viewer)
+        await receive_frame(viewer)  # presence
+        # Rejected and resynced without touching the document
+        snapshot = await self.insert(viewer, 0, 'x', 0)
+        self.assertEqual((snapshot['type'], snapshot['content']), ('document_content', 'hello'))
+
+        # Upgrades reach connected members without reconnecting
+        collaborator.permission_level = 'edit'
+        await collaborator.asave()
+        # What editor.signals sends once the change commits
+        await get_channel_layer().group_send(f'editor_{self.document.id}', {'type': 'permissions.changed'})
+        self.assertEqual(await self.insert(viewer, 0, 'x', 0), {'type': 'ack', 'revision': 1})
+
+        await collaborator.adelete()
+        await get_channel_layer().group_send(f'editor_{self.document.id}', {'type': 'permissions.changed'})
+        self.assertEqual((await viewer.receive_output())['type'], 'websocket.close')
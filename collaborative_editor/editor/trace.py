@@ -0,0 +1,157 @@
+# Opt-in session traces for reproducing production load offline (see the
+# replay_trace command). With EDITOR_TRACE_DIR set, every room session gets a
+# file <document_id>-<epoch>.jsonl there: a header with the starting content,
+# one line per command the room received from a client, and the final
+# content when the last editor leaves. Commands are recorded where they are
+# applied, in the owning worker, so the trace has the order the room saw.
+# Lines are buffered and written from a thread, so a slow disk never holds
+# up the rooms sharing the worker's event loop.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from .limits import cursor_input_rate, edit_rate, room_cursor_input_rate, room_edit_rate
+
+logger = logging.getLogger(__name__)
+
+
+def connection_key(channel):
+    # Short and the same in every worker, so handed-off rooms keep appending
+    return hashlib.blake2b(channel.encode(), digest_size=4).hexdigest()
+
+
+def encode_event(message):
+    # Stamped with the wall clock; made relative to the session start when
+    # written
+    op = message['op']
+    if op == 'attach':
+        payload = {'user': message['user_id'], 'binary': message['binary']}
+    elif op == 'submit':
+        payload = message['data']
+    elif op == 'cursor':
+        payload = [message['position'], message['selection']]
+    elif op == 'viewport':
+        payload = [message['from_line'], message['to_line']]
+    else:
+        payload = None
+    return [time.time(), connection_key(message['channel']), op, payload]
+
+
+class Session:
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.lines = []  # buffered, not yet handed to the writer
+        self.closing = False
+        # Only touched by the writer thread
+        self.file = None
+        self.started = None
+
+
+class TraceRecorder:
+    def __init__(self):
+        self.sessions = {}  # document_id -> Session
+        self.queue = []  # sessions with something to write, in order
+        self._task = None
+
+    @property
+    def directory(self):
+        return getattr(settings, 'EDITOR_TRACE_DIR', None)
+
+    def start(self, room):
+        if not self.directory or room.document_id in self.sessions:
+            return
+        path = os.path.join(self.directory, f'{room.document_id}-{room.epoch}.jsonl')
+        session = self.sessions[room.document_id] = Session(path, {
+            'document': room.document_id,
+            'epoch': room.epoch,
+            'content': room.content,
+            'revision': room.revision,
+            'started': time.time(),
+            # Admission control decides what is deferred and merged, so a
+            # replay needs the same limits to reach the same content
+            'limits': {
+                'EDITOR_EDIT_RATE': edit_rate(),
+                'EDITOR_ROOM_EDIT_RATE': room_edit_rate(),
+                'EDITOR_CURSOR_INPUT_RATE': cursor_input_rate(),
+                'EDITOR_ROOM_CURSOR_INPUT_RATE': room_cursor_input_rate(),
+            }
+        })
+        self._queue(session)
+
+    def record(self, room, message):
+        session = self.sessions.get(room.document_id)
+        if session is not None and message['op'] != 'heartbeat':
+            session.lines.append(encode_event(message))
+            self._queue(session)
+
+    def stop(self, room, final=False):
+        session = self.sessions.pop(room.document_id, None)
+        if session is None:
+            return
+        if final:
+            session.lines.append({'final': room.content, 'revision': room.revision})
+        session.closing = True
+        self._queue(session)
+
+    async def flush(self):
+        # Waits until everything recorded so far is written
+        if self.queue:
+            self._ensure_running()
+        if self._task is not None and self._task.get_loop() is asyncio.get_running_loop():
+            await asyncio.shield(self._task)
+
+    def _queue(self, session):
+        if session not in self.queue:
+            self.queue.append(session)
+        self._ensure_running()
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self.queue:
+            batch, self.queue = self.queue, []
+            batch = [(session, session.lines, session.closing) for session in batch]
+            for session, _, _ in batch:
+                session.lines = []
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception:
+                logger.exception('Failed to write session traces')
+
+    @staticmethod
+    def _open(session):
+        os.makedirs(os.path.dirname(session.path), exist_ok=True)
+        started = None
+        if os.path.exists(session.path) and os.path.getsize(session.path):
+            # Handed over from another worker: keep its clock
+            with open(session.path) as f:
+                started = json.loads(f.readline())['started']
+        session.file = open(session.path, 'a')
+        if started is None:
+            started = session.header['started']
+            session.file.write(json.dumps(session.header, separators=(',', ':')) + '\n')
+        session.started = started
+
+    def _write(self, batch):
+        for session, lines, closing in batch:
+            if session.file is None:
+                self._open(session)
+            for line in lines:
+                if isinstance(line, list):
+                    line = [round((line[0] - session.started) * 1000)] + line[1:]
+                session.file.write(json.dumps(line, separators=(',', ':')) + '\n')
+            session.file.flush()
+            if closing:
+                session.file.close()
+
+
+recorder = TraceRecorder()
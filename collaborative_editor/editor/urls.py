@@ -9,7 +9,10 @@ urlpatterns = [
     path('delete/<uuid:document_id>/', views.delete_document, name='delete_document'),
     path('collaborators/<uuid:document_id>/', views.manage_collaborators, name='manage_collaborators'),
     path('api/search-users/', views.search_users, name='search_users'),
+    path('api/search-documents/', views.search_documents, name='search_documents'),
     path('api/add-collaborator/<uuid:document_id>/', views.add_collaborator, name='add_collaborator'),
     path('api/remove-collaborator/<uuid:document_id>/<int:collaborator_id>/', views.remove_collaborator, name='remove_collaborator'),
-    path('api/update-permission/<uuid:document_id>/<int:collaborator_id>/', views.update_collaborator_permission, name='update_collaborator_permission')
+    path('api/update-permission/<uuid:document_id>/<int:collaborator_id>/', views.update_collaborator_permission, name='update_collaborator_permission'),
+    path('api/compare/<uuid:document_id>/<int:from_version>/<int:to_version>/', views.compare_versions, name='compare_versions'),
+    path('metrics/', views.metrics, name='metrics')
 ]
\ No newline at end of file
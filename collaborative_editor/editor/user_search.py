@@ -0,0 +1,81 @@
+# Indexed user lookup behind views.search_users. On SQLite two FTS5 tables
+# mirror auth_user's username and email (kept in sync by editor.signals):
+# queries of three or more characters match anywhere through a trigram
+# table. Shorter ones match the start of a word through a prefix index and,
+# when that finds too few, anywhere through a bounded icontains scan.
+# Other databases fall back to the icontains query.
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+
+TRIGRAM_TABLE = 'editor_usersearch'
+PREFIX_TABLE = 'editor_usersearch_prefix'
+TABLES = (TRIGRAM_TABLE, PREFIX_TABLE)
+
+
+def enabled():
+    return connection.vendor == 'sqlite'
+
+
+def index_user(user):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [user.id])
+            cursor.execute(
+                f'INSERT INTO {table} (rowid, username, email) VALUES (%s, %s, %s)',
+                [user.id, user.username, user.email]
+            )
+
+
+def unindex_user(user_id):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [user_id])
+
+
+def rebuild():
+    # For users written without signals, e.g. bulk_create or raw imports
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(
+                f'INSERT INTO {table} (rowid, username, email) SELECT id, username, email FROM auth_user'
+            )
+
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def matching_user_ids(query, limit):
+    if len(query) >= 3:
+        table, match = TRIGRAM_TABLE, _phrase(query)
+    else:
+        table, match = PREFIX_TABLE, _phrase(query) + ' *'
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid FROM {table} WHERE {table} MATCH %s LIMIT %s', [match, limit])
+        ids = [row[0] for row in cursor.fetchall()]
+    if len(ids) < limit and len(query) < 3:
+        # Too short for a trigram; fill up with matches inside words
+        ids += list(
+            User.objects.filter(Q(username__icontains=query) | Q(email__icontains=query))
+            .exclude(id__in=ids).values_list('id', flat=True)[:limit - len(ids)]
+        )
+    return ids
+
+
+def search_users(query, exclude=None, limit=10):
+    if not enabled():
+        return list(
+            User.objects.filter(Q(username__icontains=query) | Q(email__icontains=query))
+            .exclude(id=exclude)[:limit]
+        )
+    ids = [user_id for user_id in matching_user_ids(query, limit + 1) if user_id != exclude][:limit]
+    users = User.objects.in_bulk(ids)
+    return [users[user_id] for user_id in ids if user_id in users]
@@ -0,0 +1,133 @@
+# Version rows are stored as reverse deltas: the newest version of a document
+# holds its full text and each older one the edits that turn the next newer
+# version back into it. Every EDITOR_VERSION_KEYFRAME versions a full copy is
+# kept, so rebuilding any version applies fewer than that many deltas.
+# Payloads are zlib-compressed when EDITOR_VERSION_COMPRESSION is on.
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Document, DocumentVersion
+
+FULL = 'full'
+DELTA = 'delta'
+
+
+def keyframe_interval():
+    return max(getattr(settings, 'EDITOR_VERSION_KEYFRAME', 20), 1)
+
+
+def compression_enabled():
+    return getattr(settings, 'EDITOR_VERSION_COMPRESSION', True)
+
+
+def make_delta(base, target):
+    # Line-level instructions rebuilding target from base: [start, end]
+    # copies base lines, a string is literal text. Uses the Myers diff from
+    # editor.diff, which imports this module
+    from .diff import diff_lines
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in diff_lines(base_lines, target_lines):
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j1 < j2:
+            delta.append(''.join(target_lines[j1:j2]))
+    return delta
+
+
+def apply_delta(base, delta):
+    lines = base.splitlines(keepends=True)
+    return ''.join(
+        ''.join(lines[part[0]:part[1]]) if isinstance(part, list) else part
+        for part in delta
+    )
+
+
+def stored_size(version):
+    return len(version.content.encode()) + len(bytes(version.data or b''))
+
+
+def _payload(version):
+    data = bytes(version.data)
+    return (zlib.decompress(data) if version.compressed else data).decode()
+
+
+def _full_text(version):
+    return _payload(version) if version.data is not None else version.content
+
+
+def encode_full(version, content, compress=None):
+    compress = compression_enabled() if compress is None else compress
+    version.storage = FULL
+    if compress:
+        version.content, version.data = '', zlib.compress(content.encode())
+    else:
+        version.content, version.data = content, None
+    version.compressed = compress
+
+
+def encode_delta(version, base, content, compress=None):
+    # Store version as the delta from base (the next newer version's text)
+    compress = compression_enabled() if compress is None else compress
+    payload = json.dumps(make_delta(base, content), separators=(',', ':')).encode()
+    version.storage = DELTA
+    version.content = ''
+    version.data = zlib.compress(payload) if compress else payload
+    version.compressed = compress
+
+
+def version_content(version):
+    chain = [version]
+    while chain[-1].storage == DELTA:
+        newer = list(
+            DocumentVersion.objects
+            .filter(document_id=version.document_id, id__gt=chain[-1].id)
+            .order_by('id')[:keyframe_interval()]
+        )
+        if not newer:
+            raise LookupError(f'version {version.id} has no full version to rebuild from')
+        for row in newer:
+            chain.append(row)
+            if row.storage == FULL:
+                break
+    content = _full_text(chain[-1])
+    for row in reversed(chain[:-1]):
+        content = apply_delta(content, json.loads(_payload(row)))
+    return content
+
+
+def store_version(document_id, content, **fields):
+    # Adds the newest version of a document, turning the previous newest into
+    # a delta against it unless it has to stay a keyframe. Deltas always
+    # point at the next newer row by id, whatever revisions the rows carry.
+    interval = keyframe_interval()
+    with transaction.atomic():
+        # Serialize writers of the same document's chain
+        list(Document.objects.select_for_update().filter(id=document_id).values_list('id'))
+        recent = list(
+            DocumentVersion.objects
+            .filter(document_id=document_id)
+            .order_by('-id')
+            .values_list('storage', flat=True)[:interval]
+        )
+        previous = None
+        if recent and recent[0] == FULL:
+            run = 0
+            for storage in recent[1:]:
+                if storage != DELTA:
+                    break
+                run += 1
+            if run < interval - 1:
+                previous = DocumentVersion.objects.filter(document_id=document_id).order_by('-id').first()
+
+        version = DocumentVersion(document_id=document_id, **fields)
+        encode_full(version, content)
+        version.save()
+        if previous is not None:
+            encode_delta(previous, content, _full_text(previous))
+            previous.save(update_fields=['storage', 'content', 'data', 'compressed'])
+    return version
@@ -3,11 +3,20 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Q
-from django.http import JsonResponse
-from .models import Document, DocumentCollaborator
+from django.conf import settings
+from django.db.models import Count, Q
+from django.http import HttpResponse, JsonResponse
+from .metrics import registry
+from .diff import compare_versions as diff_versions
+from .models import Document, DocumentCollaborator, DocumentVersion
+from .permissions import OWNER, can_edit, permission_level
+from .document_search import search_documents as find_documents
+from .user_search import search_users as find_users
 from .forms import CustomUserCreationForm
+from datetime import datetime
+import hmac
 import json
+import uuid
 
 # Create your views here.
 
@@ -31,15 +40,65 @@ def user_logout(request):
     messages.info(request, 'You have been successfully logged out.')
     return redirect('login')
 
+DOCUMENTS_PER_PAGE = 24
+
+def parse_cursor(value):
+    # Cursors are "<updated_at isoformat>|<document id>" of the last row shown
+    try:
+        updated_at, document_id = value.split('|')
+        return datetime.fromisoformat(updated_at), uuid.UUID(document_id)
+    except (AttributeError, ValueError):
+        return None
+
+def keyset_page(queryset, cursor, prefix=''):
+    # Newest first, seeking past the cursor instead of OFFSET so deep pages
+    # cost the same as the first one
+    updated_field, id_field = f'{prefix}updated_at', f'{prefix}id'
+    position = parse_cursor(cursor)
+    if position is not None:
+        updated_at, document_id = position
+        queryset = queryset.filter(
+            Q(**{f'{updated_field}__lt': updated_at}) |
+            Q(**{updated_field: updated_at, f'{id_field}__lt': document_id})
+        )
+    rows = list(queryset.order_by(f'-{updated_field}', f'-{id_field}')[:DOCUMENTS_PER_PAGE + 1])
+    next_cursor = None
+    if len(rows) > DOCUMENTS_PER_PAGE:
+        rows = rows[:DOCUMENTS_PER_PAGE]
+        last = rows[-1] if not prefix else rows[-1].document
+        next_cursor = f'{last.updated_at.isoformat()}|{last.id}'
+    return rows, next_cursor
+
 @login_required
 def document_list(request):
-    owned_documents = Document.objects.filter(created_by=request.user)
-    shared_document_collabs = DocumentCollaborator.objects.filter(user=request.user).select_related('document', 'document__created_by')
-    shared_documents = [(collab.document, collab.permission_level) for collab in shared_document_collabs ]
+    owned_cursor = request.GET.get('owned')
+    shared_cursor = request.GET.get('shared')
+
+    owned_documents, owned_next = keyset_page(
+        Document.objects.filter(created_by=request.user)
+        .only('id', 'title', 'language', 'created_at', 'updated_at')
+        .annotate(collaborator_count=Count('collaborators')),
+        owned_cursor
+    )
+    shared_document_collabs, shared_next = keyset_page(
+        DocumentCollaborator.objects.filter(user=request.user)
+        .select_related('document', 'document__created_by')
+        .only(
+            'permission_level', 'document__id', 'document__title', 'document__language',
+            'document__created_at', 'document__updated_at', 'document__created_by__username'
+        ),
+        shared_cursor,
+        prefix='document__'
+    )
+    shared_documents = [(collab.document, collab.permission_level) for collab in shared_document_collabs]
 
     context = {
-        'owned_documents': owned_documents.order_by('-updated_at'),
+        'owned_documents': owned_documents,
         'shared_documents': shared_documents,
+        'owned_cursor': owned_cursor or '',
+        'shared_cursor': shared_cursor or '',
+        'owned_next': owned_next,
+        'shared_next': shared_next,
     }
     return render(request, 'editor/document_list.html', context)
 
@@ -59,26 +118,25 @@ def create_document(request):
 @login_required
 def editor(request, document_id):
     document = get_object_or_404(Document, id=document_id)
-    if not document.has_permission(request.user):
+    level = permission_level(document.id, request.user)
+    if level is None:
         messages.error(request, 'You do not have permission to access this document.')
         return redirect('document_list')
-    
-    permission_level = document.get_permission_level(request.user)
-    is_owner = document.created_by == request.user
 
     return render(request, 'editor/editor.html', {
         'document': document,
         'document_id': str(document.id),
-        'permission_level': permission_level,
-        'is_owner': is_owner,
-        'can_edit': permission_level in ['owner', 'edit']
+        'permission_level': level,
+        'is_owner': level == OWNER,
+        'can_edit': can_edit(level),
+        'binary_protocol': getattr(settings, 'EDITOR_BINARY_PROTOCOL', False)
     })
 
 @login_required
 def delete_document(request, document_id):
     document = get_object_or_404(Document, id=document_id)
 
-    if document.created_by != request.user:
+    if permission_level(document.id, request.user) != OWNER:
         messages.error(request, 'You do not have permission to delete this document.')
         return redirect(document_list)
     
@@ -94,7 +152,7 @@ def delete_document(request, document_id):
 def manage_collaborators(request, document_id):
     document = get_object_or_404(Document, id=document_id)
 
-    if document.created_by != request.user:
+    if permission_level(document.id, request.user) != OWNER:
         messages.error(request, 'You do not have permission to manage collaborators.')
         return redirect('document_list')
     
@@ -112,9 +170,7 @@ def search_users(request):
     if len(query) < 2:
         return JsonResponse({'users': []})
     
-    users = User.objects.filter(
-        Q(username__icontains=query) | Q(email__icontains=query)
-    ).exclude(id=request.user.id)[:10]
+    users = find_users(query, exclude=request.user.id, limit=10)
 
     user_list = [{
         'id': user.id,
@@ -132,30 +188,30 @@ def add_collaborator(request, document_id):
     
     document = get_object_or_404(Document, id=document_id)
 
-    if document.created_by != request.user:
+    if permission_level(document.id, request.user) != OWNER:
         return JsonResponse({'error': 'Permission denied'}, status=403)
     
     try:
         data = json.loads(request.body)
         user_id = data.get('user_id')
-        permission_level = data.get('permission_level', 'view')
+        level = data.get('permission_level', 'view')
 
         user = User.objects.get(id=user_id)
 
-        if user == document.created_by:
+        if user.id == document.created_by_id:
             return JsonResponse({'error': 'Cannot add document owner as collaborator'}, status=400)
         
         collaborator, created = DocumentCollaborator.objects.get_or_create(
             document=document,
             user=user,
             defaults={
-                'permission_level': permission_level,
+                'permission_level': level,
                 'added_by': request.user
             }
         )
 
         if not created:
-            collaborator.permission_level = permission_level
+            collaborator.permission_level = level
             collaborator.save()
 
 
@@ -186,7 +242,7 @@ def remove_collaborator(request, document_id, collaborator_id):
     document = get_object_or_404(Document, id=document_id)
     collaborator = get_object_or_404(DocumentCollaborator, id=collaborator_id, document=document)
 
-    if document.created_by != request.user:
+    if permission_level(document.id, request.user) != OWNER:
         messages.error(request, 'You do not have permission to remove collaborators.')
         return redirect('document_list')
     
@@ -205,23 +261,75 @@ def update_collaborator_permission(request, document_id, collaborator_id):
     document = get_object_or_404(Document, id=document_id)
     collaborator = get_object_or_404(DocumentCollaborator, id=collaborator_id, document=document)
 
-    if document.created_by != request.user:
+    if permission_level(document.id, request.user) != OWNER:
         return JsonResponse({'error': 'Permission denied'}, status=403)
     
     try:
         data = json.loads(request.body)
-        permission_level = data.get('permission_level')
+        level = data.get('permission_level')
         
-        if permission_level not in ['view', 'edit']:
+        if level not in ['view', 'edit']:
             return JsonResponse({'error': 'Invalid permission level'}, status=400)
         
-        collaborator.permission_level = permission_level
+        collaborator.permission_level = level
         collaborator.save()
 
         return JsonResponse({
             'success': True,
-            'message': f'Permission updated to {permission_level}'
+            'message': f'Permission updated to {level}'
         })
     
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=400)
+
+@login_required
+def compare_versions(request, document_id, from_version, to_version):
+    document = get_object_or_404(Document, id=document_id)
+
+    if permission_level(document.id, request.user) is None:
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+
+    versions = {
+        version.id: version for version in DocumentVersion.objects.filter(
+            document=document, id__in=[from_version, to_version]
+        ).only('id', 'revision', 'created_at', 'change_description')
+    }
+    if from_version not in versions or to_version not in versions:
+        return JsonResponse({'error': 'Version not found'}, status=404)
+
+    def describe(version):
+        return {
+            'id': version.id,
+            'revision': version.revision,
+            'created_at': version.created_at.isoformat(),
+            'change_description': version.change_description
+        }
+
+    return JsonResponse({
+        'from': describe(versions[from_version]),
+        'to': describe(versions[to_version]),
+        **diff_versions(document.id, from_version, to_version)
+    })
+
+@login_required
+def search_documents(request):
+    query = request.GET.get('q', '').strip()
+
+    results = [{
+        'id': str(document.id),
+        'title': document.title,
+        'language': document.language,
+        'matches': [{'line': line, 'text': text} for line, text in matches]
+    } for document, matches in find_documents(request.user, query)]
+
+    return JsonResponse({'results': results})
+
+def metrics(request):
+    # Scraped by Prometheus with EDITOR_METRICS_TOKEN as a bearer token;
+    # staff can also look at it from a browser session
+    token = getattr(settings, 'EDITOR_METRICS_TOKEN', None)
+    authorization = request.headers.get('Authorization', '')
+    allowed = request.user.is_staff or bool(token) and hmac.compare_digest(authorization, f'Bearer {token}')
+    if not allowed:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')